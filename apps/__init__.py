@@ -66,6 +66,14 @@ from apps.scanpy.dataframes.app import add_dash as add_dash_scanpy_dataframes
 app = add_dash_scanpy_dataframes(app, appbuilder, title, **pathname_params)
 app.config['url_mappings'][view_type] = url_base
 
+# density tiles for the full resolution embedding plots
+from apps.scanpy.tiles import blueprint as scanpy_tiles_blueprint
+app.register_blueprint(scanpy_tiles_blueprint)
+
+# streaming obs/var exports for the dataframes app
+from apps.scanpy.dataframes.export import blueprint as scanpy_dataframes_export_blueprint
+app.register_blueprint(scanpy_dataframes_export_blueprint)
+
 #############################
 # CellxGene
 #############################
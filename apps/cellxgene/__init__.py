@@ -37,6 +37,11 @@ def register_additional_blueprints(app):
     resources = get_api_dataroot_resources(bp_api)
     app.register_blueprint(resources.blueprint)
 
+    # arrow data access for notebooks
+    from apps.cellxgene.data_api import blueprint as data_api_blueprint
+
+    app.register_blueprint(data_api_blueprint)
+
 
 def add_url_rule(app):
     app.add_url_rule(
@@ -11,17 +11,27 @@ from server.data_common.matrix_loader import MatrixDataLoader
 from server.common.errors import DatasetAccessError, RequestException
 import server.common.rest as common_rest
 
+import copy
 import os
 from functools import lru_cache
 import logging
 from apps.logger import logger
-from apps import s3_utils
+from apps import s3_utils, disk_cache, gene_matrix, pipeline
+from apps import dataset_catalog
+from apps.dataset_registry import DATASET_CACHE_MAX_BYTES, registry, set_dataset_info
 
 DEFAULT_CONFIG = AppConfig()
 
 ANNOTATION_DIR = os.environ.get("ANNOTATION_DIR", os.path.abspath("annotations"))
 CELLXGENE_BUCKET = os.environ.get("CELLXGENE_BUCKET", False) or os.environ.get('BUCKET', False) or ""
 AWS_REGION = os.environ.get('AWS_DEFAULT_REGION', 'us-east-1')
+# open h5ad files read only with X left on disk, obs/var/obsm are still read into memory.
+# With auto, only datasets whose X takes more than ANNDATA_BACKED_MIN_BYTES are backed.
+ANNDATA_BACKED_MODE = os.environ.get("ANNDATA_BACKED", "True").lower()
+ANNDATA_BACKED = ANNDATA_BACKED_MODE in ["true", "1", "yes"]
+ANNDATA_BACKED_MIN_BYTES = int(
+    os.environ.get("ANNDATA_BACKED_MIN_BYTES", False) or DATASET_CACHE_MAX_BYTES // 4
+)
 
 # these all come from the click cli options
 # https://github.com/chanzuckerberg/cellxgene/blob/3ebbb0ccbf91955fa27913ac73d73298e018311c/server/cli/launch.py
@@ -97,10 +107,74 @@ def set_default_config(
     return
 
 
-@lru_cache(maxsize=10, typed=False)
-def load_matrix(app_config, datapath):
-    matrix_data_loader = MatrixDataLoader(datapath, app_config=app_config)
-    return matrix_data_loader.open(app_config)
+# backed or in memory, per datapath, so a dataset is reopened the same way after eviction
+_backed = {}
+
+
+def dataset_app_config(app_config, backed):
+    """
+    Copy of app_config for opening one dataset, only the backed setting differs.
+    The copy is shallow so the shared config is never changed by a load.
+    """
+    config = copy.copy(app_config)
+    config.server_config = copy.copy(app_config.server_config)
+    config.server_config.adaptor__anndata_adaptor__backed = backed
+    return config
+
+
+def load_matrix(app_config, datapath, backed=None):
+    """
+    :param backed: open X backed, by default the mode chosen for datapath
+        before, or by choose_backed
+    """
+    if backed is not None:
+        _backed[datapath] = backed
+
+    def loader():
+        local_path = disk_cache.open_local(datapath)
+        mode = _backed.get(datapath)
+        if mode is None:
+            mode = _backed[datapath] = choose_backed(datapath)
+        logger.info(
+            f"Loading matrix {datapath} from {local_path} "
+            f"{'backed' if mode else 'in memory'}"
+        )
+        config = dataset_app_config(app_config, mode)
+        matrix_data_loader = MatrixDataLoader(local_path, app_config=config)
+        adaptor = matrix_data_loader.open(config)
+        set_dataset_info(
+            adaptor.data,
+            key=datapath,
+            source=datapath,
+            local_path=local_path,
+            dataset_hash=disk_cache.content_hash(local_path),
+            backed=mode,
+        )
+        # embeddings computed by an earlier process
+        pipeline.restore(adaptor.data)
+        # gene expression requests read from the gene-major copy of X once it is built
+        gene_matrix.attach(adaptor)
+        gene_matrix.build_in_background(adaptor.data)
+        return adaptor
+
+    return registry.get(datapath, loader)
+
+
+def set_active_adaptor(app, datapath, adaptor):
+    """
+    The active dataset is referenced by the app and cellxgene,
+    so keep it pinned in the registry while it is being served.
+    """
+    previous = getattr(app, "active_datapath", None)
+    if previous != datapath:
+        if datapath in registry:
+            registry.pin(datapath)
+        if previous:
+            registry.unpin(previous)
+        app.active_datapath = datapath
+    app.data_adaptor = adaptor
+    app.app_config.server_config.data_adaptor = adaptor
+
 
 def load_matrix_no_cache():
     app_config = current_app.app_config
@@ -130,12 +204,30 @@ def generate_annotation_dir(anndata_path):
     return annotations_dir
 
 
+def choose_backed(adata_path):
+    """
+    Backed or in memory for a dataset, decided from its header in auto mode
+    """
+    if ANNDATA_BACKED_MODE != "auto":
+        return ANNDATA_BACKED
+    metadata = dataset_catalog.dataset_metadata(adata_path)
+    if not metadata or not metadata["X"]:
+        return True
+    backed = metadata["X"]["nbytes"] > ANNDATA_BACKED_MIN_BYTES
+    logger.info(
+        f"X of {adata_path} takes {metadata['X']['nbytes']} bytes, "
+        f"opening it {'backed' if backed else 'in memory'}"
+    )
+    return backed
+
+
 @lru_cache(maxsize=10, typed=False)
 def update_datapath(adata_path, csv_path):
     try:
         app_config = current_app.app_config
         logger.info(app_config)
-        set_default_config(app_config, adata_path)
+        # load_matrix opens each dataset with the mode chosen for it
+        set_default_config(app_config, adata_path, backed=ANNDATA_BACKED)
 
         app_config.update_server_config(
             single_dataset__datapath=adata_path,
@@ -155,8 +247,7 @@ def update_datapath(adata_path, csv_path):
             app_config.dataset_config.user_annotations__local_file_csv__directory = annotation_dir
 
         app_config.server_config.data_locator__s3__region_name = AWS_REGION
-        server_config.data_adaptor = load_matrix(app_config, adata_path)
-        current_app.data_adaptor = app_config.server_config.data_adaptor
+        set_active_adaptor(current_app, adata_path, load_matrix(app_config, adata_path))
 
         def messagefn(message):
             print("[cellxgene] " + message)
@@ -0,0 +1,207 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from flask import Blueprint, Response, abort, current_app, jsonify, request, session
+from pandas.api.types import is_categorical_dtype
+
+from apps import gene_matrix
+from apps.cellxgene import config as cellxgene_config
+from apps.scanpy.dataframes.export import StreamSink
+from apps.security import authenticated
+
+"""
+Arrow IPC API to read parts of a dataset without downloading the h5ad
+
+    GET /cellxgene/data/v1/schema
+    GET /cellxgene/data/v1/obs?columns=a,b&start=0&stop=1000
+    GET /cellxgene/data/v1/var?columns=a,b
+    GET /cellxgene/data/v1/obsm/<key>?components=0,1&start=0&stop=1000
+    GET /cellxgene/data/v1/genes?genes=CD3E,MS4A1&raw=true&start=0&stop=1000
+
+Every endpoint takes ?dataset=s3://bucket/path.h5ad, the session dataset is used
+without it. A logged in session or a JWT is required. Tables are sent as Arrow IPC streams, numeric columns are handed to
+Arrow as views of the numpy buffers.
+
+    with pyarrow.ipc.open_stream(response.content) as reader:
+        df = reader.read_pandas()
+"""
+
+ARROW_BATCH_ROWS = int(os.environ.get("ARROW_BATCH_ROWS", 65536))
+ARROW_STREAM_MIMETYPE = "application/vnd.apache.arrow.stream"
+BUCKET = cellxgene_config.CELLXGENE_BUCKET
+
+blueprint = Blueprint("data_api", __name__, url_prefix="/cellxgene/data/v1")
+
+
+def _dataset():
+    datapath = request.args.get("dataset") or session.get("adata_path")
+    if not datapath:
+        abort(400, "Pass the dataset to read, e.g. ?dataset=s3://bucket/data.h5ad")
+    if not BUCKET:
+        abort(403, "No bucket is configured to read datasets from")
+    if not datapath.startswith(f"s3://{BUCKET}/"):
+        abort(403, f"Only datasets in s3://{BUCKET} can be read")
+    # only through the registry, the dataset served by cellxgene is left alone
+    try:
+        adaptor = cellxgene_config.load_matrix(current_app.app_config, datapath)
+    except FileNotFoundError:
+        abort(404, f"{datapath} does not exist")
+    return adaptor.data
+
+
+def _list_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    return [item for item in value.split(",") if item]
+
+
+def _rows(n_rows):
+    """
+    Slice of the rows requested with ?start=&stop=
+    """
+    try:
+        start = int(request.args.get("start", 0))
+        stop = int(request.args.get("stop", n_rows))
+    except ValueError:
+        abort(400, "start and stop must be integers")
+    if start < 0 or stop < start:
+        abort(400, "Expected 0 <= start <= stop")
+    return slice(start, min(stop, n_rows))
+
+
+def _index_arg():
+    return request.args.get("index", "true").lower() in ["true", "1", "yes"]
+
+
+def to_arrow(values):
+    """
+    Arrow array of a column. Contiguous numeric arrays share their buffer
+    with Arrow, categoricals are sent as dictionary arrays of their codes.
+    """
+    if isinstance(values, pd.Series):
+        if is_categorical_dtype(values):
+            codes = np.asarray(values.cat.codes)
+            # missing values are null indices, from_arrays takes no mask with Arrow input
+            return pa.DictionaryArray.from_arrays(
+                pa.array(codes, mask=codes < 0),
+                pa.array(np.asarray(values.cat.categories.astype(str))),
+            )
+        values = values.to_numpy()
+    if values.dtype.kind in "iuf" and not values.dtype.isnative:
+        # Arrow only reads native byte order
+        values = values.astype(values.dtype.newbyteorder("="))
+    if values.dtype.kind in "iuf" and values.flags["C_CONTIGUOUS"]:
+        return pa.Array.from_buffers(
+            pa.from_numpy_dtype(values.dtype), len(values), [None, pa.py_buffer(values)]
+        )
+    return pa.array(values)
+
+
+def arrow_response(names, arrays):
+    """
+    Stream the columns as an Arrow IPC stream, a record batch at a time
+    """
+    table = pa.Table.from_arrays(arrays, names=names)
+
+    def generate():
+        sink = StreamSink()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=ARROW_BATCH_ROWS):
+                writer.write_batch(batch)
+                yield sink.drain()
+        yield sink.drain()
+
+    return Response(generate(), mimetype=ARROW_STREAM_MIMETYPE)
+
+
+@blueprint.route("/schema")
+@authenticated
+def schema():
+    adata = _dataset()
+    return jsonify(
+        {
+            "n_obs": adata.n_obs,
+            "n_vars": adata.n_vars,
+            "obs": {column: str(dtype) for column, dtype in adata.obs.dtypes.items()},
+            "var": {column: str(dtype) for column, dtype in adata.var.dtypes.items()},
+            "obsm": {key: list(adata.obsm[key].shape) for key in adata.obsm.keys()},
+            "raw": adata.raw is not None,
+        }
+    )
+
+
+@blueprint.route("/<any(obs, var):table>")
+@authenticated
+def frame(table):
+    adata = _dataset()
+    frame = getattr(adata, table)
+    columns = _list_arg("columns") or list(frame.columns)
+    missing = [column for column in columns if column not in frame.columns]
+    if missing:
+        abort(400, f"Unknown columns: {', '.join(missing)}")
+    rows = _rows(len(frame))
+    names, arrays = [], []
+    if _index_arg():
+        names.append(f"{table}_names")
+        arrays.append(pa.array(np.asarray(frame.index[rows].astype(str))))
+    for column in columns:
+        names.append(column)
+        arrays.append(to_arrow(frame[column].iloc[rows]))
+    return arrow_response(names, arrays)
+
+
+@blueprint.route("/obsm/<key>")
+@authenticated
+def obsm(key):
+    adata = _dataset()
+    if key not in adata.obsm.keys():
+        abort(404, f"Unknown obsm key {key}")
+    embedding = np.asarray(adata.obsm[key])
+    components = _list_arg("components")
+    try:
+        components = (
+            [int(component) for component in components]
+            if components
+            else list(range(embedding.shape[1]))
+        )
+    except ValueError:
+        abort(400, "components must be integers")
+    if any(not 0 <= component < embedding.shape[1] for component in components):
+        abort(400, f"{key} has {embedding.shape[1]} components")
+    rows = _rows(embedding.shape[0])
+    # column major so every component is a contiguous buffer
+    block = np.asfortranarray(embedding[rows][:, components])
+    names = [f"{key}_{component + 1}" for component in components]
+    arrays = [to_arrow(block[:, i]) for i in range(len(components))]
+    if _index_arg():
+        names.insert(0, "obs_names")
+        arrays.insert(0, pa.array(np.asarray(adata.obs_names[rows].astype(str))))
+    return arrow_response(names, arrays)
+
+
+@blueprint.route("/genes")
+@authenticated
+def genes():
+    adata = _dataset()
+    requested = _list_arg("genes")
+    if not requested:
+        abort(400, "Pass the genes to read, e.g. ?genes=CD3E,MS4A1")
+    raw = request.args.get("raw")
+    use_raw = None if raw is None else raw.lower() in ["true", "1", "yes"]
+    if use_raw and adata.raw is None:
+        abort(400, "The dataset has no raw matrix")
+    rows = _rows(adata.n_obs)
+    found, block = gene_matrix.gene_block(adata, requested, use_raw=use_raw, rows=rows)
+    missing = [gene for gene in requested if gene not in found]
+    if missing:
+        abort(404, f"Unknown genes: {', '.join(missing)}")
+    block = np.asfortranarray(block)
+    names = list(found)
+    arrays = [to_arrow(block[:, i]) for i in range(len(found))]
+    if _index_arg():
+        names.insert(0, "obs_names")
+        arrays.insert(0, pa.array(np.asarray(adata.obs_names[rows].astype(str))))
+    return arrow_response(names, arrays)
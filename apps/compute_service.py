@@ -0,0 +1,193 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import anndata
+
+from apps import embedding_store, pipeline
+from apps.dataset_registry import get_dataset_info, set_dataset_info, registry
+from apps.logger import logger
+
+COMPUTE_WORKERS = int(os.environ.get("COMPUTE_WORKERS", 2))
+
+READY = "ready"
+COMPUTING = "computing"
+ERROR = "error"
+
+"""
+Embeddings are computed in worker processes so Dash callbacks never hold the GIL
+or a gunicorn worker while scanpy runs.
+
+Workers read the dataset from its local (disk cached) file, store the result in the
+embedding store and return it, the result is then put on the loaded AnnData.
+"""
+
+
+def _compute(local_path, dataset_hash, source, basis, params):
+    # runs in a worker process
+    adata = anndata.read_h5ad(local_path, backed="r")
+    set_dataset_info(
+        adata, source=source, local_path=local_path, dataset_hash=dataset_hash
+    )
+    pipeline.run(adata, basis, params=params)
+    keys = pipeline.applied(adata)
+    return keys, {
+        name: embedding_store.extract(adata, pipeline.STAGES[name].outputs)
+        for name in keys.keys()
+    }
+
+
+class ComputeService(object):
+    def __init__(self, max_workers=COMPUTE_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._inflight = {}
+        self._errors = {}
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawned, a forked child could inherit locks held by the load
+                # threads, the s3fs event loop or h5py and hang
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def _reset_executor(self, executor):
+        """
+        Drop a pool broken by a killed worker (OOM), the next submit starts a new one
+        """
+        with self._lock:
+            if self._executor is executor:
+                logger.warning("Compute pool is broken, starting a new one")
+                self._executor = None
+        executor.shutdown(wait=False)
+
+    def _job_key(self, adata, basis, params=None):
+        info = get_dataset_info(adata)
+        return (
+            info.get("dataset_hash") or id(adata),
+            basis,
+            embedding_store.params_hash(params),
+        )
+
+    def _computed(self, adata, basis, params=None):
+        if params:
+            # non default parameters always go through the pipeline cache
+            return False
+        return pipeline.STAGES[basis].computed(adata)
+
+    def submit(self, adata, basis, params=None):
+        """
+        Compute basis for adata, identical jobs that are in flight are shared.
+        Returns a future that resolves once the embedding is on adata.
+
+        :param params: per stage parameter overrides passed to pipeline.run
+        """
+        if self._computed(adata, basis, params):
+            future = Future()
+            future.set_result(adata)
+            return future
+
+        key = self._job_key(adata, basis, params)
+        with self._lock:
+            future = self._inflight.get(key)
+            if future:
+                return future
+            future = Future()
+            self._inflight[key] = future
+            self._errors.pop(key, None)
+
+        info = get_dataset_info(adata)
+        if not info.get("local_path"):
+            # in memory datasets, like the scanpy example dataset, are small
+            threading.Thread(
+                target=self._run_inline,
+                args=(key, adata, basis, params, future),
+                daemon=True,
+            ).start()
+            return future
+
+        logger.info(f"Submitting {basis} for {info.get('key')}")
+        executor = self.executor
+        try:
+            worker_future = executor.submit(
+                _compute,
+                info["local_path"],
+                info["dataset_hash"],
+                info.get("source"),
+                basis,
+                params,
+            )
+        except Exception as e:
+            if isinstance(e, BrokenProcessPool):
+                self._reset_executor(executor)
+            self._finish(key, future, error=e)
+            return future
+        worker_future.add_done_callback(
+            lambda f: self._publish(key, adata, basis, f, future, executor)
+        )
+        return future
+
+    def _run_inline(self, key, adata, basis, params, future):
+        try:
+            pipeline.run(adata, basis, params=params)
+            self._finish(key, future, result=adata)
+        except Exception as e:
+            self._finish(key, future, error=e)
+
+    def _publish(self, key, adata, basis, worker_future, future, executor):
+        try:
+            keys, results = worker_future.result()
+            for arrays in results.values():
+                embedding_store.apply(adata, arrays, overwrite=True)
+            adata.uns[pipeline.PIPELINE_UNS_KEY] = dict(pipeline.applied(adata), **keys)
+            dataset_key = get_dataset_info(adata).get("key")
+            if dataset_key:
+                registry.refresh(dataset_key)
+            logger.info(f"Published {basis} for {dataset_key}")
+            self._finish(key, future, result=adata)
+        except BrokenProcessPool as e:
+            self._reset_executor(executor)
+            self._finish(key, future, error=e)
+        except Exception as e:
+            self._finish(key, future, error=e)
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if error is not None:
+                logger.exception(error)
+                self._errors[key] = str(error)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def status(self, adata, basis, params=None):
+        if self._computed(adata, basis, params):
+            return READY
+        key = self._job_key(adata, basis, params)
+        with self._lock:
+            if key in self._inflight:
+                return COMPUTING
+            if key in self._errors:
+                return ERROR
+        return None
+
+    def error(self, adata, basis, params=None):
+        """
+        The error of the last failed job for basis. It is reported once, after
+        that status() is None again and the basis can be submitted anew.
+        """
+        with self._lock:
+            return self._errors.pop(self._job_key(adata, basis, params), None)
+
+
+service = ComputeService()
@@ -97,3 +97,43 @@ layout_no_dataset = dbc.Container(
     fluid=True,
     className="dbc",
 )
+
+
+def _format_bytes(nbytes):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if nbytes < 1024:
+            return f"{nbytes:.1f} {unit}"
+        nbytes = nbytes / 1024
+    return f"{nbytes:.1f} TB"
+
+
+def load_progress(job):
+    """
+    Render the state of a background dataset load
+    :param job: dict from LoadJob.to_dict()
+    :return:
+    """
+    if job["stage"] == "error":
+        # the failed job is dropped once reported, reloading the page starts a new load
+        return dbc.Alert(
+            [
+                f"Unable to load dataset: {job['error']} ",
+                html.A("Retry", href="", className="alert-link"),
+            ],
+            color="danger",
+        )
+    stages = ["queued", "downloading", "parsing", "embedding", "done"]
+    value = int(100 * stages.index(job["stage"]) / (len(stages) - 1))
+    details = f"{job['stage'].capitalize()} {job['key']} ({int(job['elapsed'])}s)"
+    if job["stage"] == "downloading" and job["bytes_total"]:
+        value = int(25 * job["bytes_downloaded"] / job["bytes_total"])
+        details = (
+            f"{details} {_format_bytes(job['bytes_downloaded'])}"
+            f" of {_format_bytes(job['bytes_total'])}"
+        )
+    return html.Div(
+        [
+            dbc.Progress(value=max(value, 5), striped=True, animated=True),
+            html.Small(details),
+        ]
+    )
@@ -0,0 +1,338 @@
+import json
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from apps import app, db, h5ad_metadata, s3_utils
+from apps.logger import logger
+from apps.models import DatasetCatalogClaim, DatasetCatalogEntry, DatasetCatalogScan
+
+"""
+Catalog of the h5ad and csv objects of the bucket
+
+The bucket is listed on a background thread, one prefix at a time with a
+delimiter so every prefix is a paginated ListObjectsV2 of its own and sibling
+prefixes are listed concurrently. The listing is compared with the catalog
+table and only the added, changed (etag or size) and removed objects are
+written, so the datasets page renders from the database without touching S3.
+The header metadata of new and changed h5ad files is then read into the catalog.
+"""
+
+S3_BUCKET = os.environ.get("CELLXGENE_BUCKET", False) or os.environ.get("BUCKET")
+CATALOG_REFRESH_SECONDS = int(os.environ.get("CATALOG_REFRESH_SECONDS", 600))
+CATALOG_LIST_WORKERS = int(os.environ.get("CATALOG_LIST_WORKERS", 8))
+# a scan claim is taken over by another worker after this, when its worker died
+CATALOG_SCAN_TIMEOUT = int(os.environ.get("CATALOG_SCAN_TIMEOUT", 3600))
+
+KINDS = {".h5ad": "h5ad", ".csv": "csv"}
+
+_scan_lock = threading.Lock()
+# identifies this worker in the claim table
+_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_start_lock = threading.Lock()
+_wake = threading.Event()
+_started = False
+
+
+def object_kind(path):
+    return KINDS.get(os.path.splitext(path)[1].lower())
+
+
+def _list_prefix(fs, prefix):
+    """
+    :return: (catalog objects directly under prefix, sub prefixes)
+    """
+    objects, prefixes = [], []
+    for info in fs.ls(prefix, detail=True, refresh=True):
+        if info["type"] == "directory":
+            prefixes.append(info["name"])
+        elif object_kind(info["name"]):
+            objects.append(info)
+    return objects, prefixes
+
+
+def list_bucket(bucket, fs=None, workers=CATALOG_LIST_WORKERS):
+    """
+    Every h5ad and csv object of the bucket, listed prefix by prefix on a thread pool
+    """
+    fs = fs or s3_utils.get_filesystem("s3")
+    objects = []
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="catalog-list"
+    ) as executor:
+        pending = {executor.submit(_list_prefix, fs, bucket)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, prefixes = future.result()
+                objects.extend(found)
+                pending.update(
+                    executor.submit(_list_prefix, fs, prefix) for prefix in prefixes
+                )
+    return objects
+
+
+def _apply(objects, now):
+    """
+    Write the difference between the listing and the catalog
+    """
+    entries = {entry.path: entry for entry in db.session.query(DatasetCatalogEntry)}
+    added = updated = 0
+    for info in objects:
+        path = info["name"]
+        etag = (info.get("ETag") or "").strip('"') or None
+        size = info.get("size")
+        entry = entries.pop(path, None)
+        if entry is None:
+            entry = DatasetCatalogEntry(path=path, kind=object_kind(path))
+            db.session.add(entry)
+            added += 1
+        elif entry.etag == etag and entry.size == size:
+            continue
+        else:
+            updated += 1
+        entry.etag = etag
+        entry.size = size
+        entry.last_modified = info.get("LastModified")
+        entry.updated_at = now
+    # what is left was not listed anymore
+    for entry in entries.values():
+        db.session.delete(entry)
+    return added, updated, len(entries)
+
+
+def last_scan():
+    return (
+        db.session.query(DatasetCatalogScan)
+        .order_by(DatasetCatalogScan.started_at.desc())
+        .first()
+    )
+
+
+def _claim():
+    """
+    Claim the scan for this worker, False when another worker holds it
+    """
+    now = datetime.utcnow()
+    if db.session.query(DatasetCatalogClaim).get(1) is None:
+        try:
+            db.session.add(DatasetCatalogClaim(id=1))
+            db.session.commit()
+        except IntegrityError:
+            # created by another worker at the same time
+            db.session.rollback()
+    # a single conditional update, the database lets only one worker through
+    claimed = (
+        db.session.query(DatasetCatalogClaim)
+        .filter(DatasetCatalogClaim.id == 1)
+        .filter(
+            (DatasetCatalogClaim.claimed_until.is_(None))
+            | (DatasetCatalogClaim.claimed_until < now)
+        )
+        .update(
+            {
+                "owner": _owner,
+                "claimed_until": now + timedelta(seconds=CATALOG_SCAN_TIMEOUT),
+            },
+            synchronize_session=False,
+        )
+    )
+    db.session.commit()
+    return claimed == 1
+
+
+def _release():
+    db.session.query(DatasetCatalogClaim).filter_by(id=1, owner=_owner).update(
+        {"claimed_until": None}, synchronize_session=False
+    )
+    db.session.commit()
+
+
+def refresh(force=False):
+    """
+    Scan the bucket into the catalog, then read the headers of the new and
+    changed h5ad files. Unless forced, nothing is done when any worker started
+    a scan within CATALOG_REFRESH_SECONDS.
+    """
+    if not S3_BUCKET:
+        return None
+    if not _scan_lock.acquire(blocking=False):
+        # this worker is already scanning
+        return None
+    try:
+        with app.app_context():
+            if not _claim():
+                # another worker is scanning
+                return None
+            try:
+                scan = _refresh(force)
+                if scan is not None and not scan.error:
+                    read_headers()
+                return scan
+            finally:
+                _release()
+    finally:
+        _scan_lock.release()
+
+
+def _refresh(force):
+    now = datetime.utcnow()
+    previous = last_scan()
+    if (
+        not force
+        and previous is not None
+        and now - previous.started_at < timedelta(seconds=CATALOG_REFRESH_SECONDS)
+    ):
+        return None
+    scan = DatasetCatalogScan(started_at=now)
+    db.session.add(scan)
+    db.session.commit()
+    try:
+        objects = list_bucket(S3_BUCKET)
+        scan.added, scan.updated, scan.removed = _apply(objects, now)
+        scan.objects = len(objects)
+    except Exception as e:
+        logger.exception(f"Unable to scan s3://{S3_BUCKET}")
+        db.session.rollback()
+        scan.error = str(e)[:1024]
+    # the page lists the datasets from here, their headers come in after
+    scan.finished_at = datetime.utcnow()
+    db.session.commit()
+    logger.info(
+        f"Dataset catalog scan: {scan.objects} objects, {scan.added} added, "
+        f"{scan.updated} updated, {scan.removed} removed"
+    )
+    return scan
+
+
+def _read_header(path):
+    try:
+        return h5ad_metadata.read_metadata(f"s3://{path}"), None
+    except Exception as e:
+        logger.warning(f"Unable to read the header of s3://{path}: {e}")
+        return None, str(e)[:1024]
+
+
+def _store_header(entry, etag, metadata, error=None):
+    entry.header_etag = etag
+    entry.header_error = error
+    entry.header = json.dumps(metadata) if metadata else None
+    entry.n_obs = metadata["n_obs"] if metadata else None
+    entry.n_vars = metadata["n_vars"] if metadata else None
+    entry.x_nbytes = metadata["X"]["nbytes"] if metadata and metadata["X"] else None
+
+
+def read_headers(workers=CATALOG_LIST_WORKERS):
+    """
+    Read the header metadata of the h5ad entries that are new or changed since
+    their header was read, committing as the headers come in
+    """
+    stale = (
+        db.session.query(DatasetCatalogEntry)
+        .filter_by(kind="h5ad")
+        .filter(
+            (DatasetCatalogEntry.header_etag.is_(None))
+            | (DatasetCatalogEntry.header_etag != DatasetCatalogEntry.etag)
+        )
+        .all()
+    )
+    if not stale:
+        return
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="catalog-header"
+    ) as executor:
+        futures = {
+            executor.submit(_read_header, entry.path): (entry, entry.etag)
+            for entry in stale
+        }
+        for future in as_completed(futures):
+            entry, etag = futures[future]
+            metadata, error = future.result()
+            _store_header(entry, etag, metadata, error)
+            db.session.commit()
+
+
+def dataset_metadata(url):
+    """
+    Header metadata of the h5ad at url, from the catalog when it is current
+    and read from the file otherwise. None when it can not be read.
+    """
+    path = url.split("://", 1)[-1]
+    entry = db.session.query(DatasetCatalogEntry).filter_by(path=path).first()
+    if entry is not None and entry.header_etag == entry.etag and entry.header:
+        return entry.metadata
+    try:
+        metadata = h5ad_metadata.read_metadata(url)
+    except Exception as e:
+        logger.warning(f"Unable to read the header of {url}: {e}")
+        return None
+    if entry is not None:
+        _store_header(entry, entry.etag, metadata)
+        db.session.commit()
+    return metadata
+
+
+def _run():
+    while True:
+        force = _wake.is_set()
+        _wake.clear()
+        try:
+            refresh(force=force)
+        except Exception:
+            logger.exception("Dataset catalog refresh failed")
+        _wake.wait(CATALOG_REFRESH_SECONDS)
+
+
+def start():
+    """
+    Start the refresh thread of this worker, the first call wins
+    """
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+    threading.Thread(target=_run, name="dataset-catalog", daemon=True).start()
+
+
+def rescan():
+    """
+    Scan the bucket now instead of waiting for the next refresh
+    """
+    _wake.set()
+    start()
+
+
+def entries(kind):
+    return (
+        db.session.query(DatasetCatalogEntry)
+        .filter_by(kind=kind)
+        .order_by(DatasetCatalogEntry.path)
+        .all()
+    )
+
+
+def status():
+    scan = last_scan()
+    status = {"bucket": S3_BUCKET, "scanning": False, "last_scan": None}
+    if scan is not None:
+        # listing, in any worker, unless the worker died without finishing
+        age = datetime.utcnow() - scan.started_at
+        status["scanning"] = scan.finished_at is None and age < timedelta(
+            seconds=CATALOG_SCAN_TIMEOUT
+        )
+        status["last_scan"] = {
+            "started_at": scan.started_at.isoformat(),
+            "finished_at": scan.finished_at.isoformat() if scan.finished_at else None,
+            "objects": scan.objects,
+            "added": scan.added,
+            "updated": scan.updated,
+            "removed": scan.removed,
+            "error": scan.error,
+        }
+    return status
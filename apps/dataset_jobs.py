@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from apps.logger import logger
+
+DATASET_LOAD_WORKERS = int(os.environ.get("DATASET_LOAD_WORKERS", 2))
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+PARSING = "parsing"
+EMBEDDING = "embedding"
+DONE = "done"
+ERROR = "error"
+
+STAGES = [QUEUED, DOWNLOADING, PARSING, EMBEDDING, DONE]
+
+
+class LoadJob(object):
+    """
+    State of a background dataset load, polled by the dash apps
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.stage = QUEUED
+        self.bytes_downloaded = 0
+        self.bytes_total = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def update(self, stage=None, **kwargs):
+        with self._lock:
+            if stage:
+                logger.info(f"Load job {self.key}: {stage}")
+                self.stage = stage
+            for key, value in kwargs.items():
+                setattr(self, key, value)
+
+    def add_bytes(self, nbytes):
+        with self._lock:
+            self.bytes_downloaded += nbytes
+
+    @property
+    def done(self):
+        return self.stage == DONE
+
+    @property
+    def failed(self):
+        return self.stage == ERROR
+
+    @property
+    def finished(self):
+        return self.stage in (DONE, ERROR)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "key": self.key,
+                "stage": self.stage,
+                "bytes_downloaded": self.bytes_downloaded,
+                "bytes_total": self.bytes_total,
+                "error": self.error,
+                "elapsed": (self.finished_at or time.time()) - self.created_at,
+            }
+
+
+class JobManager(object):
+    """
+    Runs dataset loads on a thread pool so the gunicorn worker is not blocked.
+    Jobs are keyed by adata_path and only one job per key is in flight.
+    """
+
+    def __init__(self, max_workers=DATASET_LOAD_WORKERS):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="dataset-load"
+        )
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def submit(self, key, fn, force=False):
+        """
+        Start fn(job) in the background unless a job for key is running
+        or has already succeeded. A failed job is returned once so its error
+        can be shown, then dropped so the next submit starts a new load.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job and job.failed:
+                del self._jobs[key]
+                if not force:
+                    return job
+            elif job and (not force or not job.finished):
+                return job
+            job = LoadJob(key)
+            self._jobs[key] = job
+        self.executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        try:
+            fn(job)
+            job.update(stage=DONE, finished_at=time.time())
+        except Exception as e:
+            logger.exception(e)
+            job.update(stage=ERROR, error=str(e), finished_at=time.time())
+
+
+jobs = JobManager()
@@ -0,0 +1,272 @@
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from apps.logger import logger
+
+
+def _default_max_bytes():
+    # default to half of the physical memory of the pod
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 2)
+    except (ValueError, OSError, AttributeError):
+        return 8 * 1024 ** 3
+
+
+DATASET_CACHE_MAX_BYTES = int(
+    os.environ.get("DATASET_CACHE_MAX_BYTES", False) or _default_max_bytes()
+)
+
+
+def _array_nbytes(array):
+    if array is None:
+        return 0
+    if sparse.issparse(array):
+        return sum(
+            getattr(array, attr).nbytes
+            for attr in ("data", "indices", "indptr")
+            if hasattr(array, attr)
+        )
+    if isinstance(array, np.ndarray):
+        return array.nbytes
+    # backed h5py datasets and anything else we can not measure cheaply
+    return 0
+
+
+def _frame_nbytes(df):
+    if df is None:
+        return 0
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+_sizers = []
+
+
+def register_sizer(sizer):
+    """
+    Count memory held for a dataset outside of the AnnData object,
+    sizer(adata) returns the bytes
+    """
+    _sizers.append(sizer)
+
+
+def estimate_adata_nbytes(adata):
+    """
+    Estimate the resident memory of an AnnData object
+    """
+    nbytes = sum(sizer(adata) for sizer in _sizers)
+    if not getattr(adata, "isbacked", False):
+        nbytes += _array_nbytes(adata.X)
+    nbytes += _frame_nbytes(adata.obs)
+    nbytes += _frame_nbytes(adata.var)
+    for key in adata.obsm.keys():
+        nbytes += _array_nbytes(adata.obsm[key])
+    for key in adata.varm.keys():
+        nbytes += _array_nbytes(adata.varm[key])
+    for key in adata.layers.keys():
+        nbytes += _array_nbytes(adata.layers[key])
+    for key in adata.obsp.keys():
+        nbytes += _array_nbytes(adata.obsp[key])
+    if adata.raw is not None:
+        nbytes += _array_nbytes(adata.raw.X)
+        nbytes += _frame_nbytes(adata.raw.var)
+    return nbytes
+
+
+def estimate_adaptor_nbytes(adaptor):
+    data = getattr(adaptor, "data", None)
+    if data is None:
+        return 0
+    return estimate_adata_nbytes(data)
+
+
+_dataset_info = {}
+
+
+def set_dataset_info(adata, **info):
+    """
+    Remember where a loaded AnnData came from, e.g. its registry key and content hash
+    """
+    if id(adata) not in _dataset_info:
+        weakref.finalize(adata, _dataset_info.pop, id(adata), None)
+    _dataset_info[id(adata)] = info
+
+
+def get_dataset_info(adata):
+    return _dataset_info.get(id(adata), {})
+
+
+_dataset_info_lock = threading.Lock()
+
+
+def update_dataset_info(adata, **info):
+    """
+    Add to what is remembered about adata, set_dataset_info replaces it
+    """
+    with _dataset_info_lock:
+        set_dataset_info(adata, **dict(get_dataset_info(adata), **info))
+
+
+class DatasetEntry(object):
+    def __init__(self, key, value, nbytes):
+        self.key = key
+        self.value = value
+        self.nbytes = nbytes
+        self.pins = 0
+        self.loaded_at = time.time()
+        self.last_access = self.loaded_at
+
+    @property
+    def pinned(self):
+        return self.pins > 0
+
+
+class DatasetRegistry(object):
+    """
+    Process wide LRU cache of data adaptors bounded by resident memory
+    instead of by number of entries.
+
+    Pinned entries are never evicted.
+    """
+
+    def __init__(self, max_bytes=DATASET_CACHE_MAX_BYTES, sizer=estimate_adaptor_nbytes):
+        self.max_bytes = max_bytes
+        self.sizer = sizer
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key, loader):
+        """
+        Return the cached value for key, calling loader() on a miss.
+        Concurrent misses on the same key only load once.
+        """
+        entry = self._hit(key)
+        if entry:
+            return entry.value
+
+        with self._lock:
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            entry = self._hit(key)
+            if entry:
+                return entry.value
+            logger.info(f"Dataset registry miss: {key}")
+            value = loader()
+            nbytes = self.sizer(value)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = DatasetEntry(key, value, nbytes)
+                self._loading.pop(key, None)
+                logger.info(f"Dataset registry loaded {key} ({nbytes} bytes)")
+                self._evict(keep=key)
+            return value
+
+    def peek(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.value if entry else None
+
+    def _hit(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                self.hits += 1
+                entry.last_access = time.time()
+                self._entries.move_to_end(key)
+            return entry
+
+    def pin(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                raise KeyError(key)
+            entry.pins += 1
+
+    def unpin(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return
+            entry.pins = max(entry.pins - 1, 0)
+            self._evict()
+
+    def refresh(self, key):
+        """
+        Re-measure an entry after it was modified in place,
+        for example after adding an embedding to obsm.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return
+            entry.nbytes = self.sizer(entry.value)
+            self._evict(keep=key)
+
+    def discard(self, key):
+        with self._lock:
+            return self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @property
+    def total_bytes(self):
+        with self._lock:
+            return sum(entry.nbytes for entry in self._entries.values())
+
+    def _evict(self, keep=None):
+        total = self.total_bytes
+        if total <= self.max_bytes:
+            return
+        for key in list(self._entries.keys()):
+            if total <= self.max_bytes:
+                break
+            entry = self._entries[key]
+            if entry.pinned or key == keep:
+                continue
+            logger.info(f"Dataset registry evicting {key} ({entry.nbytes} bytes)")
+            del self._entries[key]
+            total -= entry.nbytes
+            self.evictions += 1
+        if total > self.max_bytes:
+            logger.warning(
+                f"Dataset registry is over budget: {total} > {self.max_bytes} bytes"
+            )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "total_bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": [
+                    {
+                        "key": entry.key,
+                        "nbytes": entry.nbytes,
+                        "pins": entry.pins,
+                        "loaded_at": entry.loaded_at,
+                        "last_access": entry.last_access,
+                    }
+                    for entry in self._entries.values()
+                ],
+            }
+
+
+registry = DatasetRegistry()
@@ -0,0 +1,249 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from functools import lru_cache
+
+import fsspec
+
+from apps import s3_utils
+from apps.logger import logger
+
+DISK_CACHE_DIR = os.environ.get(
+    "DATASET_DISK_CACHE_DIR", os.path.abspath("dataset_cache")
+)
+DISK_CACHE_MAX_BYTES = int(
+    os.environ.get("DATASET_DISK_CACHE_MAX_BYTES", False) or 100 * 1024 ** 3
+)
+# downloads started over when the remote object is replaced during one
+DISK_CACHE_FETCH_ATTEMPTS = int(os.environ.get("DATASET_DISK_CACHE_FETCH_ATTEMPTS", 3))
+
+"""
+Local disk cache for remote datasets
+
+Files are stored as <root>/<sha256(url)>/<sha256(etag, size)><suffix>
+so a changed remote object gets a new file and the old version is dropped.
+"""
+
+
+def _sha256(value):
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def fingerprint(info):
+    """
+    Version of a remote object from its HEAD response
+    """
+    etag = info.get("ETag") or info.get("etag")
+    if not etag:
+        etag = str(info.get("LastModified") or info.get("mtime") or "")
+    return etag.strip('"'), int(info.get("size") or 0)
+
+
+@lru_cache(maxsize=128)
+def _file_hash(path, size, mtime, chunk_size=8 * 1024 * 1024):
+    digest = hashlib.sha256(str(size).encode("utf-8"))
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_hash(path):
+    """
+    Content hash of a local file. Copies in the disk cache are identified by
+    the ETag and size of the remote object, other files are hashed in full once.
+    """
+    try:
+        with open(f"{path}.json") as fh:
+            meta = json.load(fh)
+        return _sha256(f"{meta['etag']}:{meta['size']}")
+    except (OSError, ValueError, KeyError):
+        pass
+    stat = os.stat(path)
+    return _file_hash(os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+
+class DiskCache(object):
+    def __init__(self, root=DISK_CACHE_DIR, max_bytes=DISK_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # local paths being downloaded and their size, guarded by _lock
+        self._downloading = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def entry_dir(self, url):
+        return os.path.join(self.root, _sha256(url))
+
+    def entry_path(self, url, etag, size):
+        suffix = os.path.splitext(url)[1]
+        return os.path.join(self.entry_dir(url), _sha256(f"{etag}:{size}") + suffix)
+
+    def fetch(self, url, fs=None, progress=None):
+        """
+        Return a local path for url, downloading it when the cached copy
+        is missing or stale. The remote object is revalidated with a HEAD.
+
+        :param fs: filesystem to read url from, inferred from the url if not given
+        :param progress: called with the number of bytes of each downloaded chunk
+        """
+        if fs is None:
+            fs, path = fsspec.core.url_to_fs(url)
+        else:
+            path = fs._strip_protocol(url)
+
+        for attempt in range(DISK_CACHE_FETCH_ATTEMPTS):
+            try:
+                return self._fetch(fs, path, url, progress)
+            except s3_utils.ObjectChangedError as e:
+                if attempt == DISK_CACHE_FETCH_ATTEMPTS - 1:
+                    raise
+                # start over from a HEAD of the new version
+                logger.warning(f"{e}, fetching it again")
+
+    def _fetch(self, fs, path, url, progress=None):
+        try:
+            fs.invalidate_cache(path)
+            info = fs.info(path)
+            etag, size = fingerprint(info)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            # the remote is unreachable, serve the last version we have
+            cached = self._latest(url)
+            if cached:
+                logger.warning(f"Unable to revalidate {url}, using {cached}: {e}")
+                return cached
+            raise
+
+        local_path = self.entry_path(url, etag, size)
+        with self._key_lock(local_path):
+            # checked under the cache lock so the file is not evicted in between
+            with self._lock:
+                if os.path.exists(local_path) and os.path.getsize(local_path) == size:
+                    self.hits += 1
+                    # mtime is the LRU clock
+                    os.utime(local_path)
+                    logger.info(f"Disk cache hit: {url} -> {local_path}")
+                    return local_path
+                self.misses += 1
+                self._downloading[local_path] = size
+
+            logger.info(f"Disk cache miss: {url}")
+            try:
+                # the download is counted from here, concurrent misses make room for all
+                self.evict()
+                self._download(fs, path, local_path, url, info, progress)
+            finally:
+                with self._lock:
+                    self._downloading.pop(local_path, None)
+            self._remove_stale(url, keep=local_path)
+        return local_path
+
+    def _download(self, fs, path, local_path, url, info, progress=None):
+        # s3_utils.download writes to a temporary file and renames it into place
+        # so readers never see a partial file. Every part is read from the
+        # version described by info.
+        etag, size = fingerprint(info)
+        s3_utils.download(url, local_path, fs=fs, progress=progress, info=info)
+        if os.path.getsize(local_path) != size:
+            self._remove(local_path)
+            raise s3_utils.ObjectChangedError(f"{url} changed during download")
+        with open(f"{local_path}.json", "w") as fh:
+            json.dump({"url": url, "etag": etag, "size": size, "time": time.time()}, fh)
+
+    def _files(self):
+        if not os.path.isdir(self.root):
+            return []
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith(".json") or filename.endswith(".part"):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filepath)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, filepath))
+        return files
+
+    def _latest(self, url):
+        entry_dir = self.entry_dir(url)
+        files = [f for f in self._files() if f[2].startswith(entry_dir + os.sep)]
+        if not files:
+            return None
+        return max(files)[2]
+
+    def _remove(self, filepath):
+        for path in (filepath, f"{filepath}.json"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_stale(self, url, keep):
+        entry_dir = self.entry_dir(url)
+        with self._lock:
+            for _, _, filepath in self._files():
+                if not filepath.startswith(entry_dir + os.sep) or filepath == keep:
+                    continue
+                if filepath in self._downloading:
+                    continue
+                logger.info(f"Disk cache removing stale {filepath}")
+                self._remove(filepath)
+
+    def evict(self, needed=0):
+        """
+        Remove least recently used files until needed more bytes fit in the quota.
+        Downloads in flight are kept and their size is counted as used.
+        """
+        with self._lock:
+            files = sorted(f for f in self._files() if f[2] not in self._downloading)
+            total = sum(size for _, size, _ in files) + sum(self._downloading.values())
+            for _, size, filepath in files:
+                if total + needed <= self.max_bytes:
+                    break
+                logger.info(f"Disk cache evicting {filepath} ({size} bytes)")
+                self._remove(filepath)
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            files = self._files()
+            return {
+                "root": self.root,
+                "max_bytes": self.max_bytes,
+                "total_bytes": sum(size for _, size, _ in files),
+                "files": len(files),
+                "downloading": len(self._downloading),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+cache = DiskCache()
+
+
+def is_remote(url):
+    return "://" in url and not url.startswith("file://")
+
+
+def open_local(url, progress=None):
+    """
+    Local path to read url from, going through the disk cache for remote urls
+    """
+    if not is_remote(url):
+        return url
+    return cache.fetch(url, progress=progress)
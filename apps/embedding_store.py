@@ -0,0 +1,204 @@
+import hashlib
+import io
+import json
+import os
+import uuid
+
+import fsspec
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_categorical_dtype
+from scipy import sparse
+
+from apps.logger import logger
+
+EMBEDDING_STORE_DIR = os.environ.get(
+    "EMBEDDING_STORE_DIR", os.path.abspath("embedding_store")
+)
+# also write computed embeddings next to the source dataset, e.g. s3://bucket/data.h5ad.embeddings/
+EMBEDDING_STORE_WRITE_BACK = os.environ.get(
+    "EMBEDDING_STORE_WRITE_BACK", "False"
+).lower() in ["true", "1", "yes"]
+
+"""
+Sidecar store for computed embeddings
+
+Entries are npz files at <root>/<dataset content hash>/<name>-<params hash>.npz
+holding the obs, var, obsm, varm, obsp, layers and uns items that a computation produced.
+What a computation produces is described by an outputs dict, e.g.
+{"obsm": ["X_pca"], "varm": ["PCs"], "uns": ["pca"]}
+"""
+
+SEP = "__"
+
+def params_hash(params=None):
+    params = params or {}
+    return hashlib.sha256(
+        json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()[:16]
+
+
+def _to_json(value):
+    if isinstance(value, dict):
+        return {k: _to_json(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def extract(adata, outputs):
+    """
+    Collect the results of a computation from adata as a flat dict of arrays
+    """
+    arrays = {}
+    for attr in ("obs", "var"):
+        frame = getattr(adata, attr)
+        for key in outputs.get(attr, []):
+            if key not in frame.columns:
+                continue
+            values = frame[key]
+            if is_categorical_dtype(values):
+                prefix = SEP.join([attr, key, "cat"])
+                arrays[f"{prefix}{SEP}codes"] = np.asarray(values.cat.codes)
+                arrays[f"{prefix}{SEP}categories"] = np.asarray(
+                    values.cat.categories.astype(str)
+                )
+            else:
+                arrays[SEP.join([attr, key])] = np.asarray(values)
+    for attr in ("obsm", "varm", "obsp", "layers"):
+        mapping = getattr(adata, attr)
+        for key in outputs.get(attr, []):
+            if key not in mapping.keys():
+                continue
+            value = mapping[key]
+            if sparse.issparse(value):
+                value = value.tocsr()
+                prefix = SEP.join([attr, key, "csr"])
+                arrays[f"{prefix}{SEP}data"] = value.data
+                arrays[f"{prefix}{SEP}indices"] = value.indices
+                arrays[f"{prefix}{SEP}indptr"] = value.indptr
+                arrays[f"{prefix}{SEP}shape"] = np.array(value.shape)
+            else:
+                arrays[SEP.join([attr, key])] = np.asarray(value)
+    uns = {k: _to_json(adata.uns[k]) for k in outputs.get("uns", []) if k in adata.uns}
+    arrays["uns"] = np.array(json.dumps(uns))
+    return arrays
+
+
+def apply(adata, arrays, overwrite=False):
+    """
+    Put stored results back on adata
+    """
+    grouped = {}
+    for name, value in arrays.items():
+        parts = name.split(SEP)
+        if name == "uns":
+            for key, item in json.loads(str(value)).items():
+                if overwrite or key not in adata.uns:
+                    adata.uns[key] = item
+        elif len(parts) == 4:
+            grouped.setdefault((parts[0], parts[1], parts[2]), {})[parts[3]] = value
+        else:
+            attr, key = parts
+            mapping = getattr(adata, attr)
+            if overwrite or key not in mapping.keys():
+                mapping[key] = value
+    for (attr, key, kind), items in grouped.items():
+        mapping = getattr(adata, attr)
+        if not overwrite and key in mapping.keys():
+            continue
+        if kind == "csr":
+            mapping[key] = sparse.csr_matrix(
+                (items["data"], items["indices"], items["indptr"]),
+                shape=tuple(items["shape"]),
+            )
+        elif kind == "cat":
+            mapping[key] = pd.Categorical.from_codes(
+                items["codes"], categories=list(items["categories"])
+            )
+
+
+def computed(adata, outputs):
+    """
+    True when the array outputs of a computation are present on adata
+    """
+    for attr in ("obs", "var"):
+        if not all(key in getattr(adata, attr).columns for key in outputs.get(attr, [])):
+            return False
+    for attr in ("obsm", "varm", "obsp", "layers"):
+        if not all(key in getattr(adata, attr).keys() for key in outputs.get(attr, [])):
+            return False
+    return True
+
+
+def _local_path(dataset_hash, name, params):
+    return os.path.join(
+        EMBEDDING_STORE_DIR, dataset_hash, f"{name}-{params_hash(params)}.npz"
+    )
+
+
+def _sidecar_url(source, name, params):
+    return f"{source}.embeddings/{name}-{params_hash(params)}.npz"
+
+
+def _write_npz(fh, arrays):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    fh.write(buffer.getvalue())
+
+
+def _read_npz(fh):
+    with np.load(io.BytesIO(fh.read()), allow_pickle=False) as npz:
+        return {key: npz[key] for key in npz.files}
+
+
+def save(dataset_hash, name, arrays, params=None, source=None):
+    path = _local_path(dataset_hash, name, params)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    with open(tmp_path, "wb") as fh:
+        _write_npz(fh, arrays)
+    os.replace(tmp_path, path)
+    logger.info(f"Stored {name} for {dataset_hash} at {path}")
+
+    if EMBEDDING_STORE_WRITE_BACK and source:
+        url = _sidecar_url(source, name, params)
+        try:
+            with fsspec.open(url, "wb") as fh:
+                _write_npz(fh, arrays)
+            logger.info(f"Wrote {name} back to {url}")
+        except Exception as e:
+            logger.warning(f"Unable to write {name} back to {url}: {e}")
+
+
+def exists(dataset_hash, name, params=None):
+    return os.path.exists(_local_path(dataset_hash, name, params))
+
+
+def load(dataset_hash, name, params=None, source=None):
+    """
+    Stored results for a computation or None,
+    falling back to the sidecar next to the source dataset
+    """
+    path = _local_path(dataset_hash, name, params)
+    if os.path.exists(path):
+        with open(path, "rb") as fh:
+            return _read_npz(fh)
+    if source:
+        url = _sidecar_url(source, name, params)
+        try:
+            with fsspec.open(url, "rb") as fh:
+                arrays = _read_npz(fh)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Unable to read {url}: {e}")
+            return None
+        # keep a local copy so the next open does not go to the source
+        save(dataset_hash, name, arrays, params=params)
+        return arrays
+    return None
@@ -0,0 +1,419 @@
+import fnmatch
+import os
+import threading
+import time
+import uuid
+import weakref
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from apps import embedding_store
+from apps.dataset_registry import get_dataset_info, register_sizer, registry
+from apps.logger import logger
+
+"""
+Batched access to gene columns of the expression matrix
+
+Gene names are resolved to column indices through a name -> index map that is
+built once per dataset, and all requested genes are read with a single column
+slice of the matrix instead of one obs_vector call per gene.
+
+Datasets store X cell-major (CSR), so reading a gene touches every row. Datasets
+can opt in to a gene-major (CSC) companion of X and raw.X that gene lookups use
+once it is built. It roughly doubles the memory of the matrix, its size is counted
+by the dataset registry and reported in the registry stats.
+"""
+
+# off, on-demand (built by the first gene lookup) or background (built after loading)
+GENE_MAJOR_COPY = os.environ.get("GENE_MAJOR_COPY", "off").lower()
+# comma separated patterns of the datasets that get a companion, empty for all
+GENE_MAJOR_DATASETS = [
+    pattern.strip()
+    for pattern in os.environ.get("GENE_MAJOR_DATASETS", "").split(",")
+    if pattern.strip()
+]
+# keep built companions next to the stored embeddings
+GENE_MAJOR_PERSIST = os.environ.get("GENE_MAJOR_PERSIST", "False").lower() in [
+    "true",
+    "1",
+    "yes",
+]
+# rows read at a time when building from a backed matrix
+GENE_MAJOR_CHUNK_ROWS = int(os.environ.get("GENE_MAJOR_CHUNK_ROWS", 100000))
+
+_indexes = {}
+_search_indexes = {}
+_companions = {}
+_building = {}
+_lock = threading.Lock()
+
+
+def _var_frame(adata, use_raw):
+    return adata.raw.var if use_raw else adata.var
+
+
+def _build_index(var):
+    index = pd.Series(np.arange(len(var)), index=var.index.astype(str))
+    # datasets loaded by cellxgene keep the gene names in a name_0 column
+    if "name_0" in var.columns:
+        names = pd.Series(np.arange(len(var)), index=var["name_0"].astype(str))
+        index = pd.concat([index, names[~names.index.isin(index.index)]])
+    return index[~index.index.duplicated(keep="first")].to_dict()
+
+
+def gene_index(adata, use_raw=False):
+    """
+    Cached map of gene name to column index of X (or raw.X with use_raw)
+    """
+    key = (id(adata), use_raw)
+    with _lock:
+        index = _indexes.get(key)
+    if index is None:
+        index = _build_index(_var_frame(adata, use_raw))
+        with _lock:
+            _track(adata)
+            _indexes[key] = index
+    return index
+
+
+def _forget(adata_id):
+    with _lock:
+        for cache in (_indexes, _search_indexes, _companions, _building):
+            for key in [k for k in cache if k[0] == adata_id]:
+                cache.pop(key, None)
+
+
+def _track(adata):
+    # called with _lock held, drops the cached state of adata with it
+    caches = (_indexes, _search_indexes, _companions)
+    if not any(key[0] == id(adata) for cache in caches for key in cache):
+        weakref.finalize(adata, _forget, id(adata))
+
+
+class PrefixIndex(object):
+    """
+    Case insensitive prefix search over gene names, two binary searches
+    over the sorted lowercase names per query
+    """
+
+    def __init__(self, names):
+        names = sorted(set(names), key=lambda name: (name.lower(), name))
+        self.names = np.array(names, dtype=object)
+        self.keys = np.array([name.lower() for name in names])
+
+    def __len__(self):
+        return len(self.names)
+
+    def search(self, query, limit=50):
+        query = (query or "").lower()
+        start = np.searchsorted(self.keys, query, side="left")
+        end = np.searchsorted(self.keys, query + "\U0010ffff", side="left")
+        return list(self.names[start : min(end, start + limit)])
+
+
+def search_index(adata, use_raw=None):
+    """
+    Cached prefix index over the gene names that gene_block can read
+    """
+    if use_raw is None:
+        use_raw = adata.raw is not None
+    key = (id(adata), use_raw)
+    with _lock:
+        index = _search_indexes.get(key)
+    if index is None:
+        index = PrefixIndex(gene_index(adata, use_raw).keys())
+        with _lock:
+            _track(adata)
+            _search_indexes[key] = index
+    return index
+
+
+def search_genes(adata, query, limit=50):
+    """
+    Up to limit gene names starting with query, in alphabetical order
+    """
+    return search_index(adata).search(query, limit=limit)
+
+
+def _matrix(adata, use_raw):
+    return adata.raw.X if use_raw else adata.X
+
+
+def _which(use_raw):
+    return "raw.X" if use_raw else "X"
+
+
+def _is_sparse(matrix):
+    # in memory scipy matrices and backed anndata sparse datasets
+    return sparse.issparse(matrix) or hasattr(matrix, "format_str")
+
+
+def enabled(adata):
+    """
+    True when adata opted in to a gene-major companion
+    """
+    if GENE_MAJOR_COPY not in ("on-demand", "background"):
+        return False
+    if not GENE_MAJOR_DATASETS:
+        return True
+    key = get_dataset_info(adata).get("key") or ""
+    return any(fnmatch.fnmatch(key, pattern) for pattern in GENE_MAJOR_DATASETS)
+
+
+def _matrix_nbytes(matrix):
+    return sum(getattr(matrix, attr).nbytes for attr in ("data", "indices", "indptr"))
+
+
+def estimate_companion_nbytes(adata, use_raw=False):
+    """
+    Memory a companion of X (or raw.X) would take, None when X is not sparse
+    """
+    if use_raw and adata.raw is None:
+        return None
+    matrix = _matrix(adata, use_raw)
+    if not _is_sparse(matrix):
+        return None
+    if sparse.issparse(matrix):
+        nnz = matrix.nnz
+        itemsize = matrix.dtype.itemsize
+    else:
+        # backed sparse dataset, read the sizes from the h5 group
+        nnz = matrix.group["data"].shape[0]
+        itemsize = matrix.group["data"].dtype.itemsize
+    n_vars = matrix.shape[1]
+    return int(nnz * (itemsize + 4) + (n_vars + 1) * 8)
+
+
+def _persist_path(adata, use_raw):
+    dataset_hash = get_dataset_info(adata).get("dataset_hash")
+    if not dataset_hash:
+        return None
+    return os.path.join(
+        embedding_store.EMBEDDING_STORE_DIR, dataset_hash, f"{_which(use_raw)}.csc.npz"
+    )
+
+
+def _to_csc(matrix):
+    if sparse.issparse(matrix):
+        return matrix.tocsc()
+    # backed, convert a block of rows at a time so X is never dense in memory
+    chunks = [
+        sparse.csr_matrix(matrix[start : start + GENE_MAJOR_CHUNK_ROWS])
+        for start in range(0, matrix.shape[0], GENE_MAJOR_CHUNK_ROWS)
+    ]
+    return sparse.vstack(chunks, format="csr").tocsc()
+
+
+def build_companion(adata, use_raw=False):
+    """
+    Build (or load the persisted) gene-major copy of X or raw.X and
+    put it in the cache, the dataset registry re-measures the dataset.
+    """
+    key = (id(adata), use_raw)
+    with _lock:
+        if key in _companions:
+            return _companions[key]["matrix"]
+        event = _building.get(key)
+        owner = event is None
+        if owner:
+            event = _building[key] = threading.Event()
+    if not owner:
+        event.wait()
+        with _lock:
+            entry = _companions.get(key)
+        return entry["matrix"] if entry else None
+
+    try:
+        started = time.time()
+        path = _persist_path(adata, use_raw) if GENE_MAJOR_PERSIST else None
+        if path and os.path.exists(path):
+            csc = sparse.load_npz(path).tocsc()
+            source = "disk"
+        else:
+            csc = _to_csc(_matrix(adata, use_raw))
+            source = "built"
+            if path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{uuid.uuid4().hex}.part.npz"
+                sparse.save_npz(tmp_path, csc, compressed=False)
+                os.replace(tmp_path, path)
+        entry = {
+            "matrix": csc,
+            "nbytes": _matrix_nbytes(csc),
+            "source": source,
+            "seconds": time.time() - started,
+        }
+        with _lock:
+            _track(adata)
+            _companions[key] = entry
+        dataset_key = get_dataset_info(adata).get("key")
+        logger.info(
+            f"Gene-major {_which(use_raw)} for {dataset_key} {source} in "
+            f"{entry['seconds']:.1f}s ({entry['nbytes']} bytes)"
+        )
+        if dataset_key:
+            registry.refresh(dataset_key)
+        return csc
+    except Exception as e:
+        logger.exception(e)
+        return None
+    finally:
+        with _lock:
+            _building.pop(key, None)
+        event.set()
+
+
+def build_in_background(adata):
+    """
+    Build the companions of adata on a thread when it opted in to background builds
+    """
+    if GENE_MAJOR_COPY != "background" or not enabled(adata):
+        return
+    for use_raw in (False, True):
+        if estimate_companion_nbytes(adata, use_raw) is None:
+            continue
+        threading.Thread(
+            target=build_companion, args=(adata, use_raw), daemon=True
+        ).start()
+
+
+def companion(adata, use_raw=False):
+    """
+    The gene-major copy of X (or raw.X) when it can be used, None otherwise.
+    On demand companions are built by the first lookup.
+    """
+    with _lock:
+        entry = _companions.get((id(adata), use_raw))
+    if entry:
+        return entry["matrix"]
+    if GENE_MAJOR_COPY == "on-demand" and enabled(adata):
+        if estimate_companion_nbytes(adata, use_raw) is not None:
+            return build_companion(adata, use_raw)
+    return None
+
+
+def companion_nbytes(adata):
+    with _lock:
+        return sum(
+            entry["nbytes"] for key, entry in _companions.items() if key[0] == id(adata)
+        )
+
+
+def companion_stats(adata):
+    """
+    Size of the built companions of adata and what the missing ones would cost
+    """
+    stats = {}
+    for use_raw in (False, True):
+        with _lock:
+            entry = _companions.get((id(adata), use_raw))
+        estimate = estimate_companion_nbytes(adata, use_raw)
+        if entry is None and estimate is None:
+            continue
+        stats[_which(use_raw)] = {
+            "built": entry is not None,
+            "nbytes": entry["nbytes"] if entry else 0,
+            "estimated_nbytes": estimate,
+            "source": entry["source"] if entry else None,
+            "seconds": entry["seconds"] if entry else None,
+        }
+    return {"enabled": enabled(adata), "mode": GENE_MAJOR_COPY, "matrices": stats}
+
+
+def attach(adaptor):
+    """
+    Let cellxgene gene expression requests read from the companion of X
+    """
+    get_X_array = getattr(adaptor, "get_X_array", None)
+    if get_X_array is None:
+        return
+
+    def get_X_array_gene_major(obs_mask=None, var_mask=None):
+        if obs_mask is None and var_mask is not None:
+            csc = companion(adaptor.data)
+            if csc is not None:
+                block = csc[:, var_mask]
+                # same layout the adaptor returns for X
+                return block.tocsr() if _is_sparse(adaptor.data.X) else block.toarray()
+        return get_X_array(obs_mask, var_mask)
+
+    adaptor.get_X_array = get_X_array_gene_major
+
+
+def _in_memory(matrix):
+    return isinstance(matrix, np.ndarray) or sparse.issparse(matrix)
+
+
+def _backed_block(matrix, unique, rows=None):
+    """
+    Columns of a backed matrix read GENE_MAJOR_CHUNK_ROWS rows at a time,
+    slicing the columns of a backed csr X first would read all of X
+    """
+    positions = range(matrix.shape[0])[rows if rows is not None else slice(None)]
+    if not len(positions):
+        return np.empty((0, len(unique)), dtype=np.float32)
+    start, stop = min(positions), max(positions) + 1
+    blocks = []
+    for chunk in range(start, stop, GENE_MAJOR_CHUNK_ROWS):
+        block = matrix[chunk : min(chunk + GENE_MAJOR_CHUNK_ROWS, stop)][:, unique]
+        if sparse.issparse(block):
+            block = block.toarray()
+        blocks.append(np.asarray(block, dtype=np.float32))
+    return np.concatenate(blocks)[np.asarray(positions) - start]
+
+
+def column_block(matrix, columns, rows=None):
+    """
+    Dense float32 block of the given columns of matrix, in the order given.
+    Works for in memory dense and sparse matrices and for backed datasets,
+    which need increasing column indices.
+
+    :param rows: optional slice of the rows to read
+    """
+    columns = np.asarray(columns, dtype=np.int64)
+    unique, inverse = np.unique(columns, return_inverse=True)
+    if not _in_memory(matrix):
+        return _backed_block(matrix, unique, rows)[:, inverse]
+    if rows is None:
+        # one slice for all the columns, on csr this walks the rows once
+        block = matrix[:, unique]
+    elif sparse.isspmatrix_csc(matrix):
+        block = matrix[:, unique][rows]
+    else:
+        block = matrix[rows][:, unique]
+    if sparse.issparse(block):
+        block = block.toarray()
+    block = np.asarray(block, dtype=np.float32)
+    return block[:, inverse]
+
+
+def gene_block(adata, genes, use_raw=None, rows=None):
+    """
+    Expression of genes for every cell as a dense float32 block
+
+    :param use_raw: read raw.X, defaults to True when the dataset has raw
+    :param rows: optional slice of the cells to read
+    :return: (found genes, block of shape n_obs x len(found genes)),
+        genes that are not in the dataset are left out
+    """
+    if use_raw is None:
+        use_raw = adata.raw is not None
+    index = gene_index(adata, use_raw)
+    found = [gene for gene in genes if gene in index]
+    missing = [gene for gene in genes if gene not in index]
+    if missing:
+        logger.warning(f"Genes not found in the dataset: {missing}")
+    if not found:
+        n_obs = len(range(adata.n_obs)[rows]) if rows is not None else adata.n_obs
+        return found, np.empty((n_obs, 0), dtype=np.float32)
+    columns = [index[gene] for gene in found]
+    matrix = companion(adata, use_raw)
+    if matrix is None:
+        matrix = _matrix(adata, use_raw)
+    return found, column_block(matrix, columns, rows=rows)
+
+
+# companions count towards the memory of their dataset
+register_sizer(companion_nbytes)
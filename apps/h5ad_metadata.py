@@ -0,0 +1,156 @@
+import os
+
+import fsspec
+import h5py
+import numpy as np
+
+"""
+Header only metadata of an h5ad file
+
+Only the HDF5 groups and dataset headers that describe the AnnData object are
+touched, remote files are read with ranged requests through an fsspec block
+cache so a multi GB dataset costs a handful of small reads.
+
+    {
+        "n_obs": 2638, "n_vars": 1838,
+        "obs": {"louvain": "category", "n_genes": "int64"},
+        "var": {"highly_variable": "bool"},
+        "obsm": {"X_umap": [2638, 2]},
+        "raw": True, "layers": ["counts"],
+        "X": {"format": "csr", "dtype": "float32", "nnz": 123456, "nbytes": 987648},
+    }
+"""
+
+# size of the ranged reads, HDF5 metadata is small and clustered near the groups
+H5AD_HEADER_BLOCK_SIZE = int(os.environ.get("H5AD_HEADER_BLOCK_SIZE", 256 * 1024))
+
+
+def _attr(node, name, default=None):
+    value = node.attrs.get(name, default)
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, np.ndarray):
+        return [item.decode() if isinstance(item, bytes) else item for item in value]
+    return value
+
+
+def _dtype_name(dtype):
+    if dtype.kind in "SOU":
+        return "object"
+    return str(dtype)
+
+
+def _column_dtype(node, categorical=False):
+    if isinstance(node, h5py.Group):
+        # anndata >= 0.8 writes categoricals and nullable arrays as groups
+        encoding = _attr(node, "encoding-type", "")
+        if encoding == "categorical":
+            return "category"
+        if encoding == "nullable-integer":
+            return "Int64"
+        if encoding == "nullable-boolean":
+            return "boolean"
+        return encoding or "group"
+    if categorical or "categories" in node.attrs:
+        return "category"
+    return _dtype_name(node.dtype)
+
+
+def _frame(node):
+    """
+    :return: ({column: dtype}, rows) of an obs or var frame
+    """
+    if isinstance(node, h5py.Dataset):
+        # anndata < 0.7 stored the frames as structured arrays
+        names = [name for name in node.dtype.names if name != "index"]
+        return {name: _dtype_name(node.dtype[name]) for name in names}, node.shape[0]
+    index = _attr(node, "_index", "_index")
+    # anndata 0.7 keeps the categories of every categorical column in __categories
+    categories = node.get("__categories")
+    order = _attr(node, "column-order", [])
+    if isinstance(order, str):
+        order = [order]
+    columns = {}
+    for name in order:
+        categorical = categories is not None and name in categories
+        columns[name] = _column_dtype(node[name], categorical)
+    rows = node[index].shape[0] if index in node else None
+    return columns, rows
+
+
+def _shape(node):
+    if isinstance(node, h5py.Dataset):
+        return list(node.shape)
+    shape = node.attrs.get("shape", node.attrs.get("h5sparse_shape"))
+    return [int(n) for n in shape] if shape is not None else None
+
+
+def _embeddings(node):
+    if isinstance(node, h5py.Dataset):
+        # structured array with one field per embedding
+        return {
+            name: [node.shape[0]] + list(node.dtype[name].shape)
+            for name in node.dtype.names
+        }
+    return {key: _shape(node[key]) for key in node.keys()}
+
+
+def _matrix(node):
+    """
+    Format, dtype and in memory size of X, from the dataset headers
+    """
+    if isinstance(node, h5py.Dataset):
+        return {
+            "format": "dense",
+            "dtype": str(node.dtype),
+            "nnz": None,
+            "nbytes": int(np.prod(node.shape)) * node.dtype.itemsize,
+        }
+    encoding = _attr(node, "encoding-type") or _attr(node, "h5sparse_format", "")
+    data, indices, indptr = node["data"], node["indices"], node["indptr"]
+    nnz = data.shape[0]
+    return {
+        "format": encoding.replace("_matrix", ""),
+        "dtype": str(data.dtype),
+        "nnz": int(nnz),
+        "nbytes": int(
+            nnz * (data.dtype.itemsize + indices.dtype.itemsize)
+            + indptr.shape[0] * indptr.dtype.itemsize
+        ),
+    }
+
+
+def read_header(f):
+    """
+    Metadata of an open h5py.File holding an AnnData object
+    """
+    obs, n_obs = _frame(f["obs"]) if "obs" in f else ({}, None)
+    var, n_vars = _frame(f["var"]) if "var" in f else ({}, None)
+    matrix = _matrix(f["X"]) if "X" in f else None
+    if matrix is not None:
+        shape = _shape(f["X"])
+        if shape:
+            n_obs, n_vars = shape
+    return {
+        "n_obs": n_obs,
+        "n_vars": n_vars,
+        "obs": obs,
+        "var": var,
+        "obsm": _embeddings(f["obsm"]) if "obsm" in f else {},
+        "raw": "raw" in f or "raw.X" in f,
+        "layers": list(f["layers"].keys()) if "layers" in f else [],
+        "X": matrix,
+    }
+
+
+def read_metadata(url, block_size=H5AD_HEADER_BLOCK_SIZE):
+    """
+    Header metadata of the h5ad at url, local paths are read directly
+    """
+    fs, path = fsspec.core.url_to_fs(url)
+    if "file" in fs.protocol:
+        with h5py.File(path, "r") as f:
+            return read_header(f)
+    with fs.open(path, "rb", block_size=block_size, cache_type="blockcache") as handle:
+        with h5py.File(handle, "r") as f:
+            return read_header(f)
@@ -1,5 +1,7 @@
+import json
+
 from flask_appbuilder import Model
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text, ForeignKey
 from sqlalchemy.orm import relationship
 
 """
@@ -10,3 +12,65 @@ AuditMixin will add automatic timestamp of created and modified by who
 
 
 """
+
+
+class DatasetCatalogEntry(Model):
+    """
+    One h5ad or csv object of the bucket, kept up to date by apps.dataset_catalog
+    """
+
+    __tablename__ = "dataset_catalog"
+
+    id = Column(Integer, primary_key=True)
+    # bucket/key, without the s3:// scheme like s3fs returns it
+    path = Column(String(1024), unique=True, nullable=False, index=True)
+    kind = Column(String(16), nullable=False, index=True)
+    size = Column(BigInteger)
+    etag = Column(String(128))
+    last_modified = Column(DateTime)
+    # when a scan last added or changed the entry
+    updated_at = Column(DateTime)
+    # h5ad header metadata, see apps.h5ad_metadata, for the object with header_etag
+    n_obs = Column(Integer)
+    n_vars = Column(Integer)
+    x_nbytes = Column(BigInteger)
+    header = Column(Text)
+    header_etag = Column(String(128))
+    header_error = Column(String(1024))
+
+    def __repr__(self):
+        return self.path
+
+    @property
+    def metadata(self):
+        return json.loads(self.header) if self.header else None
+
+
+class DatasetCatalogScan(Model):
+    """
+    A listing of the bucket, shared by all the workers through the database
+    """
+
+    __tablename__ = "dataset_catalog_scan"
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime, nullable=False, index=True)
+    finished_at = Column(DateTime)
+    objects = Column(Integer)
+    added = Column(Integer)
+    updated = Column(Integer)
+    removed = Column(Integer)
+    error = Column(String(1024))
+
+
+class DatasetCatalogClaim(Model):
+    """
+    Single row claimed by the worker that scans the bucket, with a conditional
+    update so only one worker scans at a time
+    """
+
+    __tablename__ = "dataset_catalog_claim"
+
+    id = Column(Integer, primary_key=True)
+    owner = Column(String(256))
+    claimed_until = Column(DateTime)
@@ -0,0 +1,485 @@
+import hashlib
+import json
+import os
+import threading
+import weakref
+
+import anndata
+import numpy as np
+import scanpy as sc
+
+from apps import embedding_store
+from apps.dataset_registry import get_dataset_info, registry
+from apps.logger import logger
+
+"""
+Preprocessing pipeline
+
+Each stage declares its inputs, default parameters and what it adds to the AnnData.
+A stage output is cached under the hash of its parameters and the cache keys of its
+inputs, so changing a UMAP parameter reuses the stored PCA and neighbors graph.
+
+The cache key of each stage applied to a dataset is recorded in adata.uns["pipeline"].
+"""
+
+PIPELINE_UNS_KEY = "pipeline"
+# above this many cells the fast t-SNE is fit on a subsample and the rest is projected
+TSNE_FAST_MAX_CELLS = int(os.environ.get("TSNE_FAST_MAX_CELLS", 100000))
+TSNE_N_JOBS = int(os.environ.get("TSNE_N_JOBS", os.cpu_count() or 1))
+# number of cells the landmark UMAP is fit on
+UMAP_LANDMARKS = int(os.environ.get("UMAP_LANDMARKS", 50000))
+# obs columns tried, in order, to stratify the landmarks when none is given
+STRATIFY_COLUMNS = ("leiden", "louvain", "cell_type", "celltype", "cluster")
+# stages restored when a dataset is opened, their dependencies are loaded as needed
+RESTORE_STAGES = ("pca", "umap", "tsne", "tsne_fast", "umap_landmark")
+
+
+class Stage(object):
+    def __init__(self, name, func, inputs=(), outputs=None, params=None):
+        self.name = name
+        self.func = func
+        self._inputs = inputs
+        self.outputs = outputs or {}
+        self.params = params or {}
+
+    def resolve_params(self, params=None):
+        resolved = dict(self.params)
+        resolved.update(params or {})
+        return resolved
+
+    def inputs(self, params):
+        if callable(self._inputs):
+            return list(self._inputs(params))
+        return list(self._inputs)
+
+    def computed(self, adata):
+        return embedding_store.computed(adata, self.outputs)
+
+
+STAGES = {}
+
+
+def stage(name, inputs=(), outputs=None, **params):
+    def decorator(func):
+        STAGES[name] = Stage(name, func, inputs=inputs, outputs=outputs, params=params)
+        return func
+
+    return decorator
+
+
+@stage("normalize", outputs={"layers": ["normalized"]}, target_sum=1e4)
+def normalize(adata, target_sum):
+    normalized = sc.pp.normalize_total(adata, target_sum=target_sum, inplace=False)["X"]
+    adata.layers["normalized"] = sc.pp.log1p(normalized, copy=True)
+
+
+@stage(
+    "hvg",
+    inputs=("normalize",),
+    outputs={"var": ["highly_variable"]},
+    n_top_genes=2000,
+)
+def hvg(adata, n_top_genes):
+    result = sc.pp.highly_variable_genes(
+        adata, layer="normalized", n_top_genes=n_top_genes, inplace=False
+    )
+    adata.var["highly_variable"] = np.asarray(result["highly_variable"])
+
+
+@stage(
+    "pca",
+    inputs=lambda params: ("hvg",) if params["use_highly_variable"] else (),
+    outputs={"obsm": ["X_pca"], "varm": ["PCs"], "uns": ["pca"]},
+    n_comps=50,
+    use_highly_variable=False,
+)
+def pca(adata, n_comps, use_highly_variable):
+    n_comps = min(n_comps, adata.n_obs - 1, adata.n_vars - 1)
+    sc.pp.pca(adata, n_comps=n_comps, use_highly_variable=use_highly_variable)
+
+
+@stage(
+    "neighbors",
+    inputs=("pca",),
+    outputs={"obsp": ["distances", "connectivities"], "uns": ["neighbors"]},
+    n_neighbors=15,
+    n_pcs=None,
+)
+def neighbors(adata, n_neighbors, n_pcs):
+    sc.pp.neighbors(adata, n_neighbors=n_neighbors, n_pcs=n_pcs, use_rep="X_pca")
+
+
+@stage(
+    "umap",
+    inputs=("neighbors",),
+    outputs={"obsm": ["X_umap"], "uns": ["umap"]},
+    min_dist=0.5,
+    spread=1.0,
+)
+def umap(adata, min_dist, spread):
+    sc.tl.umap(adata, min_dist=min_dist, spread=spread)
+
+
+@stage(
+    "tsne",
+    inputs=("pca",),
+    outputs={"obsm": ["X_tsne"], "uns": ["tsne"]},
+    perplexity=30,
+    n_pcs=None,
+)
+def tsne(adata, perplexity, n_pcs):
+    sc.tl.tsne(adata, perplexity=perplexity, n_pcs=n_pcs, use_rep="X_pca")
+
+
+@stage(
+    "tsne_fast",
+    inputs=("pca",),
+    outputs={"obsm": ["X_tsne_fast"], "uns": ["tsne_fast"]},
+    perplexity=30,
+    n_pcs=50,
+    max_cells=TSNE_FAST_MAX_CELLS,
+    random_state=0,
+)
+def tsne_fast(adata, perplexity, n_pcs, max_cells, random_state):
+    """
+    FFT accelerated t-SNE from openTSNE, initialised from the PCA.
+    Stored under its own obsm key so it can live next to the scanpy t-SNE.
+    """
+    try:
+        import openTSNE
+    except ImportError:
+        raise ImportError("The fast t-SNE needs openTSNE, pip install openTSNE")
+
+    X = np.asarray(adata.obsm["X_pca"][:, :n_pcs], dtype=np.float64)
+    n_obs = X.shape[0]
+    fit_idx = np.arange(n_obs)
+    if n_obs > max_cells:
+        rng = np.random.default_rng(random_state)
+        fit_idx = np.sort(rng.choice(n_obs, size=max_cells, replace=False))
+    logger.info(f"Fast t-SNE on {len(fit_idx)} of {n_obs} cells")
+
+    embedding = openTSNE.TSNE(
+        perplexity=perplexity,
+        initialization=openTSNE.initialization.rescale(X[fit_idx, :2]),
+        negative_gradient_method="fft",
+        n_jobs=TSNE_N_JOBS,
+        random_state=random_state,
+    ).fit(X[fit_idx])
+
+    result = np.empty((n_obs, 2), dtype=np.float32)
+    result[fit_idx] = embedding
+    if len(fit_idx) < n_obs:
+        rest = np.setdiff1d(np.arange(n_obs), fit_idx, assume_unique=True)
+        result[rest] = embedding.transform(X[rest])
+    adata.obsm["X_tsne_fast"] = result
+    adata.uns["tsne_fast"] = {
+        "params": {
+            "perplexity": perplexity,
+            "n_pcs": n_pcs,
+            "n_fit": int(len(fit_idx)),
+        }
+    }
+
+
+def stratified_sample(n_obs, size, labels=None, random_state=0, min_per_group=50):
+    """
+    Indices of a sample of size cells with every group of labels represented,
+    proportionally to its size but with at least min_per_group cells (or all of them).
+    """
+    rng = np.random.default_rng(random_state)
+    if size >= n_obs:
+        return np.arange(n_obs)
+    if labels is None:
+        return np.sort(rng.choice(n_obs, size=size, replace=False))
+    _, codes = np.unique(np.asarray(labels).astype(str), return_inverse=True)
+    counts = np.bincount(codes)
+    quotas = np.maximum(
+        np.round(counts * size / n_obs), np.minimum(counts, min_per_group)
+    ).astype(int)
+    order = np.argsort(codes, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sample = [
+        rng.choice(order[start : start + count], size=quota, replace=False)
+        for start, count, quota in zip(starts, counts, quotas)
+    ]
+    return np.sort(np.concatenate(sample))
+
+
+def interpolate(landmarks, landmark_embedding, X, k=10, chunk_size=50000):
+    """
+    Place cells at the inverse distance weighted mean of their k nearest landmarks
+    """
+    from sklearn.neighbors import NearestNeighbors
+
+    nn = NearestNeighbors(n_neighbors=min(k, len(landmarks))).fit(landmarks)
+    result = np.empty((X.shape[0], landmark_embedding.shape[1]), dtype=np.float32)
+    for start in range(0, X.shape[0], chunk_size):
+        distances, indices = nn.kneighbors(X[start : start + chunk_size])
+        weights = 1.0 / (distances + 1e-6)
+        weights /= weights.sum(axis=1, keepdims=True)
+        result[start : start + chunk_size] = np.einsum(
+            "ij,ijk->ik", weights, landmark_embedding[indices]
+        )
+    return result
+
+
+@stage(
+    "umap_landmark",
+    inputs=("pca",),
+    outputs={"obsm": ["X_umap_landmark"], "uns": ["umap_landmark"]},
+    n_landmarks=UMAP_LANDMARKS,
+    stratify=None,
+    n_pcs=50,
+    n_neighbors=15,
+    min_dist=0.5,
+    k=10,
+    random_state=0,
+)
+def umap_landmark(
+    adata, n_landmarks, stratify, n_pcs, n_neighbors, min_dist, k, random_state
+):
+    """
+    UMAP fit on a stratified landmark subsample, the other cells are placed
+    by nearest landmark interpolation in PCA space.
+    """
+    import umap as umap_learn
+
+    if stratify is None:
+        stratify = next((c for c in STRATIFY_COLUMNS if c in adata.obs.columns), None)
+    labels = adata.obs[stratify].values if stratify else None
+
+    X = np.asarray(adata.obsm["X_pca"][:, :n_pcs], dtype=np.float32)
+    n_obs = X.shape[0]
+    landmark_idx = stratified_sample(
+        n_obs, n_landmarks, labels=labels, random_state=random_state
+    )
+    logger.info(
+        f"Landmark UMAP on {len(landmark_idx)} of {n_obs} cells stratified by {stratify}"
+    )
+    landmark_embedding = umap_learn.UMAP(
+        n_neighbors=n_neighbors, min_dist=min_dist, random_state=random_state
+    ).fit_transform(X[landmark_idx])
+
+    result = np.empty((n_obs, 2), dtype=np.float32)
+    result[landmark_idx] = landmark_embedding
+    if len(landmark_idx) < n_obs:
+        rest = np.setdiff1d(np.arange(n_obs), landmark_idx, assume_unique=True)
+        result[rest] = interpolate(
+            X[landmark_idx], landmark_embedding, X[rest], k=k
+        )
+    adata.obsm["X_umap_landmark"] = result
+    adata.uns["umap_landmark"] = {
+        "params": {
+            "stratify": stratify or "",
+            "n_landmarks": int(len(landmark_idx)),
+            "n_neighbors": n_neighbors,
+            "min_dist": min_dist,
+        }
+    }
+
+
+@stage(
+    "leiden",
+    inputs=("neighbors",),
+    outputs={"obs": ["leiden"], "uns": ["leiden"]},
+    resolution=1.0,
+)
+def leiden(adata, resolution):
+    sc.tl.leiden(adata, resolution=resolution, key_added="leiden")
+
+
+def in_memory(adata):
+    """
+    AnnData with X in memory, backed datasets are read into a copy
+    """
+    if not getattr(adata, "isbacked", False):
+        return adata
+    logger.info("Reading X of a backed dataset into memory")
+    if hasattr(adata, "to_memory"):
+        return adata.to_memory()
+    return anndata.AnnData(
+        X=adata.X[:],
+        obs=adata.obs.copy(),
+        var=adata.var.copy(),
+        obsm=dict(adata.obsm),
+        varm=dict(adata.varm),
+        uns=dict(adata.uns),
+    )
+
+
+def cache_key(dataset_hash, name, params, input_keys=()):
+    value = json.dumps(
+        [dataset_hash, name, params, list(input_keys)], sort_keys=True, default=str
+    )
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+
+def applied(adata):
+    """
+    Cache keys of the stages applied to adata
+    """
+    return dict(adata.uns.get(PIPELINE_UNS_KEY, {}))
+
+
+class Run(object):
+    """
+    One pipeline run over a dataset. Scanpy needs X in memory so backed datasets
+    are read into a copy, once per run and only if a stage has to be computed.
+    A readonly run only checks the stages already on the dataset, ensure returns
+    None when one of them would have to be loaded or computed.
+    """
+
+    def __init__(self, adata, params=None, readonly=False):
+        self.adata = adata
+        self.params = params or {}
+        self.readonly = readonly
+        # a stage output was loaded or computed onto the dataset
+        self.changed = False
+        info = get_dataset_info(adata)
+        self.dataset_hash = info.get("dataset_hash")
+        self.source = info.get("source")
+        self._compute_adata = None
+
+    @property
+    def compute_adata(self):
+        if self._compute_adata is None:
+            self._compute_adata = in_memory(self.adata)
+        return self._compute_adata
+
+    def _apply(self, arrays):
+        embedding_store.apply(self.adata, arrays, overwrite=True)
+        if self._compute_adata is not None and self._compute_adata is not self.adata:
+            embedding_store.apply(self._compute_adata, arrays, overwrite=True)
+
+    def _record(self, name, key):
+        keys = applied(self.adata)
+        keys[name] = key
+        self.adata.uns[PIPELINE_UNS_KEY] = keys
+
+    def ensure(self, name):
+        """
+        Make sure the output of a stage is on the dataset, returns its cache key
+        """
+        stage = STAGES[name]
+        params = stage.resolve_params(self.params.get(name))
+        keys = applied(self.adata)
+
+        # results shipped with the dataset are used as is for the default parameters
+        if name not in keys and params == stage.params and stage.computed(self.adata):
+            return cache_key(self.dataset_hash, name, {"source": "dataset"})
+
+        input_keys = [self.ensure(input_name) for input_name in stage.inputs(params)]
+        if None in input_keys:
+            return None
+        key = cache_key(self.dataset_hash, name, params, input_keys)
+        if keys.get(name) == key and stage.computed(self.adata):
+            return key
+        if self.readonly:
+            return None
+
+        store_params = {"key": key}
+        arrays = None
+        if self.dataset_hash:
+            arrays = embedding_store.load(self.dataset_hash, name, params=store_params)
+        if arrays is not None:
+            logger.info(f"Pipeline {name}: loaded {key}")
+        else:
+            logger.info(f"Pipeline {name}: computing {key} with {params}")
+            stage.func(self.compute_adata, **params)
+            arrays = embedding_store.extract(self.compute_adata, stage.outputs)
+            if self.dataset_hash:
+                embedding_store.save(
+                    self.dataset_hash,
+                    name,
+                    arrays,
+                    params=store_params,
+                    source=self.source,
+                )
+        self._apply(arrays)
+        self._record(name, key)
+        self.changed = True
+        return key
+
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _forget_lock(adata_id):
+    with _locks_lock:
+        _locks.pop(adata_id, None)
+
+
+def dataset_lock(adata):
+    """
+    Lock serializing the pipeline runs that change one dataset
+    """
+    with _locks_lock:
+        lock = _locks.get(id(adata))
+        if lock is None:
+            lock = _locks[id(adata)] = threading.Lock()
+            weakref.finalize(adata, _forget_lock, id(adata))
+    return lock
+
+
+def run(adata, name, params=None):
+    """
+    Run stage name and everything it depends on, reusing cached stage outputs.
+
+    :param params: per stage parameter overrides, e.g. {"umap": {"min_dist": 0.1}}
+    :return: the cache key of the stage
+    """
+    # plots call this on every read, they only need a lock when a stage is missing
+    key = Run(adata, params, readonly=True).ensure(name)
+    if key is not None:
+        return key
+    with dataset_lock(adata):
+        pipeline_run = Run(adata, params)
+        key = pipeline_run.ensure(name)
+    dataset_key = get_dataset_info(adata).get("key")
+    if dataset_key and pipeline_run.changed:
+        registry.refresh(dataset_key)
+    return key
+
+
+def restore(adata, names=None):
+    """
+    Load stored default parameter stage outputs onto a freshly opened dataset
+    without computing anything. Returns the names that were restored.
+    """
+    info = get_dataset_info(adata)
+    if not info.get("dataset_hash"):
+        return []
+    source = info.get("source") if embedding_store.EMBEDDING_STORE_WRITE_BACK else None
+    restored = []
+    keys = {}
+
+    def resolve(name):
+        # cache keys for the default parameters, None if a dependency is missing
+        if name in keys:
+            return keys[name]
+        stage = STAGES[name]
+        if name not in applied(adata) and stage.computed(adata):
+            keys[name] = cache_key(info["dataset_hash"], name, {"source": "dataset"})
+            return keys[name]
+        input_keys = [resolve(input_name) for input_name in stage.inputs(stage.params)]
+        keys[name] = None
+        if None in input_keys:
+            return None
+        key = cache_key(info["dataset_hash"], name, stage.params, input_keys)
+        arrays = embedding_store.load(
+            info["dataset_hash"], name, params={"key": key}, source=source
+        )
+        if arrays is None:
+            return None
+        embedding_store.apply(adata, arrays, overwrite=True)
+        adata.uns[PIPELINE_UNS_KEY] = dict(applied(adata), **{name: key})
+        restored.append(name)
+        keys[name] = key
+        return key
+
+    for name in names or RESTORE_STAGES:
+        resolve(name)
+    if restored:
+        logger.info(f"Restored {restored} for {info.get('key')}")
+    return restored
@@ -1,14 +1,176 @@
 import copy
 import os
 import shutil
-import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from functools import lru_cache
 
+import fsspec
+import fsspec.asyn
+
+from apps.logger import logger
+
 S3_BUCKET = os.environ.get("CELLXGENE_BUCKET", False) or os.environ.get('BUCKET', False)
 
 ANNOTATION_DIR = os.environ.get("ANNOTATION_DIR", os.path.abspath("annotations"))
 ANNOTATION_DIR = os.path.join(ANNOTATION_DIR, S3_BUCKET)
 
+DOWNLOAD_PART_SIZE = int(os.environ.get("S3_DOWNLOAD_PART_SIZE", 16 * 1024 * 1024))
+DOWNLOAD_CONCURRENCY = int(os.environ.get("S3_DOWNLOAD_CONCURRENCY", 8))
+
+
+@lru_cache(maxsize=None)
+def get_filesystem(protocol="s3"):
+    # one client per protocol, its connection pool is shared by all downloads
+    return fsspec.filesystem(protocol)
+
+
+class ObjectChangedError(IOError):
+    """
+    The remote object was replaced while it was being downloaded
+    """
+
+
+def _etag(info):
+    return (info.get("ETag") or info.get("etag") or "").strip('"') or None
+
+
+def _version(info):
+    modified = info.get("LastModified") or info.get("mtime") or info.get("created")
+    return _etag(info) or str(modified or ""), info.get("size")
+
+
+def _part_reader(fs, path, info):
+    """
+    (read(start, end), pinned) for one version of the object. On S3 every
+    ranged GET is pinned to the VersionId of info, or made conditional on its
+    ETag when the bucket is not versioned, so parts of a replaced object are
+    never mixed. Other filesystems are checked once the parts are read.
+    """
+    version_id = info.get("VersionId")
+    etag = _etag(info)
+    if not hasattr(fs, "_call_s3") or not (version_id or etag):
+        return lambda start, end: fs.cat_file(path, start=start, end=end), False
+    bucket, key = fs.split_path(path)[:2]
+    pin = {"VersionId": version_id} if version_id else {"IfMatch": f'"{etag}"'}
+
+    async def get(start, end):
+        response = await fs._call_s3(
+            "get_object",
+            Bucket=bucket,
+            Key=key,
+            Range=f"bytes={start}-{end - 1}",
+            **pin,
+        )
+        try:
+            return await response["Body"].read()
+        finally:
+            response["Body"].close()
+
+    return lambda start, end: fsspec.asyn.sync(fs.loop, get, start, end), True
+
+
+def _changed(fs, path, info):
+    try:
+        fs.invalidate_cache(path)
+        current = fs.info(path)
+    except FileNotFoundError:
+        return True
+    except Exception:
+        return False
+    return _version(current) != _version(info)
+
+
+def download(
+    url,
+    out,
+    fs=None,
+    progress=None,
+    part_size=DOWNLOAD_PART_SIZE,
+    concurrency=DOWNLOAD_CONCURRENCY,
+    info=None,
+):
+    """
+    Download url to out with concurrent ranged GETs.
+    Parts are written in place to a temporary file that is renamed to out when complete.
+
+    :param fs: filesystem to read url from, a pooled client for the url protocol if not given
+    :param progress: called with the number of bytes of each downloaded part
+    :param info: fs.info of the object to download, every part is read from
+        this version of it. Raises ObjectChangedError when it was replaced.
+    :return: dict with the size, elapsed seconds and throughput in bytes per second
+    """
+    if fs is None:
+        protocol = url.split("://")[0] if "://" in url else "file"
+        fs = get_filesystem(protocol)
+    path = fs._strip_protocol(url)
+    info = info or fs.info(path)
+    size = info["size"]
+    read, pinned = _part_reader(fs, path, info)
+    start_time = time.time()
+
+    out_dir = os.path.dirname(os.path.abspath(out))
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_path = f"{out}.{uuid.uuid4().hex}.part"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    written = [0]
+    lock = threading.Lock()
+
+    def fetch(start):
+        end = min(start + part_size, size)
+        data = read(start, end)
+        if len(data) != end - start:
+            raise IOError(f"Short read of {url} at {start}-{end}")
+        os.pwrite(fd, data, start)
+        with lock:
+            written[0] += len(data)
+        if progress:
+            progress(len(data))
+
+    try:
+        os.ftruncate(fd, size)
+        starts = list(range(0, size, part_size))
+        try:
+            if len(starts) <= 1 or concurrency <= 1:
+                for start in starts:
+                    fetch(start)
+            else:
+                with ThreadPoolExecutor(
+                    max_workers=min(concurrency, len(starts)),
+                    thread_name_prefix="s3-download",
+                ) as executor:
+                    # list() re-raises the first failed part
+                    list(executor.map(fetch, starts))
+        except Exception as e:
+            # a failed precondition, or the pinned version is gone
+            if _changed(fs, path, info):
+                raise ObjectChangedError(f"{url} changed during download") from e
+            raise
+        if not pinned and _changed(fs, path, info):
+            raise ObjectChangedError(f"{url} changed during download")
+        os.fsync(fd)
+        os.close(fd)
+        fd = None
+        if written[0] != size:
+            raise IOError(f"Incomplete download of {url}: {written[0]} of {size} bytes")
+        os.replace(tmp_path, out)
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    throughput = size / elapsed
+    logger.info(
+        f"Downloaded {url} ({size} bytes) in {elapsed:.1f}s "
+        f"at {throughput / 1024 ** 2:.1f} MB/s"
+    )
+    return {"size": size, "seconds": elapsed, "throughput": throughput}
+
+
 @lru_cache(maxsize=10, typed=False)
 def sync_dataset_down(dataset):
     t_dataset = copy.deepcopy(dataset)
@@ -26,7 +188,5 @@ def sync_dataset_down(dataset):
     print(f"Up: {up}")
     print(f"Out: {out}")
 
-    command = f"aws s3 cp s3://{S3_BUCKET}/{t_dataset} {out}"
-    print(f"Running command: {command}")
-    subprocess.run(command, shell=True, capture_output=True, check=True)
+    download(up, out)
     return out, t_dataset
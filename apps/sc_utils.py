@@ -11,10 +11,13 @@ from server.data_common.matrix_loader import MatrixDataType, MatrixDataLoader
 
 from server.common.compute import diffexp_generic
 from server.data_common.matrix_loader import MatrixDataLoader
+from apps import compute_service, dataset_jobs, disk_cache, pipeline
+from apps.cellxgene import config as cellxgene_config
+from apps.scanpy import table_query
 from apps.cellxgene.config import (
     set_default_config,
+    set_active_adaptor,
     update_datapath,
-    load_matrix_no_cache,
 )
 
 from functools import lru_cache
@@ -22,6 +25,7 @@ import pandas as pd
 import numpy as np
 import os
 
+import fsspec
 from pprint import pprint
 import server.common.rest as common_rest
 from server.common.errors import DatasetAccessError, RequestException
@@ -71,25 +75,81 @@ def load_adaptor():
         logger.info('Completed loading matrix')
         logger.info(adaptor)
         dataset = adaptor.data
-        app_config = current_app.app_config
-        current_app.data_adaptor = adaptor
-        app_config.server_config.data_adaptor = adaptor
+        set_active_adaptor(current_app, adata_path, adaptor)
     else:
         logger.info('Session data not found')
         adata_found = False
         adaptor = None
         adata_path = "scanpy pbmc68k_reduced"
-        dataset = sc.datasets.pbmc68k_reduced()
+        dataset = example_dataset()
     return adata_found, adata_path, adaptor, dataset
 
 
-@lru_cache(maxsize=10, typed=False)
-def load_matrix(adata_path):
-    logger.info(f'Loading matrix {adata_path}')
-    app_config = current_app.app_config
-    matrix_data_loader = MatrixDataLoader(adata_path, app_config=app_config)
-    data_adaptor = matrix_data_loader.open(app_config)
-    return data_adaptor
+@lru_cache(maxsize=1)
+def example_dataset():
+    # shared so embeddings computed for it are kept between callbacks
+    return sc.datasets.pbmc68k_reduced()
+
+
+def start_load(adata_path=None, csv_path=None, backed=None):
+    """
+    Load the session dataset on a background thread.
+    Returns the LoadJob to poll or None when there is no session dataset.
+    """
+    adata_path = adata_path or session.get("adata_path")
+    csv_path = csv_path or session.get("csv")
+    if not adata_path:
+        return None
+    app = current_app._get_current_object()
+
+    def run(job):
+        with app.app_context():
+            load_dataset(adata_path, csv_path, job=job, backed=backed)
+
+    # a finished load may have been evicted from the registry since
+    job = dataset_jobs.jobs.get(adata_path)
+    force = bool(job and job.done and adata_path not in cellxgene_config.registry)
+    return dataset_jobs.jobs.submit(adata_path, run, force=force)
+
+
+def load_dataset(
+    adata_path,
+    csv_path=None,
+    job=None,
+    plot_type="pca",
+    backed=None,
+):
+    """
+    Download, parse and prepare the default embedding for a dataset,
+    reporting each stage to the job.
+    In backed mode only obs/var/obsm are read and X stays on disk, by default
+    the mode is chosen by cellxgene_config.choose_backed.
+    Only the disk cache and the dataset registry are warmed, the active dataset
+    of the app is switched by load_adaptor on the request that serves it.
+    """
+    if job:
+        job.update(stage=dataset_jobs.DOWNLOADING)
+        try:
+            fs, path = fsspec.core.url_to_fs(adata_path)
+            job.update(bytes_total=fs.size(path))
+        except Exception as e:
+            logger.warning(f"Unable to get the size of {adata_path}: {e}")
+        # warm the disk cache so the matrix loader reads a local file
+        disk_cache.open_local(adata_path, progress=job.add_bytes)
+    if job:
+        job.update(stage=dataset_jobs.PARSING)
+    adaptor = load_matrix(adata_path, backed)
+    # column summaries for the DataFrames view
+    table_query.summarize_dataset(adaptor.data)
+    if job:
+        job.update(stage=dataset_jobs.EMBEDDING)
+    compute_service.service.submit(adaptor.data, plot_type).result()
+    return adaptor
+
+
+def load_matrix(adata_path, backed=None):
+    # shares the process wide dataset registry with cellxgene
+    return cellxgene_config.load_matrix(current_app.app_config, adata_path, backed)
 
 
 def get_genes_as_df(adata):
@@ -107,21 +167,14 @@ def get_genes_as_df(adata):
     return df
 
 
-def check_for_plot_type(adata, plot_type):
+def check_for_plot_type(adata, plot_type, params=None):
+    """
+    Make sure the embedding for plot_type is on adata, computing it and the
+    stages it depends on (pca, neighbors) through the cached pipeline.
+    """
     logger.info("In check_for_plot_type")
     logger.info(f"Plot type: {plot_type}")
 
-    if plot_type == "pca" and "X_pca" not in list(adata.obsm.keys()):
-        logger.info("Running PCA")
-        sc.pp.pca(adata)
-        load_matrix_no_cache()
-    elif plot_type == "umap" and "X_umap" not in list(adata.obsm.keys()):
-        logger.info("Running UMAP")
-        sc.tl.umap(adata)
-        load_matrix_no_cache()
-    elif plot_type == "tsne" and "X_tsne" not in list(adata.obsm.keys()):
-        logger.info("Running tsne")
-        sc.tl.tsne(adata)
-        load_matrix_no_cache()
-    else:
+    if plot_type not in pipeline.STAGES:
         return
+    pipeline.run(adata, plot_type, params=params)
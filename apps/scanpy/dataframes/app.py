@@ -7,7 +7,7 @@ import dash
 from dash import dash_table as dt
 import dash_bootstrap_components as dbc
 from dash import Dash, html, dcc
-from dash.dependencies import Input, Output
+from dash.dependencies import Input, Output, State
 from dash.exceptions import PreventUpdate
 import plotly.express as px
 import fsspec
@@ -31,8 +31,8 @@ from functools import lru_cache
 # app imports
 from flask import url_for, session, current_app
 from apps.dash.dash_func import apply_layout_with_auth, load_object, save_object
-from apps.scanpy import scatterplot_utils
-from apps.dash.utils import fig_to_uri, navbar
+from apps.scanpy import scatterplot_utils, table_query
+from apps.dash.utils import fig_to_uri, navbar, load_progress
 from apps import sc_utils, s3_utils
 from apps.logger import logger
 
@@ -53,56 +53,69 @@ title = "Scanpy Data Frames"
 
 header = html.H4(title, className="p-2 mb-2 text-center")
 
+def table_section(table, title):
+    """
+    Column summary of a table, its rows are only fetched once shown
+    """
+    table_id = f"{table}_df"
+    return dbc.Row(
+        [
+            dbc.Col(
+                [
+                    html.H3(title),
+                    html.H5("Column summary"),
+                    dt.DataTable(
+                        id=f"{table}_summary",
+                        columns=[
+                            {"name": name, "id": name, "type": column_type}
+                            for name, column_type in table_query.SUMMARY_COLUMNS
+                        ],
+                        page_size=20,
+                        page_action="native",
+                        sort_action="native",
+                        style_cell={"textAlign": "left"},
+                    ),
+                    dbc.Button(
+                        "Show rows",
+                        id=f"{table_id}_show",
+                        color="secondary",
+                        size="sm",
+                        className="my-2",
+                    ),
+                    dbc.Collapse(
+                        [
+                            html.Div(id=f"{table_id}_export", className="mb-2"),
+                            dt.DataTable(
+                                id=table_id,
+                                columns=[],
+                                page_current=0,
+                                page_size=20,
+                                # paged, sorted and filtered on the server
+                                page_action="custom",
+                                sort_action="custom",
+                                sort_mode="multi",
+                                sort_by=[],
+                                filter_action="custom",
+                                filter_query="",
+                                row_deletable=False,
+                                editable=False
+                            ),
+                            html.Div(id=f"{table_id}_count"),
+                        ],
+                        id=f"{table_id}_collapse",
+                        is_open=False,
+                    ),
+                ]
+            )
+        ],
+        id=f"{table}-table",
+    )
+
+
 dataframes = html.Div(
     [
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        html.H3("Variable Table"),
-                        # dbc.Table.from_dataframe(var_df, striped=True, bordered=True, hover=True),
-                        dt.DataTable(
-                            id="var_df",
-                            columns=[],
-                            page_current=0,
-                            page_size=20,
-                            export_format="xlsx",
-                            export_headers="display",
-                            page_action="native",
-                            sort_action='native',
-                            filter_action='native',
-                            row_deletable=False,
-                            editable=False
-                        ),
-                    ]
-                )
-            ],
-            id="var-table",
-        ),
-        dbc.Row(
-            [
-                dbc.Col(
-                    [
-                        html.H3("Observations Table"),
-                        dt.DataTable(
-                            id="obs_df",
-                            # columns=[{"name": i, "id": i} for i in obs_df.columns],
-                            columns=[],
-                            # page_current=0,
-                            page_size=20,
-                            export_format="xlsx",
-                            export_headers="display",
-                            page_action="native",
-                            sort_action='native',
-                            filter_action='native',
-                            row_deletable=False,
-                            editable=False
-                        ),
-                    ]
-                )
-            ],
-            id="obs-table",
-        ),
+        table_section("var", "Variable Table"),
+        table_section("obs", "Observations Table"),
     ]
 )
 
@@ -121,7 +134,7 @@ layout = dbc.Container(
                                 html.Div(
                                     [
                                         dbc.Alert(
-                                            "Loading your dataset. Please be patient this can take several minutes. Do not refresh or navigate from this page. You will see a green success message when your dataset has loaded.",
+                                            "Loading your dataset in the background. Large datasets can take several minutes, the progress is shown below. You will see a green success message when your dataset has loaded.",
                                             color="primary",
                                         ),
                                     ],
@@ -134,6 +147,10 @@ layout = dbc.Container(
             ],
             id="loading-output-message",
         ),
+        # background load progress
+        dcc.Interval(id="load-interval", interval=1000, n_intervals=0),
+        dcc.Store(id="dataset-ready"),
+        html.Div([], id="load-progress"),
         # controls - select different options from the dataset to plot
         # loading spinner
         html.Div(
@@ -165,7 +182,7 @@ layout = dbc.Container(
             dbc.Col(
                 [
                     dbc.Alert(
-                        "Once your dataset has loaded select one or more options. Scroll down to view your dataframes. You can optionally download any dataframe as an excel file by clicking the 'Export' button.",
+                        "Once your dataset has loaded scroll down to view a summary of every column. Select 'Show rows' to page through a table, you can download any table as a CSV or Parquet file with the links above it.",
                         color="primary",
                     ),
                 ]
@@ -210,6 +227,21 @@ def dynamic_message(adata_path=None, adata_found=True):
         )
 
 
+def export_links(table):
+    # streamed by apps.scanpy.dataframes.export
+    return [
+        dbc.Button(
+            f"Download {fmt}",
+            href=url_for(f"scanpy_dataframes_export.export_{fmt.lower()}", table=table),
+            external_link=True,
+            color="secondary",
+            size="sm",
+            className="me-2",
+        )
+        for fmt in ("CSV", "Parquet")
+    ]
+
+
 def add_dash(server, appbuilder, title, **kwargs):
     app = Dash(
         name="dash-scanpy-dataframes",
@@ -227,34 +259,51 @@ def add_dash(server, appbuilder, title, **kwargs):
     )
     apply_layout_with_auth(app, layout, appbuilder)
 
+    @app.callback(
+        Output("load-progress", "children"),
+        Output("load-interval", "disabled"),
+        Output("dataset-ready", "data"),
+        Input("load-interval", "n_intervals"),
+    )
+    def poll_dataset(n_intervals):
+        job = sc_utils.start_load()
+        if job is None:
+            # no session dataset, update_graph falls back to the scanpy example
+            return "", True, "default"
+        if job.done:
+            return "", True, job.key
+        return load_progress(job.to_dict()), job.failed, dash.no_update
+
     @app.callback(
         Output("message", "children"),
         Output("loading-output-message", "children"),
         Output("loading-output-spinner", "children"),
-        Output("var_df", "data"),
         Output("var_df", "columns"),
-        Output("obs_df", "data"),
         Output("obs_df", "columns"),
+        Output("var_summary", "data"),
+        Output("obs_summary", "data"),
+        Output("var_df_export", "children"),
+        Output("obs_df_export", "children"),
         [
-            Input("url", "pathname"),
+            Input("dataset-ready", "data"),
         ],
     )
     def update_graph(
-        url_path
+        dataset_ready
     ):
         # , plot_type, obs, var, genes
+        if not dataset_ready:
+            # the dataset is still loading in the background
+            raise PreventUpdate
 
         ## Load the dataset
         logger.info("Loading the dataset")
         adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
         logger.info(dataset)
 
-
-        var_df = sc.get.var_df(dataset, keys=list(dataset.var.keys()))
-        var_df_data = var_df.to_dict('records')
-        logger.info(var_df.shape)
-        obs_df = sc.get.obs_df(dataset, keys=list(dataset.obs.keys()))
-        obs_df_data = obs_df.to_dict('records')
+        # the rows are sent a page at a time by update_table
+        var_table = table_query.get_table(dataset, "var")
+        obs_table = table_query.get_table(dataset, "obs")
         message = dynamic_message(
             adata_path=adata_path, adata_found=adata_found
         )
@@ -265,14 +314,67 @@ def add_dash(server, appbuilder, title, **kwargs):
             "",
             # Output("loading-output-spinner", "children"),
             "",
-            # Output("var_df", "data"),
-            var_df_data,
             # Output("var_df", "columns"),
-            [{"name": i, "id": i} for i in var_df.columns],
-            # Output("obs_df", "data"),
-            obs_df_data,
+            var_table.columns(),
             # Output("obs_df", "columns"),
-            [{"name": i, "id": i} for i in obs_df.columns],
+            obs_table.columns(),
+            # Output("var_summary", "data"),
+            var_table.summary(),
+            # Output("obs_summary", "data"),
+            obs_table.summary(),
+            # Output("var_df_export", "children"),
+            export_links("var"),
+            # Output("obs_df_export", "children"),
+            export_links("obs"),
         ]
 
+    for table in table_query.TABLES:
+        add_table_callback(app, table)
+
     return app.server
+
+
+def add_table_callback(app, table):
+    table_id = f"{table}_df"
+
+    @app.callback(
+        Output(f"{table_id}_collapse", "is_open"),
+        Output(f"{table_id}_show", "children"),
+        Input(f"{table_id}_show", "n_clicks"),
+        State(f"{table_id}_collapse", "is_open"),
+        prevent_initial_call=True,
+    )
+    def toggle_rows(n_clicks, is_open):
+        return not is_open, "Show rows" if is_open else "Hide rows"
+
+    @app.callback(
+        Output(table_id, "data"),
+        Output(table_id, "page_count"),
+        Output(f"{table_id}_count", "children"),
+        Input("dataset-ready", "data"),
+        Input(table_id, "page_current"),
+        Input(table_id, "page_size"),
+        Input(table_id, "sort_by"),
+        Input(table_id, "filter_query"),
+        Input(f"{table_id}_collapse", "is_open"),
+    )
+    def update_table(
+        dataset_ready, page_current, page_size, sort_by, filter_query, is_open
+    ):
+        # rows are only fetched once the user asks for them
+        if not dataset_ready or not is_open:
+            raise PreventUpdate
+        adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+        query = table_query.get_table(dataset, table)
+        try:
+            records, page_count, n_rows = query.page(
+                page_current=page_current,
+                page_size=page_size,
+                sort_by=sort_by,
+                filter_query=filter_query,
+            )
+        except table_query.FilterError as e:
+            return [], 1, dbc.Alert(str(e), color="warning")
+        return records, page_count, f"{n_rows:,} of {len(query):,} rows"
+
+    return update_table
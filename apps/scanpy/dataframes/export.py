@@ -0,0 +1,151 @@
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Blueprint, Response, abort, request
+
+from apps import sc_utils
+from apps.scanpy import table_query
+from apps.security import public_or_authenticated
+
+"""
+Streaming exports of the obs and var tables
+
+/scanpy/dataframes/export/<obs|var>.<csv|parquet>?columns=a,b
+
+The table is written a block of rows at a time and every block is sent as soon
+as it is encoded, so memory use does not grow with the number of rows.
+"""
+
+EXPORT_CHUNK_ROWS = int(os.environ.get("EXPORT_CHUNK_ROWS", 50000))
+
+blueprint = Blueprint(
+    "scanpy_dataframes_export", __name__, url_prefix="/scanpy/dataframes/export"
+)
+
+
+def export_frame(table, columns=None):
+    """
+    The obs or var frame of the session dataset and the positions of the columns
+    """
+    if table not in table_query.TABLES:
+        abort(404)
+    adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+    frame = getattr(dataset, table)
+    if columns:
+        missing = [column for column in columns if column not in frame.columns]
+        if missing:
+            abort(400, f"Unknown columns: {', '.join(missing)}")
+        positions = [frame.columns.get_loc(column) for column in columns]
+    else:
+        positions = list(range(len(frame.columns)))
+    return frame, positions
+
+
+def _requested_columns():
+    columns = request.args.get("columns")
+    if not columns:
+        return None
+    return [column for column in columns.split(",") if column]
+
+
+def iter_chunks(frame, positions, index_label, chunk_rows=EXPORT_CHUNK_ROWS):
+    # the columns are projected per block, the frame itself is never copied
+    for start in range(0, max(len(frame), 1), chunk_rows):
+        chunk = frame.iloc[start : start + chunk_rows, positions]
+        yield chunk.rename_axis(index_label)
+
+
+def iter_csv(chunks):
+    for i, chunk in enumerate(chunks):
+        yield chunk.to_csv(header=i == 0)
+
+
+class StreamSink(object):
+    """
+    Write only file that hands what was written to the response
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def parquet_schema(frame, positions, index_label):
+    """
+    Arrow schema of the whole export from the frame dtypes, so it does not
+    depend on the values of the first block. Object columns are written as strings.
+    """
+    empty = frame.iloc[:0, positions].rename_axis(index_label)
+    schema = pa.Schema.from_pandas(empty, preserve_index=True)
+    fields = [
+        pa.field(field.name, pa.string()) if field.type == pa.null() else field
+        for field in schema
+    ]
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+def iter_parquet(chunks, schema):
+    # one row group per block of rows
+    sink = StreamSink()
+    writer = pq.ParquetWriter(sink, schema)
+    for chunk in chunks:
+        text = [column for column in chunk.columns if chunk[column].dtype == object]
+        if text:
+            chunk = chunk.astype({column: "string" for column in text})
+        arrow_table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=True)
+        writer.write_table(arrow_table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def _download(body, mimetype, filename):
+    response = Response(body, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    return response
+
+
+@blueprint.route("/<table>.csv")
+@public_or_authenticated
+def export_csv(table):
+    frame, positions = export_frame(table, _requested_columns())
+    chunks = iter_chunks(frame, positions, index_label=f"{table}_names")
+    return _download(iter_csv(chunks), "text/csv", f"{table}.csv")
+
+
+@blueprint.route("/<table>.parquet")
+@public_or_authenticated
+def export_parquet(table):
+    frame, positions = export_frame(table, _requested_columns())
+    index_label = f"{table}_names"
+    chunks = iter_chunks(frame, positions, index_label=index_label)
+    return _download(
+        iter_parquet(chunks, parquet_schema(frame, positions, index_label)),
+        "application/vnd.apache.parquet",
+        f"{table}.parquet",
+    )
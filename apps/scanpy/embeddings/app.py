@@ -6,8 +6,8 @@ from scanpy.plotting._tools import scatterplots as sc_scatterplots
 import dash
 from dash import dash_table as dt
 import dash_bootstrap_components as dbc
-from dash import Dash, html, dcc
-from dash.dependencies import Input, Output
+from dash import Dash, Patch, html, dcc
+from dash.dependencies import Input, Output, State, MATCH
 from dash.exceptions import PreventUpdate
 import plotly.express as px
 import fsspec
@@ -31,9 +31,9 @@ from functools import lru_cache
 # app imports
 from flask import url_for, session, current_app
 from apps.dash.dash_func import apply_layout_with_auth, CustomDash, load_object, save_object
-from apps.scanpy import scatterplot_utils
-from apps.dash.utils import fig_to_uri, navbar
-from apps import sc_utils, s3_utils
+from apps.scanpy import figure_cache, scatterplot_utils, tiles
+from apps.dash.utils import fig_to_uri, navbar, load_progress
+from apps import sc_utils, s3_utils, compute_service, gene_matrix
 from apps.logger import logger
 
 from server.data_anndata.anndata_adaptor import AnndataAdaptor
@@ -75,11 +75,12 @@ var_dropdown = html.Div(
 )
 genes_dropdown = html.Div(
     [
-        dbc.Label("Select 0 or more genes from your dataset."),
+        dbc.Label("Select 0 or more genes from your dataset, type to search."),
         dcc.Dropdown(
             id="genes_dropdown",
             options=[],
             multi=True,
+            placeholder="Type a gene name",
         ),
     ],
     className="mb-4",
@@ -93,6 +94,8 @@ plot_type_dropdown = html.Div(
                 {"label": "umap", "value": "umap"},
                 {"label": "pca", "value": "pca"},
                 {"label": "tsne", "value": "tsne"},
+                {"label": "tsne (fast)", "value": "tsne_fast"},
+                {"label": "umap (landmarks)", "value": "umap_landmark"},
             ],
             value="pca",
         ),
@@ -100,8 +103,22 @@ plot_type_dropdown = html.Div(
     className="mb-4",
 )
 
+full_resolution_switch = html.Div(
+    [
+        dbc.Checklist(
+            id="full_resolution",
+            options=[
+                {"label": "Full resolution, draw every cell as zoomable density tiles", "value": "full"}
+            ],
+            value=[],
+            switch=True,
+        ),
+    ],
+    className="mb-4",
+)
+
 controls = dbc.Card(
-    [plot_type_dropdown, obs_dropdown, genes_dropdown],
+    [plot_type_dropdown, obs_dropdown, genes_dropdown, full_resolution_switch],
     body=True,
 )
 
@@ -128,7 +145,7 @@ layout = dbc.Container(
                                 html.Div(
                                     [
                                         dbc.Alert(
-                                            "Loading your dataset. Please be patient this can take several minutes. Do not refresh or navigate from this page. You will see a green success message when your dataset has loaded.",
+                                            "Loading your dataset in the background. Large datasets can take several minutes, the progress is shown below. You will see a green success message when your dataset has loaded.",
                                             color="primary",
                                         ),
                                     ],
@@ -141,6 +158,10 @@ layout = dbc.Container(
             ],
             id="loading-output-message",
         ),
+        # background load progress
+        dcc.Interval(id="load-interval", interval=1000, n_intervals=0),
+        dcc.Store(id="dataset-ready"),
+        html.Div([], id="load-progress"),
         # controls - select different options from the dataset to plot
         # loading spinner
         html.Div(
@@ -181,7 +202,10 @@ layout = dbc.Container(
         html.Br(),
         dbc.Row([dbc.Col([controls], width=12)], id="controls"),
         html.Br(),
-        # plots
+        # polls while an embedding is computed in the background
+        dcc.Interval(id="compute-interval", interval=2000, disabled=True),
+        # plots, one panel per selected color
+        dcc.Store(id="panels"),
         html.Div(
             [],
             id="scatter_plots",
@@ -195,6 +219,11 @@ layout = dbc.Container(
 d = os.path.dirname(__file__)
 assets_folder = os.path.join(d, "assets")
 
+# gene dropdown options returned per search
+GENE_SEARCH_LIMIT = 50
+# panel key of the plot without a color
+NO_COLOR = "__no_color__"
+
 
 def get_genes_as_df(dataset):
     # if loading with cellxgene there is a name_0 column
@@ -229,21 +258,18 @@ def build_options(vars, obs, genes):
 def scanpy_plot(dataset, plot_type, color):
 
 
+    # blocks until the worker process has computed the embedding
+    compute_service.service.submit(dataset, plot_type).result()
+
     if plot_type == "pca":
-        if "X_pca" not in list(dataset.obsm.keys()):
-            sc.pp.pca(dataset)
         ax = sc_scatterplots.embedding(
             dataset, "pca", ncols=1, show=False, return_fig=False, color=color
         )
     elif plot_type == "umap":
-        if "X_umap" not in list(dataset.obsm.keys()):
-            sc.tl.umap(dataset)
         ax = sc_scatterplots.embedding(
             dataset, "umap", ncols=1, show=False, return_fig=False, color=color
         )
     elif plot_type == "tsne":
-        if "X_tsne" not in list(dataset.obsm.keys()):
-            sc.tl.tsne(dataset)
         ax = sc_scatterplots.embedding(
             dataset, "tsne", ncols=1, show=False, return_fig=False, color=color
         )
@@ -298,14 +324,28 @@ def dynamic_message(dataset_path=None, dataset_found=True):
         )
 
 
-def dynamic_plot_maker(scatter_fig, histogram_fig=None, title="", index=0, error=False):
+def scatter_graph(scatter_fig, index=0, raster_meta=None):
+    if raster_meta is None:
+        return dcc.Graph(id={"type": "scatter-graph", "index": index}, figure=scatter_fig)
+    # tiles are swapped in by update_raster_tiles as the user zooms
+    return html.Div(
+        [
+            dcc.Graph(id={"type": "raster-graph", "index": index}, figure=scatter_fig),
+            dcc.Store(id={"type": "raster-meta", "index": index}, data=raster_meta),
+        ]
+    )
+
+
+def dynamic_plot_maker(
+    scatter_fig, histogram_fig=None, title="", index=0, error=None, raster_meta=None
+):
     if error:
         return dbc.Row(
             [
                 dbc.Col(
                     [
                         dbc.Alert(
-                            "Unable to render this plot: {error}", color="danger"
+                            f"Unable to render this plot: {error}", color="danger"
                         ),
                     ]
                 )
@@ -319,17 +359,107 @@ def dynamic_plot_maker(scatter_fig, histogram_fig=None, title="", index=0, error
                     title,
                 ),
                 dbc.Col(
-                    [dcc.Graph(id=f"histogram-{index}", figure=histogram_fig)], width=12
-                ),
-                dbc.Col(
-                    [dcc.Graph(id=f"scatter-{index}", figure=scatter_fig)], width=12
+                    [
+                        dcc.Graph(
+                            id={"type": "histogram-graph", "index": index},
+                            figure=histogram_fig,
+                        )
+                    ],
+                    width=12,
                 ),
+                dbc.Col([scatter_graph(scatter_fig, index, raster_meta)], width=12),
             ]
         )
     else:
         return dbc.Row(
-            [dbc.Col([dcc.Graph(id=f"scatter-{index}", figure=scatter_fig)], width=12)]
+            [dbc.Col([scatter_graph(scatter_fig, index, raster_meta)], width=12)]
+        )
+
+
+def axis_labels(basis):
+    if basis == "pca":
+        return {"x": "PC1", "y": "PC2"}
+    elif basis.startswith("umap"):
+        return {"x": "UMAP1", "y": "UMAP2"}
+    return {"x": "TSNE1", "y": "TSNE2"}
+
+
+def panel_skeleton(key, settings):
+    """
+    Placeholder for one panel, render_panel fills it in from the spec
+    """
+    spec = dict(settings, color=None if key == NO_COLOR else key)
+    return html.Div(
+        [
+            dcc.Store(id={"type": "panel-spec", "index": key}, data=spec),
+            dbc.Spinner(html.Div(id={"type": "panel-body", "index": key})),
+        ],
+        id={"type": "panel", "index": key},
+    )
+
+
+def panel_figures(dataset, spec):
+    """
+    Scatter plot, and histogram of the color, for one panel
+    """
+    basis = spec["basis"]
+    color = spec["color"]
+    labels = axis_labels(basis)
+    title = f"{basis.upper()} {color}" if color else f"{basis.upper()}"
+    if color:
+        labels["color"] = color
+
+    sc_data_frame = scatterplot_utils.create_plot_dataframe(
+        dataset, basis, color=[color] if color else None
+    )
+    if color and color not in sc_data_frame.columns:
+        raise ValueError(f"{color} is not in this dataset")
+
+    if spec["full_resolution"]:
+        scatter_fig = tiles.raster_figure(
+            dataset, basis, color=color, labels=labels, title=title
+        )
+        raster_meta = tiles.raster_meta(dataset, basis, color=color)
+    else:
+        scatter_fig = scatterplot_utils.scatter_figure(
+            sc_data_frame, color=color, labels=labels, title=title
+        )
+        raster_meta = None
+
+    histogram_fig = None
+    if color:
+        histogram_fig = scatterplot_utils.histogram_figure(
+            sc_data_frame[color], labels=labels, title=title
         )
+    return {
+        "scatter": scatter_fig,
+        "histogram": histogram_fig,
+        "raster_meta": raster_meta,
+        "title": title,
+    }
+
+
+def panel_plots(dataset, spec):
+    # repeated views are served from the figure cache
+    key = figure_cache.figure_key(
+        dataset,
+        spec["basis"],
+        spec["color"],
+        full_resolution=spec["full_resolution"],
+        budget=scatterplot_utils.PLOT_POINT_BUDGET,
+        tile_size=tiles.TILE_SIZE,
+    )
+    figures = figure_cache.cache.get(key)
+    if figures is None:
+        figures = panel_figures(dataset, spec)
+        figure_cache.cache.put(key, figures)
+    return dynamic_plot_maker(
+        scatter_fig=figures["scatter"],
+        histogram_fig=figures["histogram"],
+        title=figures["title"],
+        index=spec["color"] or NO_COLOR,
+        raster_meta=figures["raster_meta"],
+    )
 
 
 def add_dash(server, appbuilder, title, **kwargs):
@@ -349,136 +479,198 @@ def add_dash(server, appbuilder, title, **kwargs):
     )
     apply_layout_with_auth(app, layout, appbuilder)
 
+    @app.callback(
+        Output("load-progress", "children"),
+        Output("load-interval", "disabled"),
+        Output("dataset-ready", "data"),
+        Input("load-interval", "n_intervals"),
+    )
+    def poll_dataset(n_intervals):
+        job = sc_utils.start_load()
+        if job is None:
+            # no session dataset, update_graph falls back to the scanpy example
+            return "", True, "default"
+        if job.done:
+            return "", True, job.key
+        return load_progress(job.to_dict()), job.failed, dash.no_update
+
     @app.callback(
         Output("obs_dropdown", "options"),
+        Input("dataset-ready", "data"),
+    )
+    def update_obs_options(dataset_ready):
+        # sent once per dataset
+        if not dataset_ready:
+            raise PreventUpdate
+        adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+        var_options, obs_options, genes_options = build_options(
+            [], list(dataset.obs.keys()), []
+        )
+        return obs_options
+
+    @app.callback(
         Output("genes_dropdown", "options"),
+        Input("genes_dropdown", "search_value"),
+        State("genes_dropdown", "value"),
+        State("dataset-ready", "data"),
+    )
+    def search_genes(search_value, genes_values, dataset_ready):
+        # only the matches of the typed prefix are sent, the dataset can have 30k+ genes
+        if not dataset_ready or not search_value:
+            raise PreventUpdate
+        adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+        matches = gene_matrix.search_genes(
+            dataset, search_value, limit=GENE_SEARCH_LIMIT
+        )
+        # the selected genes have to stay in the options
+        selected = [gene for gene in genes_values or [] if gene not in matches]
+        var_options, obs_options, genes_options = build_options([], [], selected + matches)
+        return genes_options
+
+    @app.callback(
         Output("scatter_plots", "children"),
+        Output("panels", "data"),
         Output("message", "children"),
         Output("loading-output-message", "children"),
         Output("loading-output-spinner", "children"),
-        # Output("loading-div", "children"),
-        # Output(component_id="controls", component_property="hidden"),
+        Output("compute-interval", "disabled"),
         [
-            # Input("url", "pathname"),
+            Input("dataset-ready", "data"),
+            Input("compute-interval", "n_intervals"),
             Input("plot_type_dropdown", "value"),
             Input("obs_dropdown", "value"),
             Input("genes_dropdown", "value"),
+            Input("full_resolution", "value"),
         ],
+        State("panels", "data"),
     )
-    def update_graph(plot_type_value, obs_values, genes_values):
-        # , plot_type, obs, var, genes
-        var_values = []
-        adata_path = None
-
-        ## Load the dataset
-        logger.info("Loading the dataset")
-        adata_found = True
-
-        try:
-            adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
-        except Exception as e:
-            logger.exception(e)
-
-        logger.info('Completed loading the dataset')
-        logger.info(dataset)
+    def update_panels(
+        dataset_ready,
+        compute_intervals,
+        plot_type_value,
+        obs_values,
+        genes_values,
+        full_resolution_value,
+        panels,
+    ):
+        """
+        Keep one panel per selected color. When only the selection changed the
+        panels are patched: new colors are appended and render themselves through
+        render_panel, removed colors are deleted without recomputing anything.
+        """
+        if not dataset_ready:
+            # the dataset is still loading in the background
+            raise PreventUpdate
 
-        ## Generate dropdown options for obs and genes
-        logger.info('Generating dropdown menus')
         color = build_colors(
             var_values=[], obs_values=obs_values, genes_values=genes_values
         )
-        logger.info(color)
-
-        df = get_genes_as_df(dataset)
-        genes = list(df["genes"])
-        obs = list(dataset.obs.keys())
-        vars = list(dataset.var.keys())
-        var_options, obs_options, genes_options = build_options(vars, obs, genes)
-
-        # if we want to just matplotlib we can render it like this
-        # out_url = scanpy_plot(dataset=dataset, plot_type=plot_type_value, color=color)
-
-        ## Get the embedding plot data as a dataframe
-        logger.info('Getting plot dataframe')
-        sc_data_frame = scatterplot_utils.create_plot_dataframe(
-            dataset, plot_type_value, color=color
-        )
-        if plot_type_value == "pca":
-            labels = {
-                "x": "PC1",
-                "y": "PC2",
-            }
-        elif plot_type_value == "umap":
-            labels = {
-                "x": "UMAP1",
-                "y": "UMAP2",
-            }
-        else:
-            labels = {
-                "x": "TSNE1",
-                "y": "TSNE2",
-            }
-        dynamic_figs = []
-        # Get the inputs and generate the corresponding plots
-        if color:
-            logger.info("Plotting with colors")
-            for i, c in enumerate(color):
-                # TODO Wrap this in try/catch block
-                labels["color"] = color[i]
-                title = f"{plot_type_value.upper()} {color[i]}"
-                scatter_fig = px.scatter(
-                    x=sc_data_frame["x"],
-                    y=sc_data_frame["y"],
-                    color=sc_data_frame[f"{color[i]}"],
-                    labels=labels,
-                    title=title,
-                )
+        keys = list(dict.fromkeys(color)) if color else [NO_COLOR]
+        settings = {
+            "dataset": dataset_ready,
+            "basis": plot_type_value,
+            "full_resolution": bool(full_resolution_value),
+        }
+
+        if panels and panels["settings"] == settings:
+            patched = Patch()
+            # delete from the end so the positions stay valid
+            for position in reversed(range(len(panels["keys"]))):
+                if panels["keys"][position] not in keys:
+                    del patched[position]
+            kept = [key for key in panels["keys"] if key in keys]
+            added = [key for key in keys if key not in kept]
+            for key in added:
+                patched.append(panel_skeleton(key, settings))
+            if not added and len(kept) == len(panels["keys"]):
+                raise PreventUpdate
+            return [
+                patched,
+                {"settings": settings, "keys": kept + added},
+                dash.no_update,
+                dash.no_update,
+                dash.no_update,
+                dash.no_update,
+            ]
 
-                histogram_fig = px.histogram(
-                    sc_data_frame,
-                    x=f"{color[i]}",
-                    labels=labels,
-                    title=title,
+        ## Load the dataset
+        logger.info("Loading the dataset")
+        adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+        message = dynamic_message(dataset_path=adata_path, dataset_found=adata_found)
+
+        ## Embeddings are computed in a worker process, the other bases stay usable meanwhile
+        basis_status = compute_service.service.status(dataset, plot_type_value)
+        if basis_status != compute_service.READY:
+            if basis_status == compute_service.ERROR:
+                # picking the plot type again submits it again
+                error = compute_service.service.error(dataset, plot_type_value)
+                alert = dbc.Alert(
+                    f"Unable to compute {plot_type_value.upper()}: {error}",
+                    color="danger",
                 )
-                fig_0 = dynamic_plot_maker(
-                    scatter_fig=scatter_fig,
-                    histogram_fig=histogram_fig,
-                    title=title,
-                    index=i,
+            else:
+                compute_service.service.submit(dataset, plot_type_value)
+                alert = dbc.Alert(
+                    f"Computing {plot_type_value.upper()} for this dataset. The plots will appear here when it is ready, you can view the other plot types meanwhile.",
+                    color="info",
                 )
-                dynamic_figs.append(fig_0)
-        else:
-            logger.info("Plotting without colors")
-            title = f"{plot_type_value.upper()}"
-            scatter_fig = px.scatter(
-                x=sc_data_frame["x"], y=sc_data_frame["y"], title=title, labels=labels
-            )
-            fig_0 = dynamic_plot_maker(
-                scatter_fig=scatter_fig,
-                histogram_fig=None,
-                title=title,
-                index=0,
-            )
-            dynamic_figs = [fig_0]
+            return [
+                [dbc.Row([dbc.Col([alert])])],
+                None,
+                message,
+                "",
+                "",
+                basis_status == compute_service.ERROR,
+            ]
 
-        message = dynamic_message(
-            dataset_path=adata_path, dataset_found=adata_found
-        )
+        # the dataset, plot type or render mode changed, start over
         return [
-            # Output("obs_dropdown", "options"),
-            obs_options,
-            # Output("genes_dropdown", "options"),
-            genes_options,
-            # Output("scatter_plots", "children"),
-            dynamic_figs,
-            # Output("message", "children"),
+            [panel_skeleton(key, settings) for key in keys],
+            {"settings": settings, "keys": keys},
             message,
-            # Output("loading-output-message", "children"),
             "",
-            # Output("loading-output-spinner", "children"),
             "",
-            # Output(component_id="controls", component_property="style"),
-            # False,
+            True,
         ]
 
+    @app.callback(
+        Output({"type": "panel-body", "index": MATCH}, "children"),
+        Input({"type": "panel-spec", "index": MATCH}, "data"),
+    )
+    def render_panel(spec):
+        # runs once for each panel added to the page
+        adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+        try:
+            return panel_plots(dataset, spec)
+        except Exception as e:
+            logger.exception(e)
+            return dynamic_plot_maker(None, error=str(e))
+
+    @app.callback(
+        Output({"type": "raster-graph", "index": MATCH}, "figure"),
+        Input({"type": "raster-graph", "index": MATCH}, "relayoutData"),
+        State({"type": "raster-graph", "index": MATCH}, "figure"),
+        State({"type": "raster-meta", "index": MATCH}, "data"),
+    )
+    def update_raster_tiles(relayout_data, figure, raster_meta):
+        # only the tiles of the visible window are requested, at the matching zoom
+        if not relayout_data or not raster_meta:
+            raise PreventUpdate
+        window = tiles.relayout_window(relayout_data)
+        if window is None and not relayout_data.get("xaxis.autorange"):
+            raise PreventUpdate
+        x_min, x_max, y_min, y_max = raster_meta["bounds"]
+        if window is None:
+            window = (x_min, x_max, y_min, y_max)
+        figure["layout"]["images"] = tiles.tile_images(
+            raster_meta["dataset"],
+            raster_meta["basis"],
+            raster_meta["color"],
+            raster_meta["bounds"],
+            window,
+        )
+        figure["layout"]["xaxis"]["range"] = list(window[:2])
+        figure["layout"]["yaxis"]["range"] = list(window[2:])
+        return figure
+
     return app.server
@@ -0,0 +1,86 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from plotly.utils import PlotlyJSONEncoder
+
+from apps.dataset_registry import get_dataset_info
+
+"""
+Cache of rendered embedding figures
+
+Figures are stored as their serialized JSON, keyed by the dataset content hash,
+the basis, the color and the parameters that change what is drawn, so switching
+back to a plot that was already drawn does not touch the AnnData object.
+"""
+
+FIGURE_CACHE_MAX_BYTES = int(os.environ.get("FIGURE_CACHE_MAX_BYTES", 256 * 1024 ** 2))
+
+
+def figure_key(adata, basis, color=None, **params):
+    info = get_dataset_info(adata)
+    dataset = info.get("dataset_hash") or info.get("key") or str(id(adata))
+    return (dataset, basis, color, tuple(sorted(params.items())))
+
+
+class FigureCache(object):
+    """
+    LRU cache of figure JSON bounded by the size of the JSON
+    """
+
+    def __init__(self, max_bytes=FIGURE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        The cached figures for key as dicts, or None
+        """
+        with self._lock:
+            payload = self._items.get(key)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._items.move_to_end(key)
+        return json.loads(payload)
+
+    def put(self, key, figures):
+        payload = json.dumps(figures, cls=PlotlyJSONEncoder)
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self._nbytes -= len(previous)
+            if len(payload) > self.max_bytes:
+                return
+            self._items[key] = payload
+            self._nbytes += len(payload)
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._nbytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "total_bytes": self._nbytes,
+                "entries": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+cache = FigureCache()
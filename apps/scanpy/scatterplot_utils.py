@@ -52,11 +52,19 @@ from scanpy.plotting._utils import (
     make_projection_available,
 )
 from scanpy._utils import sanitize_anndata, _doc_params, Empty, _empty
-from apps import sc_utils
+from apps import gene_matrix, sc_utils
 from apps.logger import logger
+import base64
+import os
+from scanpy.plotting import palettes
 
 VMinMax = Union[str, float, Callable[[Sequence[float]], float]]
 
+# maximum number of cells drawn as markers in an embedding scatter plot
+PLOT_POINT_BUDGET = int(os.environ.get("PLOT_POINT_BUDGET", 50000))
+# upper bound on the bins of a histogram of a continuous color
+HISTOGRAM_MAX_BINS = int(os.environ.get("HISTOGRAM_MAX_BINS", 200))
+
 
 # https://github.com/theislab/scanpy/blob/1.6.1/scanpy/plotting/_tools/scatterplots.py
 def embedding(
@@ -565,14 +573,246 @@ def create_plot_dataframe(
     sc_data_frame["x"] = data_points[0][:, 0]
     sc_data_frame["y"] = data_points[0][:, 1]
     if color:
-        for value_to_plot in color:
-            try:
-                if value_to_plot not in adata.obs.columns:
-                    values = adata.raw.obs_vector(value_to_plot)
-                else:
-                    values = adata.obs_vector(value_to_plot, layer=None)
-                sc_data_frame[value_to_plot] = values
-            except Exception as e:
-                print(e)
+        obs_keys = [value for value in color if value in adata.obs.columns]
+        genes = [value for value in color if value not in adata.obs.columns]
+        for value_to_plot in obs_keys:
+            sc_data_frame[value_to_plot] = adata.obs_vector(value_to_plot, layer=None)
+        if genes:
+            # all genes in one column slice of the expression matrix
+            found, block = gene_matrix.gene_block(adata, genes, use_raw=use_raw)
+            for i, gene in enumerate(found):
+                sc_data_frame[gene] = block[:, i]
     return sc_data_frame
 
+
+def is_categorical(values):
+    return not pd.api.types.is_numeric_dtype(values) or is_categorical_dtype(values)
+
+
+def _grid_bins(x, y, grid_size):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    x_bin = ((x - x.min()) / (np.ptp(x) or 1.0) * (grid_size - 1)).astype(np.int64)
+    y_bin = ((y - y.min()) / (np.ptp(y) or 1.0) * (grid_size - 1)).astype(np.int64)
+    return x_bin * grid_size + y_bin
+
+
+def downsample(
+    sc_data_frame: pd.DataFrame,
+    budget: int = PLOT_POINT_BUDGET,
+    category: Optional[str] = None,
+    grid_size: int = 200,
+    random_state: int = 0,
+) -> pd.DataFrame:
+    """
+    Density aware downsampling of the plot dataframe.
+
+    Cells are binned on a grid over x/y, per category when one is given,
+    and every bin keeps at most the same number of cells. Dense regions are
+    thinned while sparse regions and rare categories are kept whole.
+    """
+    n_obs = len(sc_data_frame)
+    if n_obs <= budget:
+        return sc_data_frame
+    groups = _grid_bins(sc_data_frame["x"], sc_data_frame["y"], grid_size)
+    if category is not None:
+        codes = pd.factorize(sc_data_frame[category])[0].astype(np.int64) + 1
+        groups = groups * (codes.max() + 1) + codes
+    _, groups, counts = np.unique(groups, return_inverse=True, return_counts=True)
+
+    # largest per bin cap that stays within the budget
+    sorted_counts = np.sort(counts)
+    kept_below = np.cumsum(sorted_counts)
+    n_above = len(sorted_counts) - np.arange(len(sorted_counts))
+    totals = np.concatenate([[0], kept_below[:-1]]) + sorted_counts * n_above
+    i = np.searchsorted(totals, budget, side="right") - 1
+    if i < 0:
+        cap = max(budget // len(counts), 1)
+    elif i == len(counts) - 1:
+        cap = sorted_counts[i]
+    else:
+        # spread what is left of the budget over the bins above the cap
+        extra = (budget - totals[i]) // (len(counts) - i - 1)
+        cap = min(sorted_counts[i] + extra, sorted_counts[i + 1])
+
+    # random rank of each cell within its bin
+    rng = np.random.default_rng(random_state)
+    order = np.lexsort((rng.random(n_obs), groups))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.empty(n_obs, dtype=np.int64)
+    rank[order] = np.arange(n_obs) - starts[groups[order]]
+    return sc_data_frame[rank < cap]
+
+
+def category_codes(values):
+    """
+    Integer codes and category names of a categorical color,
+    missing values get their own "nan" category
+    """
+    if is_categorical_dtype(values):
+        codes = np.asarray(values.cat.codes, dtype=np.int64)
+        categories = [str(c) for c in values.cat.categories]
+    else:
+        codes, categories = pd.factorize(values, sort=True)
+        categories = [str(c) for c in categories]
+    if (codes < 0).any():
+        codes = np.where(codes < 0, len(categories), codes)
+        categories = categories + ["nan"]
+    return codes, categories
+
+
+def category_palette(n_categories):
+    palette = palettes.default_20 if n_categories <= 20 else palettes.default_102
+    return [palette[i % len(palette)] for i in range(n_categories)]
+
+
+def typed_array(values, dtype="f4"):
+    """
+    Plotly typed array, the values go over the wire as base64 encoded binary
+    instead of a JSON list of numbers
+    """
+    values = np.ascontiguousarray(values, dtype=np.dtype(dtype).newbyteorder("<"))
+    return {"dtype": dtype, "bdata": base64.b64encode(values.tobytes()).decode("ascii")}
+
+
+def _discrete_colorscale(colors):
+    # one flat step per category so the integer codes map onto the palette
+    n = len(colors)
+    scale = []
+    for i, color in enumerate(colors):
+        scale.append([i / n, color])
+        scale.append([(i + 1) / n, color])
+    return scale
+
+
+def scatter_figure(
+    sc_data_frame: pd.DataFrame,
+    color: Optional[str] = None,
+    labels: Optional[Mapping[str, str]] = None,
+    title: str = "",
+    budget: int = PLOT_POINT_BUDGET,
+):
+    """
+    WebGL scatter plot of an embedding, downsampled to the point budget.
+    Full resolution plots are drawn from tiles, see apps.scanpy.tiles.
+    """
+    labels = labels or {}
+    n_obs = len(sc_data_frame)
+    categorical = color is not None and is_categorical(sc_data_frame[color])
+    plot_df = downsample(
+        sc_data_frame, budget=budget, category=color if categorical else None
+    )
+    if len(plot_df) < n_obs:
+        title = f"{title} ({len(plot_df):,} of {n_obs:,} cells, {len(plot_df) / n_obs:.1%})"
+
+    trace = {
+        "type": "scattergl",
+        "mode": "markers",
+        "x": typed_array(plot_df["x"].values),
+        "y": typed_array(plot_df["y"].values),
+        "marker": {"size": 3},
+        "showlegend": False,
+        "hovertemplate": f"{labels.get('x', 'x')}=%{{x}}<br>{labels.get('y', 'y')}=%{{y}}<extra></extra>",
+    }
+    legend = []
+    if categorical:
+        # codes over the whole frame so the colors do not depend on the sample
+        codes, categories = category_codes(sc_data_frame[color])
+        codes = codes[sc_data_frame.index.get_indexer(plot_df.index)]
+        colors = category_palette(len(categories))
+        trace["marker"].update(
+            color=typed_array(codes, "u1" if len(categories) <= 256 else "u2"),
+            colorscale=_discrete_colorscale(colors),
+            cmin=-0.5,
+            cmax=len(categories) - 0.5,
+        )
+        # empty traces for the legend entries
+        legend = [
+            {
+                "type": "scattergl",
+                "mode": "markers",
+                "x": [None],
+                "y": [None],
+                "name": category,
+                "marker": {"color": colors[i], "size": 8},
+                "legendgroup": category,
+            }
+            for i, category in enumerate(categories)
+        ]
+    elif color is not None:
+        trace["marker"].update(
+            color=typed_array(plot_df[color].values),
+            colorscale="Viridis",
+            colorbar={"title": {"text": labels.get("color", color)}},
+        )
+        trace["hovertemplate"] = trace["hovertemplate"].replace(
+            "<extra>", f"<br>{color}=%{{marker.color}}<extra>"
+        )
+    return {
+        "data": [trace] + legend,
+        "layout": {
+            "title": {"text": title},
+            "xaxis": {"title": {"text": labels.get("x")}},
+            "yaxis": {"title": {"text": labels.get("y")}},
+            "legend": {"title": {"text": labels.get("color", color)}, "itemsizing": "constant"},
+        },
+    }
+
+
+def histogram_bins(values, max_bins=HISTOGRAM_MAX_BINS):
+    """
+    Bin edges for continuous values, numpy's "auto" rule (the larger of the
+    Sturges and Freedman Diaconis estimates) capped at max_bins
+    """
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return np.array([0.0, 1.0])
+    edges = np.histogram_bin_edges(values, bins="auto")
+    if len(edges) - 1 > max_bins:
+        edges = np.histogram_bin_edges(values, bins=max_bins)
+    return edges
+
+
+def histogram_figure(
+    values: pd.Series,
+    labels: Optional[Mapping[str, str]] = None,
+    title: str = "",
+    max_bins: int = HISTOGRAM_MAX_BINS,
+):
+    """
+    Histogram binned on the server, only the bins and their counts are sent
+    to the browser. Categories are counted per category.
+    """
+    labels = labels or {}
+    name = labels.get("color", values.name)
+    if is_categorical(values):
+        codes, categories = category_codes(values)
+        counts = np.bincount(codes, minlength=len(categories))
+        trace = {
+            "type": "bar",
+            "x": categories,
+            "y": typed_array(counts, "u4"),
+            "marker": {"color": category_palette(len(categories))},
+            "hovertemplate": f"{name}=%{{x}}<br>cells=%{{y}}<extra></extra>",
+        }
+    else:
+        data = np.asarray(values, dtype=np.float64)
+        edges = histogram_bins(data, max_bins=max_bins)
+        counts, edges = np.histogram(data[np.isfinite(data)], bins=edges)
+        trace = {
+            "type": "bar",
+            "x": typed_array((edges[:-1] + edges[1:]) / 2),
+            "y": typed_array(counts, "u4"),
+            "width": typed_array(np.diff(edges)),
+            "customdata": np.column_stack([edges[:-1], edges[1:]]).tolist(),
+            "hovertemplate": f"{name}=%{{customdata[0]:.3g}} to %{{customdata[1]:.3g}}<br>cells=%{{y}}<extra></extra>",
+        }
+    return {
+        "data": [trace],
+        "layout": {
+            "title": {"text": title},
+            "xaxis": {"title": {"text": name}},
+            "yaxis": {"title": {"text": "count"}},
+            "bargap": 0,
+        },
+    }
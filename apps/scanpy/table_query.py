@@ -0,0 +1,400 @@
+import math
+import operator
+import re
+import threading
+import warnings
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_categorical_dtype, is_numeric_dtype
+
+from apps.dataset_registry import (
+    get_dataset_info,
+    register_sizer,
+    registry,
+    update_dataset_info,
+)
+
+"""
+Server side paging, sorting and filtering of the obs and var tables
+
+Dash DataTables with page_action, sort_action and filter_action set to "custom"
+send their page, sort_by and filter_query, which are answered here with
+vectorized masks over the frame and sort permutations cached per column.
+Only the rows of the requested page are sent back.
+
+Column summaries (dtype, missing values, range, quantiles, most frequent values)
+are computed once per dataset when it is loaded.
+
+The tables are kept in the dataset info of their AnnData, so they are counted
+in its registry size and dropped with it.
+"""
+
+TABLES = ("obs", "var")
+# most frequent values listed in the summary of a categorical column
+SUMMARY_TOP_K = 5
+
+_OPERATORS = {
+    "eq": operator.eq,
+    "=": operator.eq,
+    "ne": operator.ne,
+    "!=": operator.ne,
+    "lt": operator.lt,
+    "<": operator.lt,
+    "le": operator.le,
+    "<=": operator.le,
+    "gt": operator.gt,
+    ">": operator.gt,
+    "ge": operator.ge,
+    ">=": operator.ge,
+}
+_TEXT_OPERATORS = ("contains", "datestartswith")
+_BLANK_OPERATORS = ("is blank", "is nil")
+
+# {column} operator value, the value may be quoted
+_EXPRESSION = re.compile(
+    r"^\s*\{(?P<column>[^}]+)\}\s+(?P<op>is not blank|is blank|is nil|[is]?\S+)\s*(?P<value>.*?)\s*$"
+)
+
+
+class FilterError(ValueError):
+    pass
+
+
+def parse_filter(filter_query):
+    """
+    Split a DataTable filter_query into (column, operator, value, case_sensitive) terms
+    """
+    terms = []
+    if not filter_query:
+        return terms
+    for expression in filter_query.split(" && "):
+        match = _EXPRESSION.match(expression)
+        if not match:
+            raise FilterError(f"Unable to parse the filter {expression}")
+        column, op, value = match.group("column", "op", "value")
+        case_sensitive = True
+        prefixed = op[0] in "is" and (op[1:] in _OPERATORS or op[1:] in _TEXT_OPERATORS)
+        if op not in _OPERATORS and prefixed:
+            # icontains, seq, ... carry the case sensitivity of the column
+            case_sensitive = op[0] == "s"
+            op = op[1:]
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in "\"'`":
+            value = value[1:-1].replace(f"\\{value[0]}", value[0])
+        terms.append((column, op, value, case_sensitive))
+    return terms
+
+
+_TRUE = ("true", "t", "yes", "1")
+_FALSE = ("false", "f", "no", "0")
+
+
+def _truth(value):
+    if value.lower() in _TRUE:
+        return True
+    if value.lower() in _FALSE:
+        return False
+    raise FilterError(f"{value} is not true or false")
+
+
+def _compare(values, op, value, case_sensitive=True):
+    """
+    Vectorized mask of values matching the term, values is a numpy array or
+    a Series. Missing values only match the blank operators.
+    """
+    values = pd.Series(values)
+    notnull = values.notnull().to_numpy()
+    if op in _BLANK_OPERATORS or op == "is not blank":
+        blank = ~notnull | (values.astype(str) == "").to_numpy()
+        return ~blank if op == "is not blank" else blank
+    if op in _TEXT_OPERATORS:
+        text = values.astype(str)
+        if not case_sensitive:
+            text = text.str.lower()
+            value = value.lower()
+        if op == "contains":
+            return text.str.contains(value, regex=False).to_numpy(dtype=bool) & notnull
+        return text.str.startswith(value).to_numpy(dtype=bool) & notnull
+    if op not in _OPERATORS:
+        raise FilterError(f"Unknown filter operator {op}")
+    compare = _OPERATORS[op]
+    if is_bool_dtype(values.dtype):
+        truth = _truth(value)
+        flags = values.fillna(False).to_numpy(dtype=bool)
+        return compare(flags, truth) & notnull
+    if is_numeric_dtype(values.dtype):
+        try:
+            number = float(value)
+        except ValueError:
+            raise FilterError(f"{value} is not a number")
+        numbers = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        with np.errstate(invalid="ignore"):
+            return compare(numbers, number) & notnull
+    text = values.astype(str).to_numpy()
+    if not case_sensitive:
+        text = np.char.lower(text.astype(str))
+        value = value.lower()
+    return compare(text, value) & notnull
+
+
+class TableQuery(object):
+    """
+    One obs or var frame with its sort orders
+
+    :param key: registry key of the dataset, re-measured as sort orders are cached
+    """
+
+    def __init__(self, frame, key=None):
+        self.frame = frame
+        self.key = key
+        self.signature = signature(frame)
+        self._ranks = {}
+        self._orders = {}
+        self._summary = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.frame)
+
+    def columns(self):
+        return [
+            {
+                "name": column,
+                "id": column,
+                "type": "numeric"
+                if is_numeric_dtype(self.frame[column].dtype)
+                and not is_categorical_dtype(self.frame[column].dtype)
+                else "text",
+            }
+            for column in self.frame.columns
+        ]
+
+    def rank(self, column):
+        """
+        Dense rank of every row by column, equal values share a rank and
+        missing values rank last
+        """
+        with self._lock:
+            rank = self._ranks.get(column)
+        if rank is None:
+            values = self.frame[column]
+            if is_categorical_dtype(values) and values.cat.ordered:
+                codes = np.asarray(values.cat.codes, dtype=np.float64)
+                values = pd.Series(np.where(codes < 0, np.nan, codes))
+            elif not is_numeric_dtype(values):
+                values = values.astype(str).where(values.notnull())
+            rank = values.rank(method="dense", na_option="bottom").values.astype(np.int64)
+            with self._lock:
+                self._ranks[column] = rank
+            self._grown()
+        return rank
+
+    def sort_key(self, column, ascending=True):
+        if ascending:
+            return self.rank(column)
+        # descending, but keep the missing values last
+        missing = self.frame[column].isnull().values
+        return np.where(missing, 1, -self.rank(column))
+
+    def order(self, column, ascending=True):
+        """
+        Cached row permutation sorting the frame by column
+        """
+        key = (column, ascending)
+        with self._lock:
+            order = self._orders.get(key)
+        if order is None:
+            order = np.argsort(self.sort_key(column, ascending), kind="stable")
+            with self._lock:
+                self._orders[key] = order
+            self._grown()
+        return order
+
+    def nbytes(self):
+        with self._lock:
+            arrays = list(self._ranks.values()) + list(self._orders.values())
+        return sum(array.nbytes for array in arrays)
+
+    def _grown(self):
+        if self.key:
+            registry.refresh(self.key)
+
+    def mask(self, filter_query):
+        mask = np.ones(len(self.frame), dtype=bool)
+        for column, op, value, case_sensitive in parse_filter(filter_query):
+            if column not in self.frame.columns:
+                raise FilterError(f"Unknown column {column}")
+            values = self.frame[column]
+            if is_categorical_dtype(values):
+                # compare the categories once and look the rows up by code
+                categories = np.asarray(values.cat.categories)
+                matches = _compare(categories, op, value, case_sensitive)
+                codes = np.asarray(values.cat.codes)
+                # rows without a category are missing values
+                mask &= np.where(codes >= 0, matches[codes], op in _BLANK_OPERATORS)
+            else:
+                matches = _compare(values, op, value, case_sensitive)
+                mask &= np.asarray(matches, dtype=bool)
+        return mask
+
+    def rows(self, sort_by=None, filter_query=None):
+        """
+        Positions of the rows that pass the filter, in sort order
+        """
+        mask = self.mask(filter_query)
+        sort_by = sort_by or []
+        if not sort_by:
+            return np.flatnonzero(mask)
+        if len(sort_by) == 1:
+            order = self.order(
+                sort_by[0]["column_id"], sort_by[0]["direction"] == "asc"
+            )
+            return order[mask[order]]
+        # later columns break the ties of earlier ones
+        keys = [
+            self.sort_key(sort["column_id"], sort["direction"] == "asc")
+            for sort in reversed(sort_by)
+        ]
+        order = np.lexsort(keys)
+        return order[mask[order]]
+
+    def summary(self):
+        """
+        Cached per column summary of the table
+        """
+        with self._lock:
+            summary = self._summary
+        if summary is None:
+            summary = summarize(self.frame)
+            with self._lock:
+                self._summary = summary
+        return summary
+
+    def page(self, page_current=0, page_size=20, sort_by=None, filter_query=None):
+        """
+        :return: (records of the page, page count, matching rows)
+        """
+        rows = self.rows(sort_by=sort_by, filter_query=filter_query)
+        page_count = max(math.ceil(len(rows) / page_size), 1)
+        start = (page_current or 0) * page_size
+        page = self.frame.iloc[rows[start : start + page_size]]
+        return page.to_dict("records"), page_count, len(rows)
+
+
+def _number(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def summarize(frame, top_k=SUMMARY_TOP_K):
+    """
+    Summary rows, one per column. The numeric columns are summarized together
+    in one pass over a 2D array, the others by their top_k value counts.
+    """
+    numeric = [
+        column
+        for column in frame.columns
+        if is_numeric_dtype(frame[column].dtype)
+        and not is_bool_dtype(frame[column].dtype)
+        and not is_categorical_dtype(frame[column].dtype)
+    ]
+    summaries = {}
+    if numeric:
+        values = frame[numeric].to_numpy(dtype=np.float64, na_value=np.nan)
+        nulls = np.isnan(values).sum(axis=0)
+        with warnings.catch_warnings():
+            # columns with only missing values give nan
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            minimum = np.nanmin(values, axis=0)
+            maximum = np.nanmax(values, axis=0)
+            mean = np.nanmean(values, axis=0)
+            quantiles = np.nanquantile(values, [0.25, 0.5, 0.75], axis=0)
+        for i, column in enumerate(numeric):
+            summaries[column] = {
+                "nulls": int(nulls[i]),
+                "min": _number(minimum[i]),
+                "q25": _number(quantiles[0, i]),
+                "median": _number(quantiles[1, i]),
+                "q75": _number(quantiles[2, i]),
+                "max": _number(maximum[i]),
+                "mean": _number(mean[i]),
+            }
+    for column in frame.columns:
+        if column in summaries:
+            continue
+        values = frame[column]
+        counts = values.value_counts(dropna=True)
+        summaries[column] = {
+            "nulls": int(values.isnull().sum()),
+            "unique": int((counts > 0).sum()),
+            "top": ", ".join(
+                f"{value} ({count:,})" for value, count in counts.head(top_k).items()
+            ),
+        }
+    return [
+        dict({"column": column, "dtype": str(frame[column].dtype)}, **summaries[column])
+        for column in frame.columns
+    ]
+
+
+def summarize_dataset(adata):
+    """
+    Compute the summaries of the obs and var tables of adata, run when it is loaded
+    """
+    for table in TABLES:
+        get_table(adata, table).summary()
+
+
+SUMMARY_COLUMNS = [
+    ("column", "text"),
+    ("dtype", "text"),
+    ("nulls", "numeric"),
+    ("unique", "numeric"),
+    ("min", "numeric"),
+    ("q25", "numeric"),
+    ("median", "numeric"),
+    ("q75", "numeric"),
+    ("max", "numeric"),
+    ("mean", "numeric"),
+    ("top", "text"),
+]
+
+
+def signature(frame):
+    """
+    Columns and dtypes of a frame, a table is rebuilt when they change
+    """
+    return len(frame), tuple(frame.columns), tuple(str(dtype) for dtype in frame.dtypes)
+
+
+_tables_lock = threading.Lock()
+
+
+def get_table(adata, table):
+    """
+    TableQuery of the obs or var frame of adata, shared between requests
+    """
+    if table not in TABLES:
+        raise ValueError(f"Unknown table {table}")
+    frame = getattr(adata, table)
+    with _tables_lock:
+        info = get_dataset_info(adata)
+        tables = info.get("tables")
+        if tables is None:
+            tables = {}
+            update_dataset_info(adata, tables=tables)
+        query = tables.get(table)
+        # first request, or obs/var was replaced or gained columns since
+        stale = query is None or query.frame is not frame
+        if stale or query.signature != signature(frame):
+            query = tables[table] = TableQuery(frame, key=info.get("key"))
+    return query
+
+
+def tables_nbytes(adata):
+    tables = get_dataset_info(adata).get("tables") or {}
+    return sum(query.nbytes() for query in list(tables.values()))
+
+
+# sort orders count towards the memory of their dataset
+register_sizer(tables_nbytes)
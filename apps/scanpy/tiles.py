@@ -0,0 +1,341 @@
+import math
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+from flask import Blueprint, Response, abort, request, url_for
+from matplotlib import cm
+from matplotlib import image as mpimg
+from matplotlib import colors as mcolors
+
+from apps import sc_utils
+from apps.dataset_registry import get_dataset_info
+from apps.security import public_or_authenticated
+from apps.scanpy import scatterplot_utils
+
+"""
+Rasterized density rendering of embeddings
+
+The embedding bounds are split into a pyramid of tiles, 2**z x 2**z tiles at zoom z,
+with tile (0, 0) in the lower left corner. Each tile aggregates the cells that fall
+in it into TILE_SIZE x TILE_SIZE pixels: cell counts, the mean of a continuous color
+or the majority category, and is served as a PNG.
+"""
+
+TILE_SIZE = int(os.environ.get("TILE_SIZE", 256))
+TILE_MAX_ZOOM = int(os.environ.get("TILE_MAX_ZOOM", 8))
+TILE_CACHE_SIZE = int(os.environ.get("TILE_CACHE_SIZE", 2048))
+# tiles requested at once for the visible window
+MAX_VISIBLE_TILES = 16
+
+blueprint = Blueprint("scanpy_tiles", __name__, url_prefix="/scanpy/tiles")
+
+
+class LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return self._items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._items),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+tile_cache = LRUCache(TILE_CACHE_SIZE)
+points_cache = LRUCache(16)
+
+
+class Points(object):
+    """
+    Embedding coordinates and color values of every cell, ready for aggregation
+    """
+
+    def __init__(self, x, y, values=None):
+        self.x = np.asarray(x, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.categories = None
+        self.values = None
+        self.vmin = self.vmax = None
+        if values is not None:
+            values = pd.Series(values)
+            if scatterplot_utils.is_categorical(values):
+                codes, self.categories = scatterplot_utils.category_codes(values)
+                self.values = codes.astype(np.int32)
+            else:
+                self.values = values.values.astype(np.float32)
+                self.vmin, self.vmax = np.nanpercentile(self.values, [1, 99])
+        self.bounds = (
+            float(self.x.min()),
+            float(self.x.max()),
+            float(self.y.min()),
+            float(self.y.max()),
+        )
+        # densest pixel of the whole embedding, used to scale counts at every zoom
+        counts, _, _ = np.histogram2d(self.x, self.y, bins=TILE_SIZE)
+        self.max_count = float(counts.max())
+
+    @property
+    def how(self):
+        if self.values is None:
+            return "count"
+        if self.categories is not None:
+            return "majority"
+        return "mean"
+
+
+def dataset_key(adata):
+    info = get_dataset_info(adata)
+    return info.get("dataset_hash") or info.get("key") or str(id(adata))
+
+
+def get_points(adata, basis, color=None):
+    key = (dataset_key(adata), basis, color)
+    points = points_cache.get(key)
+    if points is None:
+        df = scatterplot_utils.create_plot_dataframe(
+            adata, basis, color=[color] if color else None
+        )
+        points = Points(df["x"], df["y"], df[color] if color else None)
+        points_cache.put(key, points)
+    return points
+
+
+def tile_bounds(bounds, z, x, y):
+    x_min, x_max, y_min, y_max = bounds
+    n = 2 ** z
+    width = (x_max - x_min) / n
+    height = (y_max - y_min) / n
+    return (
+        x_min + x * width,
+        x_min + (x + 1) * width,
+        y_min + y * height,
+        y_min + (y + 1) * height,
+    )
+
+
+def aggregate(points, window, size=TILE_SIZE):
+    """
+    Aggregate the cells inside window into a size x size grid
+    :return: (counts, image) with rows along y from the bottom,
+        image is None for counts, the mean or the majority category code per pixel
+    """
+    x0, x1, y0, y1 = window
+    mask = (points.x >= x0) & (points.x <= x1) & (points.y >= y0) & (points.y <= y1)
+    ix = ((points.x[mask] - x0) / ((x1 - x0) or 1.0) * size).astype(np.int64)
+    iy = ((points.y[mask] - y0) / ((y1 - y0) or 1.0) * size).astype(np.int64)
+    np.clip(ix, 0, size - 1, out=ix)
+    np.clip(iy, 0, size - 1, out=iy)
+    pixel = iy * size + ix
+    counts = np.bincount(pixel, minlength=size * size).astype(np.float64)
+
+    image = None
+    if points.how == "mean":
+        values = points.values[mask]
+        finite = np.isfinite(values)
+        sums = np.bincount(pixel[finite], weights=values[finite], minlength=size * size)
+        # mean of the cells with a value, nan where a pixel has none
+        valued = np.bincount(pixel[finite], minlength=size * size)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            image = sums / valued
+    elif points.how == "majority":
+        n_categories = len(points.categories)
+        codes = points.values[mask]
+        per_category = np.bincount(
+            pixel * n_categories + codes,
+            minlength=size * size * n_categories,
+        ).reshape(size * size, n_categories)
+        image = per_category.argmax(axis=1)
+    return counts.reshape(size, size), None if image is None else image.reshape(size, size)
+
+
+def colorize(points, counts, image, z):
+    rgba = np.zeros(counts.shape + (4,), dtype=np.float32)
+    filled = counts > 0
+    if points.how == "count":
+        # expected density falls by 4 per zoom level
+        reference = max(points.max_count / 4 ** z, 1.0)
+        scaled = np.clip(np.log1p(counts) / np.log1p(reference), 0, 1)
+        rgba[filled] = cm.viridis(scaled[filled])
+    elif points.how == "mean":
+        norm = mcolors.Normalize(vmin=points.vmin, vmax=points.vmax, clip=True)
+        valid = filled & np.isfinite(image)
+        rgba[valid] = cm.viridis(norm(image[valid]))
+    else:
+        palette = scatterplot_utils.category_palette(len(points.categories))
+        lookup = np.array([mcolors.to_rgba(color) for color in palette])
+        rgba[filled] = lookup[image[filled]]
+    return rgba
+
+
+def render_tile(points, z, x, y):
+    window = tile_bounds(points.bounds, z, x, y)
+    counts, image = aggregate(points, window)
+    rgba = colorize(points, counts, image, z)
+    buffer = BytesIO()
+    # png rows go from the top, the grid rows from the bottom
+    mpimg.imsave(buffer, rgba[::-1], format="png")
+    return buffer.getvalue()
+
+
+@blueprint.route("/<basis>/<int:z>/<int:x>/<int:y>.png")
+@public_or_authenticated
+def tile(basis, z, x, y):
+    if z < 0 or z > TILE_MAX_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        abort(404)
+    color = request.args.get("color") or None
+    adata_found, adata_path, adaptor, dataset = sc_utils.load_adaptor()
+    if f"X_{basis}" not in dataset.obsm.keys():
+        abort(404)
+    # the url names the dataset so the browser cache never mixes datasets
+    if request.args.get("dataset") != dataset_key(dataset):
+        abort(404)
+
+    key = (dataset_key(dataset), basis, color, z, x, y)
+    png = tile_cache.get(key)
+    if png is None:
+        png = render_tile(get_points(dataset, basis, color), z, x, y)
+        tile_cache.put(key, png)
+    response = Response(png, mimetype="image/png")
+    response.headers["Cache-Control"] = "private, max-age=3600"
+    return response
+
+
+def visible_tiles(bounds, window=None):
+    """
+    Zoom level and tiles covering the visible window of the plot
+    """
+    x_min, x_max, y_min, y_max = bounds
+    if window is None:
+        return 0, [(0, 0)]
+    wx0, wx1, wy0, wy1 = window
+    visible = max(min((wx1 - wx0) / ((x_max - x_min) or 1.0), (wy1 - wy0) / ((y_max - y_min) or 1.0)), 1e-9)
+    z = int(min(max(math.floor(math.log2(1 / visible)), 0), TILE_MAX_ZOOM))
+    while True:
+        n = 2 ** z
+        width = (x_max - x_min) / n or 1.0
+        height = (y_max - y_min) / n or 1.0
+        xs = range(max(int((wx0 - x_min) // width), 0), min(int((wx1 - x_min) // width), n - 1) + 1)
+        ys = range(max(int((wy0 - y_min) // height), 0), min(int((wy1 - y_min) // height), n - 1) + 1)
+        tiles = [(tx, ty) for tx in xs for ty in ys]
+        if len(tiles) <= MAX_VISIBLE_TILES or z == 0:
+            return z, tiles
+        z -= 1
+
+
+def tile_images(dataset, basis, color, bounds, window=None):
+    """
+    Plotly layout images for the tiles covering window, dataset is the dataset_key
+    """
+    z, tiles = visible_tiles(bounds, window)
+    images = []
+    for tx, ty in tiles:
+        x0, x1, y0, y1 = tile_bounds(bounds, z, tx, ty)
+        source = url_for(
+            "scanpy_tiles.tile",
+            basis=basis,
+            z=z,
+            x=tx,
+            y=ty,
+            dataset=dataset,
+            color=color,
+        )
+        images.append(
+            dict(
+                source=source,
+                xref="x",
+                yref="y",
+                x=x0,
+                y=y1,
+                sizex=x1 - x0,
+                sizey=y1 - y0,
+                sizing="stretch",
+                layer="below",
+            )
+        )
+    return images
+
+
+def raster_meta(adata, basis, color=None):
+    """
+    What the browser needs to ask for the tiles of a raster figure
+    """
+    points = get_points(adata, basis, color)
+    return {
+        "dataset": dataset_key(adata),
+        "basis": basis,
+        "color": color,
+        "bounds": list(points.bounds),
+    }
+
+
+def relayout_window(relayout_data):
+    """
+    Visible window from the relayoutData of a graph, None when zoomed out
+    """
+    if not relayout_data:
+        return None
+    keys = ["xaxis.range[0]", "xaxis.range[1]", "yaxis.range[0]", "yaxis.range[1]"]
+    if all(key in relayout_data for key in keys):
+        return tuple(float(relayout_data[key]) for key in keys)
+    if "xaxis.range" in relayout_data and "yaxis.range" in relayout_data:
+        return tuple(relayout_data["xaxis.range"]) + tuple(relayout_data["yaxis.range"])
+    return None
+
+
+def raster_figure(adata, basis, color=None, labels=None, title=""):
+    """
+    Figure drawing the embedding from tiles. Corner markers fix the axis ranges,
+    the images are swapped for finer tiles as the user zooms.
+    """
+    labels = labels or {}
+    points = get_points(adata, basis, color)
+    x_min, x_max, y_min, y_max = points.bounds
+    how = {"count": "cell density", "mean": f"mean {color}", "majority": f"majority {color}"}
+    return {
+        "data": [
+            {
+                "type": "scattergl",
+                "x": [x_min, x_max],
+                "y": [y_min, y_max],
+                "mode": "markers",
+                "marker": {"opacity": 0},
+                "hoverinfo": "skip",
+                "showlegend": False,
+            }
+        ],
+        "layout": {
+            "title": {"text": f"{title} (all {len(points.x):,} cells, {how[points.how]})"},
+            "xaxis": {"title": {"text": labels.get("x")}, "range": [x_min, x_max]},
+            "yaxis": {"title": {"text": labels.get("y")}, "range": [y_min, y_max]},
+            "images": tile_images(dataset_key(adata), basis, color, points.bounds),
+            "plot_bgcolor": "white",
+            "uirevision": f"{basis}-{color}",
+        },
+    }
@@ -1,4 +1,4 @@
-from flask import render_template, current_app, request, redirect, url_for, session
+from flask import render_template, current_app, request, redirect, url_for, session, jsonify
 from flask_appbuilder.models.sqla.interface import SQLAInterface
 from flask_appbuilder import ModelView, ModelRestApi
 from flask_appbuilder.baseviews import BaseView
@@ -15,6 +15,9 @@ from flask_babel import lazy_gettext as _
 
 # from apps.scanpy.app import add_dash as add_dash_scanpy
 from apps.scanpy.embeddings import app as scanpy_embeding_app
+from apps.dataset_registry import registry
+from apps import dataset_catalog, disk_cache, gene_matrix
+from apps.scanpy import figure_cache, tiles
 from pprint import pprint
 
 from . import appbuilder, db
@@ -58,22 +61,48 @@ class DatasetView(BaseView):
         else:
             current_app.config['DATASET'] = False
 
-        s3 = s3fs.S3FileSystem()
+        # rendered from the catalog, the bucket is listed in the background
+        dataset_catalog.start()
         datasets = []
-        h5ads = s3.glob(f"s3://{S3_BUCKET}/**.h5ad")
-        csvs = s3.glob(f"s3://{S3_BUCKET}/**.csv")
-
-        for h5ad in h5ads:
-            datasets.append({"h5ad": h5ad})
+        for entry in dataset_catalog.entries("h5ad"):
+            datasets.append({"h5ad": entry.path, "entry": entry})
+        csvs = [entry.path for entry in dataset_catalog.entries("csv")]
 
         return self.render_template(
             "list.html",
             datasets=datasets,
             csvs=csvs,
+            catalog=dataset_catalog.status(),
             appbuilder=appbuilder,
             title="List Datasets",
         )
 
+    @has_access
+    @expose("/rescan/", methods=["POST"])
+    def rescan(self):
+        dataset_catalog.rescan()
+        flash("Rescanning the bucket, new datasets will be listed shortly", "info")
+        return redirect(url_for("DatasetView.list"))
+
+    @has_access
+    @expose("/stats/", methods=["GET"])
+    def stats(self):
+        datasets = registry.stats()
+        for entry in datasets["entries"]:
+            adaptor = registry.peek(entry["key"])
+            if adaptor is not None:
+                # what the gene-major copy of X costs, or would cost, for this dataset
+                entry["gene_major"] = gene_matrix.companion_stats(adaptor.data)
+        return jsonify(
+            {
+                "datasets": datasets,
+                "disk_cache": disk_cache.cache.stats(),
+                "figure_cache": figure_cache.cache.stats(),
+                "tile_cache": tiles.tile_cache.stats(),
+                "catalog": dataset_catalog.status(),
+            }
+        )
+
 
 appbuilder.add_view_no_menu(DatasetView())
 # appbuilder.add_link(
@@ -0,0 +1,15 @@
+import os
+import sys
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# the app is always deployed against a bucket
+os.environ.setdefault("BUCKET", "test-bucket")
+
+# apps/__init__.py builds the whole Flask, AppBuilder and cellxgene app. The tests
+# import the modules of the package without running it.
+if "apps" not in sys.modules:
+    apps = types.ModuleType("apps")
+    apps.__path__ = [os.path.join(ROOT, "apps")]
+    sys.modules["apps"] = apps
@@ -0,0 +1,81 @@
+import threading
+
+import anndata
+import numpy as np
+import pytest
+
+from apps import compute_service
+
+
+@pytest.fixture
+def adata():
+    return anndata.AnnData(X=np.ones((10, 3), dtype=np.float32))
+
+
+@pytest.fixture
+def service():
+    return compute_service.ComputeService(max_workers=1)
+
+
+def test_failed_job_can_be_submitted_again(service, adata, monkeypatch):
+    calls = []
+
+    def run(adata, basis, params=None):
+        calls.append(basis)
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        adata.obsm[f"X_{basis}"] = np.zeros((adata.n_obs, 2))
+
+    monkeypatch.setattr(compute_service.pipeline, "run", run)
+
+    with pytest.raises(RuntimeError):
+        service.submit(adata, "umap").result(timeout=5)
+    assert service.status(adata, "umap") == compute_service.ERROR
+    assert service.error(adata, "umap") == "out of memory"
+    # reported once, the basis can be picked again
+    assert service.status(adata, "umap") is None
+
+    assert service.submit(adata, "umap").result(timeout=5) is adata
+    assert calls == ["umap", "umap"]
+    assert service.status(adata, "umap") == compute_service.READY
+
+
+def test_identical_jobs_in_flight_are_shared(service, adata, monkeypatch):
+    release = threading.Event()
+
+    def run(adata, basis, params=None):
+        release.wait(5)
+        adata.obsm[f"X_{basis}"] = np.zeros((adata.n_obs, 2))
+
+    monkeypatch.setattr(compute_service.pipeline, "run", run)
+
+    first = service.submit(adata, "umap")
+    second = service.submit(adata, "umap")
+    assert first is second
+    assert service.status(adata, "umap") == compute_service.COMPUTING
+    release.set()
+    assert first.result(timeout=5) is adata
+
+
+def test_broken_pool_fails_the_job_and_is_replaced(service, adata, monkeypatch):
+    from concurrent.futures.process import BrokenProcessPool
+
+    class BrokenExecutor(object):
+        shutdown_called = False
+
+        def submit(self, *args, **kwargs):
+            raise BrokenProcessPool("worker killed")
+
+        def shutdown(self, wait=True):
+            BrokenExecutor.shutdown_called = True
+
+    compute_service.set_dataset_info(
+        adata, local_path="/tmp/data.h5ad", dataset_hash="abc", key="data"
+    )
+    service._executor = BrokenExecutor()
+
+    with pytest.raises(BrokenProcessPool):
+        service.submit(adata, "umap").result(timeout=5)
+    assert BrokenExecutor.shutdown_called
+    assert service._executor is None
+    assert service.status(adata, "umap") == compute_service.ERROR
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+try:
+    from apps.cellxgene import data_api
+except ImportError as e:
+    # imports the cellxgene config, which needs cellxgene and the app models
+    pytest.skip(f"needs the app dependencies: {e}", allow_module_level=True)
+
+
+def test_numeric_arrays_share_their_buffer():
+    values = np.arange(10, dtype=np.float32)
+    array = data_api.to_arrow(values)
+    assert array.type == pa.float32()
+    assert array.buffers()[1].address == values.ctypes.data
+    assert array.to_pylist() == values.tolist()
+
+
+def test_strided_and_non_native_arrays_are_copied():
+    values = np.arange(10, dtype=np.int64)[::2]
+    assert data_api.to_arrow(values).to_pylist() == [0, 2, 4, 6, 8]
+    swapped = np.arange(3, dtype=">f8")
+    assert data_api.to_arrow(swapped).to_pylist() == [0.0, 1.0, 2.0]
+
+
+def test_categoricals_are_dictionary_arrays():
+    values = pd.Series(pd.Categorical(["b", None, "a", "b"]))
+    array = data_api.to_arrow(values)
+    assert pa.types.is_dictionary(array.type)
+    assert array.dictionary.to_pylist() == ["a", "b"]
+    assert array.to_pylist() == ["b", None, "a", "b"]
+
+
+def test_strings_and_bools():
+    assert data_api.to_arrow(pd.Series(["x", "y"])).to_pylist() == ["x", "y"]
+    assert data_api.to_arrow(np.array([True, False])).to_pylist() == [True, False]
+
+
+def test_arrow_response_streams_record_batches(monkeypatch):
+    monkeypatch.setattr(data_api, "ARROW_BATCH_ROWS", 4)
+    names = ["n_genes", "louvain"]
+    arrays = [
+        data_api.to_arrow(np.arange(10, dtype=np.int32)),
+        data_api.to_arrow(pd.Series(pd.Categorical(list("abcabcabca")))),
+    ]
+    response = data_api.arrow_response(names, arrays)
+    assert response.mimetype == data_api.ARROW_STREAM_MIMETYPE
+    reader = pa.ipc.open_stream(b"".join(response.response))
+    batches = list(reader)
+    assert [batch.num_rows for batch in batches] == [4, 4, 2]
+    table = pa.Table.from_batches(batches)
+    assert table.column_names == names
+    assert table.column("n_genes").to_pylist() == list(range(10))
+    assert table.column("louvain").to_pylist() == list("abcabcabca")
@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from apps import dataset_jobs
+
+
+@pytest.fixture
+def jobs():
+    manager = dataset_jobs.JobManager(max_workers=2)
+    yield manager
+    manager.executor.shutdown(wait=True)
+
+
+def wait(job):
+    for _ in range(500):
+        if job.finished:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"job {job.key} did not finish")
+
+
+def test_job_reports_its_stages(jobs):
+    def load(job):
+        job.update(stage=dataset_jobs.DOWNLOADING, bytes_total=10)
+        job.add_bytes(4)
+        job.add_bytes(6)
+
+    job = wait(jobs.submit("data.h5ad", load))
+    assert job.done
+    state = job.to_dict()
+    assert state["stage"] == dataset_jobs.DONE
+    assert (state["bytes_downloaded"], state["bytes_total"]) == (10, 10)
+
+
+def test_one_job_per_key_in_flight(jobs):
+    release = threading.Event()
+    calls = []
+
+    def load(job):
+        calls.append(job)
+        release.wait(5)
+
+    first = jobs.submit("data.h5ad", load)
+    assert jobs.submit("data.h5ad", load) is first
+    # running jobs are not started again even when forced
+    assert jobs.submit("data.h5ad", load, force=True) is first
+    release.set()
+    wait(first)
+    # a finished job is kept unless forced
+    assert jobs.submit("data.h5ad", load) is first
+    second = wait(jobs.submit("data.h5ad", load, force=True))
+    assert second is not first
+    assert len(calls) == 2
+
+
+def test_failed_job_is_reported_once(jobs):
+    def fail(job):
+        raise IOError("no such object")
+
+    failed = wait(jobs.submit("data.h5ad", fail))
+    assert failed.failed
+    assert failed.to_dict()["error"] == "no such object"
+    assert jobs.submit("data.h5ad", fail) is failed
+    assert jobs.get("data.h5ad") is None
+
+    retried = wait(jobs.submit("data.h5ad", lambda job: None))
+    assert retried is not failed
+    assert retried.done
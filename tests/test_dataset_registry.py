@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from apps.dataset_registry import DatasetRegistry
+
+
+class Dataset(object):
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+
+@pytest.fixture
+def registry():
+    return DatasetRegistry(max_bytes=250, sizer=lambda value: value.nbytes)
+
+
+def test_get_loads_once(registry):
+    loads = []
+
+    def loader():
+        loads.append(1)
+        return Dataset(100)
+
+    first = registry.get("a", loader)
+    assert registry.get("a", loader) is first
+    assert len(loads) == 1
+    assert (registry.misses, registry.hits) == (1, 1)
+
+
+def test_concurrent_misses_load_once(registry):
+    loads = []
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.1)
+        return Dataset(100)
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.get("a", loader)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert len(set(map(id, results))) == 1
+
+
+def test_evicts_least_recently_used(registry):
+    registry.get("a", lambda: Dataset(100))
+    registry.get("b", lambda: Dataset(100))
+    registry.get("a", lambda: Dataset(100))
+    registry.get("c", lambda: Dataset(100))
+    assert "b" not in registry
+    assert "a" in registry and "c" in registry
+    assert registry.evictions == 1
+    assert registry.total_bytes <= registry.max_bytes
+
+
+def test_pinned_entries_are_kept(registry):
+    registry.get("a", lambda: Dataset(100))
+    registry.pin("a")
+    registry.get("b", lambda: Dataset(100))
+    registry.get("c", lambda: Dataset(100))
+    assert "a" in registry
+    assert "b" not in registry
+
+    # over budget with everything pinned, the entry just loaded is kept
+    registry.pin("c")
+    registry.get("d", lambda: Dataset(100))
+    assert registry.total_bytes > registry.max_bytes
+    assert "d" in registry
+
+    # unpinning makes room again
+    registry.unpin("a")
+    assert "a" not in registry
+    assert registry.total_bytes <= registry.max_bytes
+    with pytest.raises(KeyError):
+        registry.pin("a")
+
+
+def test_refresh_measures_again(registry):
+    a = registry.get("a", lambda: Dataset(100))
+    registry.get("b", lambda: Dataset(100))
+    a.nbytes = 200
+    registry.refresh("a")
+    assert "a" in registry
+    assert "b" not in registry
+    assert registry.stats()["entries"][0]["nbytes"] == 200
@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+
+import fsspec
+import pytest
+
+from apps import disk_cache
+
+
+@pytest.fixture
+def fs():
+    return fsspec.filesystem("file")
+
+
+@pytest.fixture
+def remote(tmp_path):
+    root = tmp_path / "remote"
+    root.mkdir()
+
+    def write(name, data):
+        path = root / name
+        path.write_bytes(data)
+        return str(path)
+
+    return write
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return disk_cache.DiskCache(root=str(tmp_path / "cache"), max_bytes=1024 ** 2)
+
+
+def test_fetch_hit_after_miss(cache, fs, remote):
+    url = remote("data.h5ad", b"a" * 100)
+    first = cache.fetch(url, fs=fs)
+    second = cache.fetch(url, fs=fs)
+    assert first == second
+    assert open(first, "rb").read() == b"a" * 100
+    assert (cache.misses, cache.hits) == (1, 1)
+
+
+def test_fetch_revalidates_changed_object(cache, fs, remote):
+    url = remote("data.h5ad", b"a" * 100)
+    old = cache.fetch(url, fs=fs)
+    # a new version of the object, with a new mtime and size
+    time.sleep(0.01)
+    remote("data.h5ad", b"b" * 120)
+    new = cache.fetch(url, fs=fs)
+    assert new != old
+    assert open(new, "rb").read() == b"b" * 120
+    assert not os.path.exists(old)
+    assert cache.misses == 2
+
+
+def test_fetch_serves_cached_copy_when_remote_is_unreachable(cache, fs, remote):
+    url = remote("data.h5ad", b"a" * 100)
+    cached = cache.fetch(url, fs=fs)
+
+    class Unreachable(object):
+        def _strip_protocol(self, url):
+            return url
+
+        def invalidate_cache(self, path):
+            pass
+
+        def info(self, path):
+            raise ConnectionError("unreachable")
+
+    assert cache.fetch(url, fs=Unreachable()) == cached
+
+
+def test_eviction_removes_least_recently_used(tmp_path, fs, remote):
+    cache = disk_cache.DiskCache(root=str(tmp_path / "cache"), max_bytes=250)
+    first = cache.fetch(remote("first.h5ad", b"1" * 100), fs=fs)
+    second = cache.fetch(remote("second.h5ad", b"2" * 100), fs=fs)
+    now = time.time()
+    os.utime(first, (now - 60, now - 60))
+    os.utime(second, (now - 30, now - 30))
+
+    third = cache.fetch(remote("third.h5ad", b"3" * 100), fs=fs)
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+    assert os.path.exists(third)
+    assert cache.evictions == 1
+    assert cache.stats()["total_bytes"] <= 250
+
+
+def test_concurrent_fetch_of_one_key_downloads_once(cache, fs, remote, monkeypatch):
+    url = remote("data.h5ad", b"a" * 1000)
+    download = disk_cache.s3_utils.download
+    downloads = []
+
+    def slow_download(*args, **kwargs):
+        downloads.append(args[0])
+        time.sleep(0.2)
+        return download(*args, **kwargs)
+
+    monkeypatch.setattr(disk_cache.s3_utils, "download", slow_download)
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.fetch(url, fs=fs)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(downloads) == 1
+    assert len(results) == 8
+    assert len(set(results)) == 1
+    assert cache.misses == 1
+    assert cache.hits == 7
+
+
+def test_fetch_starts_over_when_the_object_changes(cache, fs, remote, monkeypatch):
+    url = remote("data.h5ad", b"a" * 100)
+    download = disk_cache.s3_utils.download
+    downloads = []
+
+    def replaced_once(*args, **kwargs):
+        downloads.append(args[0])
+        if len(downloads) == 1:
+            remote("data.h5ad", b"b" * 120)
+            raise disk_cache.s3_utils.ObjectChangedError(f"{url} changed during download")
+        return download(*args, **kwargs)
+
+    monkeypatch.setattr(disk_cache.s3_utils, "download", replaced_once)
+    local_path = cache.fetch(url, fs=fs)
+    assert open(local_path, "rb").read() == b"b" * 120
+    assert len(downloads) == 2
+
+
+def test_eviction_counts_downloads_in_flight(tmp_path, fs, remote, monkeypatch):
+    cache = disk_cache.DiskCache(root=str(tmp_path / "cache"), max_bytes=250)
+    old = cache.fetch(remote("old.h5ad", b"0" * 100), fs=fs)
+    download = disk_cache.s3_utils.download
+    started, release = threading.Event(), threading.Event()
+
+    def slow_download(url, *args, **kwargs):
+        if url.endswith("first.h5ad"):
+            started.set()
+            release.wait(5)
+        return download(url, *args, **kwargs)
+
+    monkeypatch.setattr(disk_cache.s3_utils, "download", slow_download)
+    first_url = remote("first.h5ad", b"1" * 100)
+    thread = threading.Thread(target=cache.fetch, args=(first_url,), kwargs={"fs": fs})
+    thread.start()
+    assert started.wait(5)
+    assert cache.stats()["downloading"] == 1
+
+    # the first download is not on disk yet but takes its room
+    second = cache.fetch(remote("second.h5ad", b"2" * 100), fs=fs)
+    assert not os.path.exists(old)
+    release.set()
+    thread.join()
+    assert os.path.exists(second)
+    stats = cache.stats()
+    assert stats["files"] == 2
+    assert stats["total_bytes"] <= 250
+    assert stats["downloading"] == 0
+    assert (cache.misses, cache.evictions) == (3, 1)
@@ -0,0 +1,44 @@
+import anndata
+import numpy as np
+import pytest
+from scipy import sparse
+
+from apps import gene_matrix
+
+
+@pytest.fixture
+def X():
+    rng = np.random.default_rng(0)
+    return sparse.random(50, 20, density=0.3, format="csr", random_state=rng)
+
+
+@pytest.fixture
+def backed(tmp_path, X):
+    path = str(tmp_path / "data.h5ad")
+    anndata.AnnData(X=X.astype(np.float32)).write_h5ad(path)
+    adata = anndata.read_h5ad(path, backed="r")
+    yield adata
+    adata.file.close()
+
+
+@pytest.mark.parametrize("rows", [None, slice(5, 37), slice(3, 40, 4)])
+def test_column_block_in_memory(X, rows):
+    columns = [7, 2, 7, 19]
+    expected = X.toarray()[rows if rows is not None else slice(None)][:, columns]
+    np.testing.assert_allclose(gene_matrix.column_block(X, columns, rows), expected)
+    np.testing.assert_allclose(
+        gene_matrix.column_block(X.tocsc(), columns, rows), expected
+    )
+    np.testing.assert_allclose(
+        gene_matrix.column_block(X.toarray(), columns, rows), expected
+    )
+
+
+@pytest.mark.parametrize("rows", [None, slice(5, 37), slice(3, 40, 4)])
+def test_column_block_backed_reads_row_chunks(backed, X, rows, monkeypatch):
+    monkeypatch.setattr(gene_matrix, "GENE_MAJOR_CHUNK_ROWS", 8)
+    columns = [7, 2, 7, 19]
+    expected = X.toarray()[rows if rows is not None else slice(None)][:, columns]
+    block = gene_matrix.column_block(backed.X, columns, rows)
+    assert block.dtype == np.float32
+    np.testing.assert_allclose(block, expected, rtol=1e-6)
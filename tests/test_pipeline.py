@@ -0,0 +1,41 @@
+import numpy as np
+
+from apps import pipeline
+
+
+def test_cache_key_is_stable():
+    key = pipeline.cache_key("abc", "umap", {"min_dist": 0.5, "spread": 1.0}, ["k1"])
+    assert key == pipeline.cache_key(
+        "abc", "umap", {"spread": 1.0, "min_dist": 0.5}, ("k1",)
+    )
+    assert len(key) == 16
+
+
+def test_cache_key_changes_with_its_inputs():
+    key = pipeline.cache_key("abc", "umap", {"min_dist": 0.5}, ["k1"])
+    assert key != pipeline.cache_key("abd", "umap", {"min_dist": 0.5}, ["k1"])
+    assert key != pipeline.cache_key("abc", "tsne", {"min_dist": 0.5}, ["k1"])
+    assert key != pipeline.cache_key("abc", "umap", {"min_dist": 0.1}, ["k1"])
+    assert key != pipeline.cache_key("abc", "umap", {"min_dist": 0.5}, ["k2"])
+
+
+def test_stratified_sample_without_labels():
+    sample = pipeline.stratified_sample(1000, 100)
+    assert len(sample) == 100
+    assert len(np.unique(sample)) == 100
+    assert np.all(np.diff(sample) > 0)
+    assert np.array_equal(sample, pipeline.stratified_sample(1000, 100))
+    assert np.array_equal(pipeline.stratified_sample(50, 100), np.arange(50))
+
+
+def test_stratified_sample_keeps_rare_groups():
+    labels = np.array(["common"] * 9900 + ["rare"] * 60 + ["tiny"] * 40)
+    sample = pipeline.stratified_sample(len(labels), 1000, labels, min_per_group=50)
+    assert len(np.unique(sample)) == len(sample)
+    groups, counts = np.unique(labels[sample], return_counts=True)
+    counts = dict(zip(groups, counts))
+    assert counts["common"] == 990
+    # below their share of the sample the small groups get min_per_group,
+    # or every cell they have
+    assert counts["rare"] == 50
+    assert counts["tiny"] == 40
@@ -0,0 +1,103 @@
+import fsspec.asyn
+import pytest
+
+from apps import s3_utils
+
+
+class Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    async def read(self):
+        return self.data
+
+    def close(self):
+        pass
+
+
+class FakeS3(object):
+    """
+    The parts of s3fs download uses, serving one object that can be replaced
+    """
+
+    def __init__(self, data, etag="v1", version_id=None):
+        self.loop = fsspec.asyn.get_loop()
+        self.versions = {version_id or etag: data}
+        self.etag, self.version_id, self.data = etag, version_id, data
+        self.requests = []
+
+    def replace(self, data, etag, version_id=None):
+        self.versions[version_id or etag] = data
+        self.etag, self.version_id, self.data = etag, version_id, data
+
+    def _strip_protocol(self, url):
+        return url.split("://", 1)[-1]
+
+    def split_path(self, path):
+        bucket, key = path.split("/", 1)
+        return bucket, key, None
+
+    def invalidate_cache(self, path):
+        pass
+
+    def info(self, path):
+        info = {"size": len(self.data), "ETag": f'"{self.etag}"'}
+        if self.version_id:
+            info["VersionId"] = self.version_id
+        return info
+
+    async def _call_s3(self, method, Bucket, Key, Range, **pin):
+        self.requests.append(pin)
+        start, end = (int(n) for n in Range[len("bytes=") :].split("-"))
+        if "VersionId" in pin:
+            data = self.versions[pin["VersionId"]]
+        elif pin.get("IfMatch") != f'"{self.etag}"':
+            raise PermissionError("PreconditionFailed")
+        else:
+            data = self.data
+        return {"Body": Body(data[start : end + 1])}
+
+
+def test_download_pins_parts_to_the_etag(tmp_path):
+    fs = FakeS3(b"0123456789" * 10)
+    out = str(tmp_path / "data.h5ad")
+    s3_utils.download("s3://bucket/data.h5ad", out, fs=fs, part_size=16)
+    assert open(out, "rb").read() == b"0123456789" * 10
+    assert len(fs.requests) == 7
+    assert all(pin == {"IfMatch": '"v1"'} for pin in fs.requests)
+
+
+def test_download_fails_when_the_object_is_replaced(tmp_path):
+    fs = FakeS3(b"a" * 100)
+    info = fs.info("bucket/data.h5ad")
+    fs.replace(b"b" * 100, etag="v2")
+    out = str(tmp_path / "data.h5ad")
+    with pytest.raises(s3_utils.ObjectChangedError):
+        s3_utils.download("s3://bucket/data.h5ad", out, fs=fs, part_size=16, info=info)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_download_reads_the_version_it_was_given(tmp_path):
+    fs = FakeS3(b"a" * 100, etag="v1", version_id="1")
+    info = fs.info("bucket/data.h5ad")
+    fs.replace(b"b" * 100, etag="v2", version_id="2")
+    out = str(tmp_path / "data.h5ad")
+    s3_utils.download("s3://bucket/data.h5ad", out, fs=fs, part_size=16, info=info)
+    assert open(out, "rb").read() == b"a" * 100
+    assert all(pin == {"VersionId": "1"} for pin in fs.requests)
+
+
+def test_download_checks_other_filesystems_after_the_parts(tmp_path, monkeypatch):
+    remote = tmp_path / "remote.h5ad"
+    remote.write_bytes(b"a" * 100)
+    fs = fsspec.filesystem("file")
+    cat_file = fs.cat_file
+
+    def replaced(path, start=None, end=None):
+        data = cat_file(path, start=start, end=end)
+        remote.write_bytes(b"b" * 120)
+        return data
+
+    monkeypatch.setattr(fs, "cat_file", replaced)
+    with pytest.raises(s3_utils.ObjectChangedError):
+        s3_utils.download(str(remote), str(tmp_path / "data.h5ad"), fs=fs)
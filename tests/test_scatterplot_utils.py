@@ -0,0 +1,70 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    from apps.scanpy import scatterplot_utils
+except ImportError as e:
+    # imports sc_utils, which needs cellxgene and the app models
+    pytest.skip(f"needs the app dependencies: {e}", allow_module_level=True)
+
+
+@pytest.fixture
+def frame():
+    rng = np.random.default_rng(0)
+    # a dense blob, a sparse spread and a rare category inside the blob
+    dense = rng.normal(0, 0.1, size=(9000, 2))
+    spread = rng.uniform(-10, 10, size=(900, 2))
+    rare = rng.normal(0, 0.1, size=(100, 2))
+    xy = np.concatenate([dense, spread, rare])
+    return pd.DataFrame(
+        {
+            "x": xy[:, 0],
+            "y": xy[:, 1],
+            "cell_type": pd.Categorical(["T"] * 9000 + ["B"] * 900 + ["NK"] * 100),
+        }
+    )
+
+
+def test_downsample_under_budget_is_unchanged(frame):
+    assert scatterplot_utils.downsample(frame, budget=len(frame)) is frame
+
+
+def test_downsample_stays_within_budget(frame):
+    sample = scatterplot_utils.downsample(frame, budget=2000)
+    assert 0 < len(sample) <= 2000
+    assert sample.index.is_unique
+    assert sample.index.isin(frame.index).all()
+    # the same cells for the same random state
+    assert sample.index.equals(scatterplot_utils.downsample(frame, budget=2000).index)
+
+
+def test_downsample_thins_dense_regions(frame):
+    sample = scatterplot_utils.downsample(frame, budget=2000)
+    kept = sample["cell_type"].value_counts()
+    assert kept["B"] / 900 > kept["T"] / 9000
+
+
+def test_downsample_keeps_rare_categories(frame):
+    sample = scatterplot_utils.downsample(frame, budget=2000, category="cell_type")
+    kept = sample["cell_type"].value_counts()
+    assert len(sample) <= 2000
+    assert kept["NK"] == 100
+
+
+def test_category_codes_give_missing_values_a_category():
+    codes, categories = scatterplot_utils.category_codes(
+        pd.Series(pd.Categorical(["b", None, "a", "b"]))
+    )
+    assert categories == ["a", "b", "nan"]
+    assert list(codes) == [1, 2, 0, 1]
+
+
+def test_typed_array_round_trips():
+    import base64
+
+    values = np.array([1.5, -2.0, 3.25])
+    encoded = scatterplot_utils.typed_array(values)
+    assert encoded["dtype"] == "f4"
+    decoded = np.frombuffer(base64.b64decode(encoded["bdata"]), dtype="<f4")
+    np.testing.assert_array_equal(decoded, values.astype(np.float32))
@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from apps.scanpy import table_query
+from apps.scanpy.table_query import FilterError, TableQuery, parse_filter
+
+
+@pytest.fixture
+def frame():
+    return pd.DataFrame(
+        {
+            "n_genes": [10, 30, 20, np.nan, 30],
+            "louvain": pd.Categorical(["b", "a", None, "b", "c"]),
+            "label": ["CD4 T", None, "cd8 T", "B", "NK"],
+            "doublet": [True, False, True, False, False],
+            "flagged": pd.array([True, None, False, True, None], dtype="boolean"),
+        },
+        index=[f"cell{i}" for i in range(5)],
+    )
+
+
+@pytest.fixture
+def query(frame):
+    return TableQuery(frame)
+
+
+def rows(query, filter_query=None, sort_by=None):
+    return list(query.rows(sort_by=sort_by, filter_query=filter_query))
+
+
+def test_parse_filter():
+    assert parse_filter("") == []
+    assert parse_filter('{n_genes} ge 20 && {label} icontains "t"') == [
+        ("n_genes", "ge", "20", True),
+        ("label", "contains", "t", False),
+    ]
+    assert parse_filter("{louvain} is blank") == [("louvain", "is blank", "", True)]
+    with pytest.raises(FilterError):
+        parse_filter("n_genes > 3")
+
+
+def test_numeric_filter_leaves_out_missing_values(query):
+    assert rows(query, "{n_genes} > 15") == [1, 2, 4]
+    assert rows(query, "{n_genes} ne 30") == [0, 2]
+    with pytest.raises(FilterError):
+        rows(query, "{n_genes} > many")
+
+
+@pytest.mark.parametrize(
+    "filter_query, expected",
+    [
+        ("{doublet} = True", [0, 2]),
+        ("{doublet} eq false", [1, 3, 4]),
+        ("{doublet} ne 1", [1, 3, 4]),
+        ("{flagged} = true", [0, 3]),
+        ("{flagged} ne true", [2]),
+        ("{flagged} is blank", [1, 4]),
+    ],
+)
+def test_bool_filter(query, filter_query, expected):
+    assert rows(query, filter_query) == expected
+
+
+def test_bool_filter_rejects_other_values(query):
+    with pytest.raises(FilterError):
+        rows(query, "{doublet} = maybe")
+
+
+def test_text_filter_leaves_out_missing_values(query):
+    assert rows(query, "{label} < C") == [3]
+    assert rows(query, "{label} ne NK") == [0, 2, 3]
+    assert rows(query, "{label} contains T") == [0, 2]
+    assert rows(query, "{label} icontains t") == [0, 2]
+    assert rows(query, "{label} is not blank") == [0, 2, 3, 4]
+
+
+def test_categorical_filter(query):
+    assert rows(query, "{louvain} = b") == [0, 3]
+    assert rows(query, "{louvain} ne b") == [1, 4]
+    assert rows(query, "{louvain} is blank") == [2]
+
+
+def test_unknown_column(query):
+    with pytest.raises(FilterError):
+        rows(query, "{missing} = 1")
+
+
+def test_sort_keeps_missing_values_last(query):
+    ascending = [{"column_id": "n_genes", "direction": "asc"}]
+    descending = [{"column_id": "n_genes", "direction": "desc"}]
+    assert rows(query, sort_by=ascending) == [0, 2, 1, 4, 3]
+    assert rows(query, sort_by=descending) == [1, 4, 2, 0, 3]
+    # ties broken by the next column
+    assert rows(
+        query,
+        sort_by=descending + [{"column_id": "label", "direction": "desc"}],
+    ) == [4, 1, 2, 0, 3]
+    assert rows(query, "{doublet} = false", sort_by=ascending) == [1, 4, 3]
+
+
+def test_page(query):
+    records, page_count, matching = query.page(1, 2)
+    assert (page_count, matching) == (3, 5)
+    assert [record["label"] for record in records] == ["cd8 T", "B"]
+
+
+def test_summarize(frame):
+    summary = {row["column"]: row for row in table_query.summarize(frame)}
+    assert list(summary) == list(frame.columns)
+    assert summary["n_genes"]["nulls"] == 1
+    assert summary["n_genes"]["min"] == 10
+    assert summary["n_genes"]["max"] == 30
+    assert summary["n_genes"]["median"] == 25
+    assert summary["louvain"]["unique"] == 3
+    assert summary["louvain"]["top"].startswith("b (2)")
+    # bools are counted, not averaged
+    assert summary["doublet"]["top"] == "False (3), True (2)"
+
+
+def test_get_table_is_kept_with_the_dataset(frame, monkeypatch):
+    import anndata
+
+    from apps import dataset_registry
+
+    adata = anndata.AnnData(obs=frame)
+    dataset_registry.set_dataset_info(adata, key="data.h5ad")
+    refreshed = []
+    monkeypatch.setattr(table_query.registry, "refresh", refreshed.append)
+
+    query = table_query.get_table(adata, "obs")
+    assert table_query.get_table(adata, "obs") is query
+    assert dataset_registry.get_dataset_info(adata)["key"] == "data.h5ad"
+    assert table_query.tables_nbytes(adata) == 0
+
+    query.order("n_genes")
+    assert refreshed == ["data.h5ad", "data.h5ad"]
+    assert table_query.tables_nbytes(adata) == query.nbytes() > 0
+
+    # a new column makes a new table
+    adata.obs["score"] = np.arange(adata.n_obs, dtype=np.float64)
+    rebuilt = table_query.get_table(adata, "obs")
+    assert rebuilt is not query
+    assert "score" in [column["id"] for column in rebuilt.columns()]
+    assert table_query.tables_nbytes(adata) == 0
+
+
+def test_get_table_without_dataset_info():
+    import anndata
+
+    adata = anndata.AnnData(obs=pd.DataFrame(index=["a", "b"]))
+    query = table_query.get_table(adata, "var")
+    assert table_query.get_table(adata, "var") is query
+    assert query.key is None
+    with pytest.raises(ValueError):
+        table_query.get_table(adata, "X")
@@ -0,0 +1,74 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+try:
+    from apps.scanpy import tiles
+except ImportError as e:
+    # imports sc_utils, which needs cellxgene and the app models
+    pytest.skip(f"needs the app dependencies: {e}", allow_module_level=True)
+
+
+BOUNDS = (0.0, 8.0, 0.0, 4.0)
+
+
+def test_tile_bounds_split_the_embedding():
+    assert tiles.tile_bounds(BOUNDS, 0, 0, 0) == BOUNDS
+    assert tiles.tile_bounds(BOUNDS, 1, 1, 0) == (4.0, 8.0, 0.0, 2.0)
+    assert tiles.tile_bounds(BOUNDS, 2, 3, 3) == (6.0, 8.0, 3.0, 4.0)
+
+
+def test_visible_tiles():
+    assert tiles.visible_tiles(BOUNDS) == (0, [(0, 0)])
+    # a quarter of the width and height is zoom 2
+    z, visible = tiles.visible_tiles(BOUNDS, (2.1, 3.9, 1.1, 1.9))
+    assert z == 2
+    assert visible == [(1, 1)]
+    # deep zoom windows are capped at TILE_MAX_ZOOM
+    z, visible = tiles.visible_tiles(BOUNDS, (1.0, 1.0 + 1e-9, 1.0, 1.0 + 1e-9))
+    assert z == tiles.TILE_MAX_ZOOM
+    assert len(visible) <= tiles.MAX_VISIBLE_TILES
+
+
+def test_aggregate_counts():
+    points = tiles.Points([0.5, 0.5, 3.5, 8.0], [0.5, 0.5, 3.5, 4.0])
+    counts, image = tiles.aggregate(points, (0.0, 4.0, 0.0, 4.0), size=4)
+    assert image is None
+    assert counts.sum() == 3
+    # rows along y from the bottom
+    assert counts[0, 0] == 2
+    assert counts[3, 3] == 1
+
+
+def test_aggregate_mean_and_majority():
+    x, y = [0.5, 0.5, 0.5, 3.5], [0.5, 0.5, 0.5, 3.5]
+    numeric = tiles.Points(x, y, [1.0, 2.0, np.nan, 4.0])
+    assert numeric.how == "mean"
+    counts, image = tiles.aggregate(numeric, (0.0, 4.0, 0.0, 4.0), size=4)
+    assert image[0, 0] == 1.5
+    assert image[3, 3] == 4.0
+    assert np.isnan(image[1, 1])
+
+    labels = tiles.Points(x, y, pd.Series(["b", "a", "b", "a"], dtype="category"))
+    assert labels.how == "majority"
+    counts, image = tiles.aggregate(labels, (0.0, 4.0, 0.0, 4.0), size=4)
+    assert labels.categories[image[0, 0]] == "b"
+    assert labels.categories[image[3, 3]] == "a"
+
+
+def test_render_tile_is_a_png():
+    rng = np.random.default_rng(0)
+    points = tiles.Points(rng.normal(size=1000), rng.normal(size=1000))
+    png = tiles.render_tile(points, 1, 0, 1)
+    assert png.startswith(b"\x89PNG")
+
+
+def test_lru_cache():
+    cache = tiles.LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats() == {"size": 2, "maxsize": 2, "hits": 2, "misses": 1}